@@ -1,7 +1,160 @@
+import contextlib
+import copy
+import math
+import types
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.models as models
 from transformers import Wav2Vec2Model
+from torch.utils.checkpoint import checkpoint
+from transformers.modeling_utils import no_init_weights
+
+WAV2VEC_PRETRAINED = "facebook/wav2vec2-large-960h"
+LFCC_SHAPE = (80, 321)  # (n_lfcc, frames) of the LFCC of a 4 seconds clip at 16kHz, input of the CNN branch
+
+
+# =============================================================================
+# 0. Process-level cache of pristine pretrained weights
+# =============================================================================
+# Once warm_pretrained_cache was called (hyperparameter studies, which build a model per trial), every model
+# built in this process is initialized by copying from these state dicts instead of deserializing the
+# pretrained checkpoints again. The cached tensors are only ever read, so workers forked after the cache
+# is warm share them copy-on-write. Otherwise (inference, export, distillation, ...) nothing is kept.
+_PRETRAINED_CACHE = {}
+_CACHE_ENABLED = False  # set by warm_pretrained_cache, reset by clear_pretrained_cache
+
+
+def get_pretrained(name, loader):
+    """
+    Returns the cached object for `name`, or `loader()` (kept in the cache only once it is enabled).
+    """
+    if name in _PRETRAINED_CACHE:
+        return _PRETRAINED_CACHE[name]
+    value = loader()
+    if _CACHE_ENABLED:
+        _PRETRAINED_CACHE[name] = value
+    return value
+
+
+def clear_pretrained_cache():
+    """Frees the cached pretrained weights (about 1.2 GB with Wav2Vec2 large) and stops caching."""
+    global _CACHE_ENABLED
+    _CACHE_ENABLED = False
+    _PRETRAINED_CACHE.clear()
+
+
+def _detached_state(module):
+    return {key: value.detach() for key, value in module.state_dict().items()}
+
+
+def vgg16_bn_features_state():
+    def loader():
+        features = models.vgg16_bn(pretrained=True).features
+        return _detached_state(features)
+    return get_pretrained("vgg16_bn.features", loader)
+
+
+def torchvision_state(model_name):
+    return get_pretrained(model_name, lambda: _detached_state(getattr(models, model_name)(pretrained=True)))
+
+
+def resnet_state(model_name):
+    return torchvision_state(model_name)
+
+
+def wav2vec_state(model_name=WAV2VEC_PRETRAINED):
+    """Returns (config, state dict) of a pretrained Wav2Vec2 model."""
+    def loader():
+        model = Wav2Vec2Model.from_pretrained(model_name)
+        return model.config, _detached_state(model)
+    return get_pretrained(model_name, loader)
+
+
+def warm_pretrained_cache(backbones=("vgg",)):
+    """
+    Loads the pretrained weights used by AVDNet once, so that models built afterwards
+    (including in forked trial workers) only copy them in memory. Call clear_pretrained_cache once done.
+    """
+    global _CACHE_ENABLED
+    _CACHE_ENABLED = True
+    for backbone in backbones:
+        if backbone.lower() == "vgg":
+            vgg16_bn_features_state()
+        elif backbone.lower() == "resnet":
+            resnet_state("resnet50")
+        elif backbone.lower() == "resnet34":
+            resnet_state("resnet34")
+        elif backbone.lower() in EFFICIENT_BACKBONES:
+            torchvision_state(EFFICIENT_BACKBONES[backbone.lower()])
+    wav2vec_state()
+
+
+# Activation checkpointing: the activations of the checkpointed modules are not kept for the backward
+# pass but recomputed during it (less memory, about one more forward of compute). The recomputation
+# restores the BatchNorm running statistics it updates, so they are updated once per step as without it.
+def _needs_grad(module, args):
+    return any(param.requires_grad for param in module.parameters()) or \
+        any(isinstance(arg, torch.Tensor) and arg.requires_grad for arg in args)
+
+
+@contextlib.contextmanager
+def _preserved_batchnorm_statistics(module):
+    """Restores on exit the running statistics (and batch counters) of every BatchNorm of `module`."""
+    saved = [(buffer, buffer.clone()) for layer in module.modules()
+             if isinstance(layer, nn.modules.batchnorm._BatchNorm) for buffer in layer.buffers()]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for buffer, value in saved:
+                buffer.copy_(value)
+
+
+def _checkpoint(function, module, *args, **kwargs):
+    """checkpoint() of module (called through `function`), whose recomputation leaves the BatchNorm statistics unchanged."""
+    return checkpoint(function, *args, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), _preserved_batchnorm_statistics(module)), **kwargs)
+
+
+def _checkpointed_forward(self, *args, **kwargs):
+    forward = type(self).forward
+    if self.training and torch.is_grad_enabled() and _needs_grad(self, args):
+        return _checkpoint(forward, self, self, *args, **kwargs)
+    return forward(self, *args, **kwargs)
+
+
+def set_activation_checkpointing(module, enabled=True):
+    """Makes `module` recompute its activations in the backward pass (when it trains) or restores its forward."""
+    if enabled:
+        module.forward = types.MethodType(_checkpointed_forward, module)
+    else:
+        module.__dict__.pop("forward", None)
+    return module
+
+
+def run_features(features, x, checkpoint_segments=0):
+    """
+    Runs a CNN trunk (nn.Sequential). With checkpoint_segments > 0 in training, the modules from the first
+    trainable one onward are split in that many segments, all checkpointed but the last one (as
+    checkpoint_sequential does; the frozen prefix keeps no activations anyway).
+    """
+    if checkpoint_segments > 0 and features.training and torch.is_grad_enabled():
+        start = next((i for i, layer in enumerate(features)
+                      if any(param.requires_grad for param in layer.parameters())), len(features))
+        x = features[:start](x)
+        tail = features[start:]
+        segments = min(checkpoint_segments, len(tail))
+        if segments > 0:
+            segment_size = len(tail) // segments
+            for begin in range(0, segment_size * (segments - 1), segment_size):
+                segment = tail[begin:begin + segment_size]
+                x = _checkpoint(segment, segment, x)
+            x = tail[segment_size * (segments - 1):](x)
+        return x
+    return features(x)
 
 
 # =============================================================================
@@ -18,13 +171,15 @@ class VGG16FeatureExtractor(nn.Module):
               Otherwise, only freeze the first `freeze_vgg_layers` modules.
         """
         super(VGG16FeatureExtractor, self).__init__()
-        vgg16 = models.vgg16_bn(pretrained=True)
+        # Build only the convolutions (cutting the dense) and copy the cached pretrained weights in
+        features = models.vgg.make_layers(models.vgg.cfgs["D"], batch_norm=True)
+        features.load_state_dict(vgg16_bn_features_state())
 
         # Modify first convolution layer to accept 1-channel input
-        vgg16.features[0] = nn.Conv2d(1, 64, kernel_size=3, stride=1, padding=1)
+        features[0] = nn.Conv2d(1, 64, kernel_size=3, stride=1, padding=1)
 
-        #keeping only the convolutions (cutting the dense)
-        self.features = vgg16.features
+        self.features = features
+        self.checkpoint_segments = 0  # see AVDNet.enable_activation_checkpointing
 
         if freeze:
             if freeze_vgg_layers is None:
@@ -41,7 +196,7 @@ class VGG16FeatureExtractor(nn.Module):
         x: Tensor of shape [B, 3, H, W] (e.g., spectrogram-like input)
         Returns: feature maps of shape [B, 512, H_out, W_out]
         """
-        return self.features(x)
+        return run_features(self.features, x, self.checkpoint_segments)
 
 
 # =============================================================================
@@ -59,7 +214,8 @@ class ResNetFeatureExtractor(nn.Module):
               Otherwise, freeze only the first `freeze_resnet_layers` modules in the features.
         """
         super(ResNetFeatureExtractor, self).__init__()
-        resnet = getattr(models, model_name)(pretrained=True)
+        resnet = getattr(models, model_name)(weights=None)
+        resnet.load_state_dict(resnet_state(model_name))
 
         resnet.conv1 = nn.Conv2d(1, 64, kernel_size=7, stride=2, padding=3, bias=False)
         # Build a sequential model that stops before the average pool and fc layers.
@@ -74,6 +230,8 @@ class ResNetFeatureExtractor(nn.Module):
             resnet.layer4  # for resnet50: 2048
         )
 
+        self.checkpoint_segments = 0  # see AVDNet.enable_activation_checkpointing
+
         # 🔹 Modify first layer to accept 1-channel input
 
         if freeze:
@@ -92,14 +250,140 @@ class ResNetFeatureExtractor(nn.Module):
         x: Tensor of shape [B, 3, H, W] (e.g., spectrogram-like input)
         Returns: feature maps of shape [B, C, H_out, W_out] (for resnet50, C=2048)
         """
-        return self.features(x)
+        return run_features(self.features, x, self.checkpoint_segments)
+
+
+# =============================================================================
+# 2b. Lightweight Feature Extractors (MobileNetV3, EfficientNet-B0, depthwise CNN)
+# =============================================================================
+# backbone name -> torchvision model whose `features` trunk is used
+EFFICIENT_BACKBONES = {"mobilenet_v3_small": "mobilenet_v3_small",
+                       "mobilenet_v3_large": "mobilenet_v3_large",
+                       "efficientnet_b0": "efficientnet_b0"}
+
+
+def _freeze_modules(features, freeze, freeze_layers):
+    """Same freezing rule as the VGG/ResNet extractors: every module, or only the first `freeze_layers` ones."""
+    if freeze:
+        for i, layer in enumerate(features):
+            if freeze_layers is None or i < freeze_layers:
+                for param in layer.parameters():
+                    param.requires_grad = False
+
+
+class EfficientFeatureExtractor(nn.Module):
+    def __init__(self, model_name="mobilenet_v3_small", freeze=True, freeze_layers=None):
+        """
+        Loads a pretrained MobileNetV3 or EfficientNet-B0 and uses its convolutional trunk (features).
+
+        Args:
+            model_name (str): "mobilenet_v3_small", "mobilenet_v3_large" or "efficientnet_b0".
+            freeze (bool): Whether to freeze layers.
+            freeze_layers (int or None): If None, freeze all layers when freeze is True.
+              Otherwise, only freeze the first `freeze_layers` modules of the trunk.
+        """
+        super(EfficientFeatureExtractor, self).__init__()
+        network = getattr(models, model_name)(weights=None)
+        network.load_state_dict(torchvision_state(model_name))
+        features = network.features
+
+        # Modify first convolution layer to accept 1-channel input
+        stem = features[0][0]
+        features[0][0] = nn.Conv2d(1, stem.out_channels, kernel_size=stem.kernel_size, stride=stem.stride,
+                                   padding=stem.padding, bias=False)
+
+        self.features = features
+        self.out_channels = features[-1].out_channels  # 576 / 960 / 1280
+        self.checkpoint_segments = 0  # see AVDNet.enable_activation_checkpointing
+        _freeze_modules(self.features, freeze, freeze_layers)
+
+    def forward(self, x):
+        """
+        x: Tensor of shape [B, 1, H, W] (LFCC)
+        Returns: feature maps of shape [B, out_channels, H_out, W_out]
+        """
+        return run_features(self.features, x, self.checkpoint_segments)
+
+
+class DepthwiseSeparableConv(nn.Sequential):
+    def __init__(self, in_channels, out_channels, stride=1):
+        super().__init__(
+            nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=stride, padding=1, groups=in_channels, bias=False),
+            nn.BatchNorm2d(in_channels),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(in_channels, out_channels, kernel_size=1, bias=False),
+            nn.BatchNorm2d(out_channels),
+            nn.ReLU(inplace=True))
+
+
+class DepthwiseCNNFeatureExtractor(nn.Module):
+    # (output channels, stride) of every depthwise separable block
+    CFG = [(64, 2), (128, 2), (128, 1), (256, 2), (256, 1), (256, 2)]
+
+    def __init__(self, freeze=False, freeze_layers=None):
+        """
+        Small depthwise separable CNN trained from scratch (no pretrained weights, so it is normally
+        used with freeze=False). The freezing arguments follow the other extractors.
+        """
+        super(DepthwiseCNNFeatureExtractor, self).__init__()
+        layers = [nn.Sequential(nn.Conv2d(1, 32, kernel_size=3, stride=2, padding=1, bias=False),
+                                nn.BatchNorm2d(32), nn.ReLU(inplace=True))]
+        in_channels = 32
+        for out_channels, stride in self.CFG:
+            layers.append(DepthwiseSeparableConv(in_channels, out_channels, stride))
+            in_channels = out_channels
+        self.features = nn.Sequential(*layers)
+        self.out_channels = in_channels
+        self.checkpoint_segments = 0  # see AVDNet.enable_activation_checkpointing
+        _freeze_modules(self.features, freeze, freeze_layers)
+
+    def forward(self, x):
+        return run_features(self.features, x, self.checkpoint_segments)
 
 
 # =============================================================================
 # 3. Wav2Vec2 Feature Extractor with Partial Freezing
 # =============================================================================
+class LoRALinear(nn.Module):
+    def __init__(self, base, rank, alpha=16, dropout=0.0):
+        """
+        Wraps a frozen nn.Linear with a trainable low-rank update: y = base(x) + (alpha / rank) * B(A(x)).
+        B starts at zero so the wrapped layer initially behaves exactly like `base`.
+
+        Args:
+            base (nn.Linear): The pretrained layer (its parameters are frozen).
+            rank (int): Rank of the update.
+            alpha (float): Scaling of the update.
+            dropout (float): Dropout applied to the adapter input.
+        """
+        super().__init__()
+        self.base = base
+        for param in self.base.parameters():
+            param.requires_grad = False
+        self.lora_A = nn.Parameter(torch.empty(rank, base.in_features))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, rank))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.scaling = alpha / rank
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x):
+        return self.base(x) + (self.dropout(x) @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+
+    def merged(self):
+        """Returns a plain nn.Linear with the update folded into its weight."""
+        with torch.no_grad():
+            self.base.weight += (self.lora_B @ self.lora_A) * self.scaling
+        return self.base
+
+
+# Projections of each wav2vec2 encoder layer receiving an adapter
+LORA_TARGETS = ("attention.q_proj", "attention.k_proj", "attention.v_proj", "attention.out_proj",
+                "feed_forward.intermediate_dense", "feed_forward.output_dense")
+
+
 class Wav2VecFeatureExtractor(nn.Module):
-    def __init__(self, freeze=True, freeze_feature_extractor=True, freeze_encoder_layers=0):
+    def __init__(self, freeze=True, freeze_feature_extractor=True, freeze_encoder_layers=0, num_encoder_layers=None,
+                 lora_rank=0, lora_alpha=16, lora_dropout=0.0):
         """
         Loads a pretrained Wav2Vec2 model from transformers.
 
@@ -107,10 +391,28 @@ class Wav2VecFeatureExtractor(nn.Module):
             freeze (bool): Whether to freeze parts of the model.
             freeze_feature_extractor (bool): If True, freeze the convolutional feature extractor.
             freeze_encoder_layers (int): Number of initial transformer encoder layers to freeze.
+            num_encoder_layers (int or None): Keep only the first `num_encoder_layers` transformer encoder
+              layers, the output is then the hidden state of that intermediate layer. The other layers are
+              not built at all (and so are absent from the checkpoints). None keeps every layer.
+            lora_rank (int): If > 0, the whole Wav2Vec2 model is frozen and low-rank adapters of this rank
+              are injected into the attention and feed-forward projections of every encoder layer
+              (only the adapters are trained). 0 disables the adapters.
+            lora_alpha (float): Scaling of the adapters.
+            lora_dropout (float): Dropout applied to the adapter inputs.
         """
         super(Wav2VecFeatureExtractor, self).__init__()
         # self.model = Wav2Vec2Model.from_pretrained("facebook/wav2vec2-xls-r-300m")
-        self.model = Wav2Vec2Model.from_pretrained("facebook/wav2vec2-large-960h")
+        config, state = wav2vec_state(WAV2VEC_PRETRAINED)
+        if num_encoder_layers is not None and num_encoder_layers < config.num_hidden_layers:
+            dropped = tuple(f"encoder.layers.{i}." for i in range(num_encoder_layers, config.num_hidden_layers))
+            config = copy.deepcopy(config)
+            config.num_hidden_layers = num_encoder_layers
+            state = {key: value for key, value in state.items() if not key.startswith(dropped)}
+
+        with no_init_weights():  # the weights are overwritten by the cached pretrained ones right away
+            self.model = Wav2Vec2Model(config)
+        self.model.load_state_dict(state)
+        self.model.eval()  # as returned by from_pretrained
 
         if freeze:
             if freeze_feature_extractor:
@@ -121,6 +423,25 @@ class Wav2VecFeatureExtractor(nn.Module):
                     for param in self.model.encoder.layers[i].parameters():
                         param.requires_grad = False
 
+        if lora_rank > 0:
+            for param in self.model.parameters():
+                param.requires_grad = False
+            for layer in self.model.encoder.layers:
+                for target in LORA_TARGETS:
+                    parent_name, name = target.split(".")
+                    parent = getattr(layer, parent_name)
+                    setattr(parent, name, LoRALinear(getattr(parent, name), lora_rank, lora_alpha, lora_dropout))
+
+    def merge_lora(self):
+        """Folds the adapters into the base weights (for inference), the module then has the plain layout."""
+        for layer in self.model.encoder.layers:
+            for target in LORA_TARGETS:
+                parent_name, name = target.split(".")
+                parent = getattr(layer, parent_name)
+                module = getattr(parent, name)
+                if isinstance(module, LoRALinear):
+                    setattr(parent, name, module.merged())
+
     def forward(self, x):
         """
         x: Tensor of shape [B, T] (raw audio waveform)
@@ -153,20 +474,10 @@ class PositionalEncoding2D(nn.Module):
         H, W: Spatial dimensions
         Returns: [B, H*W, d_model] with 2D positional info added
         """
-        # We'll create row and col indices for each of the H*W patches
-        # row: 0..H-1, col: 0..W-1
-        device = x.device
-        row_indices = torch.arange(H, device=device).unsqueeze(1).repeat(1, W).view(-1)  # [H*W]
-        col_indices = torch.arange(W, device=device).unsqueeze(0).repeat(H, 1).view(-1)  # [H*W]
-
-        # Get embeddings and sum them
-        row_emb = self.row_embed(row_indices)  # [H*W, d_model]
-        col_emb = self.col_embed(col_indices)  # [H*W, d_model]
-        pe_2d = row_emb + col_emb  # [H*W, d_model]
-
-        # Broadcast over the batch dimension
-        pe_2d = pe_2d.unsqueeze(0).expand(x.size(0), -1, -1)  # [B, H*W, d_model]
-        return x + pe_2d
+        # Slice the embedding tables directly (row-major order: token i*W + j gets row i and col j),
+        # no index tensors are built on each forward
+        pe_2d = self.row_embed.weight[:H].unsqueeze(1) + self.col_embed.weight[:W].unsqueeze(0)  # [H, W, d_model]
+        return x + pe_2d.reshape(H * W, -1)  # broadcast over the batch dimension
 
 
 class PositionalEncoding1D(nn.Module):
@@ -184,13 +495,64 @@ class PositionalEncoding1D(nn.Module):
         T: sequence length
         Returns: [B, T, d_model] with 1D positional info added
         """
-        device = x.device
-        positions = torch.arange(T, device=device)  # [T]
-        pe_1d = self.pe(positions).unsqueeze(0).expand(x.size(0), -1, -1)  # [B, T, d_model]
-        return x + pe_1d
+        return x + self.pe.weight[:T]  # broadcast over the batch dimension
+
+
+class LearnedTokenPooling(nn.Module):
+    """
+    Learned pooling of a token sequence by `factor` along time: a depthwise strided convolution
+    initialized as a plain average.
+    """
+    def __init__(self, d_model, factor):
+        super().__init__()
+        self.factor = factor
+        self.pool = nn.Conv1d(d_model, d_model, kernel_size=factor, stride=factor, groups=d_model)
+        nn.init.constant_(self.pool.weight, 1.0 / factor)
+        nn.init.zeros_(self.pool.bias)
+
+    def forward(self, tokens):
+        """
+        tokens: [B, T, d_model]
+        Returns: [B, ceil(T / factor), d_model]
+        """
+        x = tokens.transpose(1, 2)  # [B, d_model, T]
+        pad = (-x.size(-1)) % self.factor
+        if pad:
+            x = F.pad(x, (0, pad), mode="replicate")
+        return self.pool(x).transpose(1, 2)
+
+
+class CrossAttentionPooling(nn.Module):
+    """
+    A small set of learned query tokens attending to the whole token sequence with scaled dot product
+    attention, reducing [B, N, d_model] to [B, num_queries, d_model].
+    """
+    def __init__(self, d_model, nhead, num_queries, dropout=0.1):
+        super().__init__()
+        self.nhead = nhead
+        self.dropout = dropout
+        self.queries = nn.Parameter(torch.empty(1, num_queries, d_model))
+        nn.init.trunc_normal_(self.queries, std=0.02)
+        self.q_proj = nn.Linear(d_model, d_model)
+        self.kv_proj = nn.Linear(d_model, 2 * d_model)
+        self.out_proj = nn.Linear(d_model, d_model)
+        self.norm = nn.LayerNorm(d_model)
+
+    def forward(self, tokens):
+        B, N, D = tokens.shape
+        q = self.q_proj(self.queries).expand(B, -1, -1)
+        k, v = self.kv_proj(tokens).chunk(2, dim=-1)
+        # [B, seq, D] -> [B, nhead, seq, D / nhead]
+        q, k, v = (t.reshape(B, -1, self.nhead, D // self.nhead).transpose(1, 2) for t in (q, k, v))
+
+        attended = F.scaled_dot_product_attention(q, k, v, dropout_p=self.dropout if self.training else 0.0)
+        attended = attended.transpose(1, 2).reshape(B, -1, D)
+        return self.norm(self.queries + self.out_proj(attended))
+
 
 class FusionTransformer(nn.Module):
-    def __init__(self, cnn_in_channels, wav2vec_in_dim, d_model=256, nhead=8, num_layers=2, dropout=0.1):
+    def __init__(self, cnn_in_channels, wav2vec_in_dim, d_model=256, nhead=8, num_layers=2, dropout=0.1,
+                 token_reduction="none", reduction_factor=4, num_queries=8, cnn_grid=(4, 15)):
         """
         Projects features from the CNN branch and the Wav2Vec branch to a common dimension,
         concatenates them, and fuses via a Transformer encoder.
@@ -202,6 +564,13 @@ class FusionTransformer(nn.Module):
             nhead: Number of attention heads.
             num_layers: Number of Transformer encoder layers.
             dropout: Dropout rate.
+            token_reduction (str): How to shorten the fused sequence before the Transformer encoder:
+              "none", "stride" (average the Wav2Vec tokens by `reduction_factor`), "learned" (learned
+              pooling of the Wav2Vec tokens by `reduction_factor`) or "query" (`num_queries` learned
+              query tokens cross-attending to all the tokens, the encoder then only runs on them).
+            reduction_factor (int): Time pooling factor of the "stride" and "learned" reductions.
+            num_queries (int): Number of query tokens of the "query" reduction.
+            cnn_grid (tuple): Maximum (H, W) of the CNN feature maps, size of the 2D positional encoding.
         """
         super(FusionTransformer, self).__init__()
         self.cnn_proj = nn.Linear(cnn_in_channels, d_model)
@@ -210,30 +579,30 @@ class FusionTransformer(nn.Module):
         self.dropout = nn.Dropout(p=dropout)
 
         # Positional Encodings
-        self.pos_encoding_2d = PositionalEncoding2D(4, 15, d_model)
+        self.pos_encoding_2d = PositionalEncoding2D(cnn_grid[0], cnn_grid[1], d_model)
         self.pos_encoding_1d = PositionalEncoding1D(200, d_model)
 
         # Token type embedding (to distinguish CNN vs. Wav2Vec tokens)
         self.token_type_embeddings = nn.Embedding(2, d_model)
         nn.init.trunc_normal_(self.token_type_embeddings.weight, std=0.02)
 
+        # Token reduction
+        self.token_reduction = token_reduction
+        self.reduction_factor = reduction_factor
+        if token_reduction == "learned":
+            self.token_pooling = LearnedTokenPooling(d_model, reduction_factor)
+        elif token_reduction == "query":
+            self.query_pooling = CrossAttentionPooling(d_model, nhead, num_queries, dropout=dropout)
+        elif token_reduction not in ("none", "stride"):
+            raise ValueError("Unsupported token reduction. Choose 'none', 'stride', 'learned' or 'query'.")
+
         encoder_layer = nn.TransformerEncoderLayer(d_model=d_model, nhead=nhead, dropout=dropout, batch_first=True)
         self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=num_layers)
 
-    def forward(self, cnn_feat, wav2vec_feat):
+    def embed(self, cnn_feat, wav2vec_feat):
         """
-        Args:
-            cnn_feat: Tensor of shape [B, C, H, W] from the CNN extractor.
-            wav2vec_feat: Tensor of shape [B, T, wav2vec_in_dim] from the Wav2Vec extractor.
-
-        Process:
-            - Reshape CNN features: [B, C, H, W] -> [B, H*W, C] and project.
-            - Project Wav2Vec features.
-            - Concatenate along the sequence dimension.
-            - Fuse with Transformer encoder and pool to get a fixed-length representation.
-
-        Returns:
-            fused_feature: Tensor of shape [B, d_model]
+        Projects both branches and adds the positional and token type embeddings.
+        Returns: cnn_tokens [B, H*W, d_model], wav2vec_tokens [B, T, d_model]
         """
         B, C, H, W = cnn_feat.shape
         cnn_tokens = cnn_feat.view(B, C, -1).transpose(1, 2)  # [B, H*W, C]
@@ -246,28 +615,52 @@ class FusionTransformer(nn.Module):
         T = wav2vec_tokens.size(1)
         wav2vec_tokens = self.pos_encoding_1d(wav2vec_tokens, T)  # [B, T, d_model]
 
-        # model encoding 0 for VGG 1 for Wav2vec2
-        device = cnn_tokens.device
-        cnn_type_ids = torch.zeros(H * W, dtype=torch.long, device=device)
-        w2v_type_ids = torch.ones(T, dtype=torch.long, device=device)
-        # shape => [1, seq_len] => then expand batch dimension
-        cnn_type_emb = self.token_type_embeddings(cnn_type_ids).unsqueeze(0)
-        w2v_type_emb = self.token_type_embeddings(w2v_type_ids).unsqueeze(0)
+        # model encoding 0 for VGG 1 for Wav2vec2 (broadcast along batch and sequence)
+        cnn_tokens = cnn_tokens + self.token_type_embeddings.weight[0]
+        wav2vec_tokens = wav2vec_tokens + self.token_type_embeddings.weight[1]
+        return cnn_tokens, wav2vec_tokens
 
-        # broadcast along batch
-        cnn_type_emb = cnn_type_emb.expand(B, -1, -1)  # [B, H*W, d_model]
-        w2v_type_emb = w2v_type_emb.expand(B, -1, -1)  # [B, T, d_model]
-        cnn_tokens = cnn_tokens + cnn_type_emb
-        wav2vec_tokens = wav2vec_tokens + w2v_type_emb
+    def fuse(self, cnn_tokens, wav2vec_tokens):
+        """
+        Reduces the token sequence, fuses it with the Transformer encoder and mean pools it.
+        Returns: fused_feature [B, d_model]
+        """
+        if self.token_reduction == "stride":
+            wav2vec_tokens = F.avg_pool1d(wav2vec_tokens.transpose(1, 2), self.reduction_factor,
+                                          self.reduction_factor, ceil_mode=True).transpose(1, 2)
+        elif self.token_reduction == "learned":
+            wav2vec_tokens = self.token_pooling(wav2vec_tokens)
 
         # Concatenate tokens and apply dropout before fusion
-        tokens = torch.cat([cnn_tokens, wav2vec_tokens], dim=1)  # [B, H*W + T, d_model]
+        tokens = torch.cat([cnn_tokens, wav2vec_tokens], dim=1)  # [B, H*W + T', d_model]
         tokens = self.dropout(tokens)
 
+        if self.token_reduction == "query":
+            tokens = self.query_pooling(tokens)  # [B, num_queries, d_model]
+
         fused_tokens = self.transformer_encoder(tokens)
         fused_feature = fused_tokens.mean(dim=1)
         return fused_feature
 
+    def forward(self, cnn_feat, wav2vec_feat):
+        """
+        Args:
+            cnn_feat: Tensor of shape [B, C, H, W] from the CNN extractor.
+            wav2vec_feat: Tensor of shape [B, T, wav2vec_in_dim] from the Wav2Vec extractor.
+
+        Process:
+            - Reshape CNN features: [B, C, H, W] -> [B, H*W, C] and project.
+            - Project Wav2Vec features.
+            - Optionally reduce the number of tokens.
+            - Concatenate along the sequence dimension.
+            - Fuse with Transformer encoder and pool to get a fixed-length representation.
+
+        Returns:
+            fused_feature: Tensor of shape [B, d_model]
+        """
+        cnn_tokens, wav2vec_tokens = self.embed(cnn_feat, wav2vec_feat)
+        return self.fuse(cnn_tokens, wav2vec_tokens)
+
 
 # =============================================================================
 # 5. Dense Classifier Module
@@ -300,6 +693,11 @@ class DenseClassifier(nn.Module):
         return self.classifier(x)
 
 
+def _set_num_threads(num_threads):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+
 # =============================================================================
 # 6. Full DeepFake Detector Model with Backbone Choice
 # =============================================================================
@@ -308,13 +706,16 @@ class AVDNet(nn.Module):
                  backbone="vgg",  # "vgg" or "resnet"
                  freeze_cnn=True, freeze_cnn_layers=None,
                  freeze_wav2vec=True, freeze_feature_extractor=True, freeze_encoder_layers=0,
-                 d_model=256, nhead=8, num_layers=2, dense_hidden_dims=None):
+                 d_model=256, nhead=8, num_layers=2, dense_hidden_dims=None, wav2vec_layers=None,
+                 fusion_token_reduction="none", fusion_reduction_factor=4, fusion_queries=8,
+                 lora_rank=0, lora_alpha=16, cnn_grid=None):
         """
         Combines a CNN-based feature extractor (VGG16 or ResNet), a Wav2Vec2 extractor,
         a Transformer fusion module, and a dense classifier for binary deepfake detection.
 
         Args:
-            backbone (str): Choose "vgg" or "resnet" for the CNN branch.
+            backbone (str): CNN branch: "vgg", "resnet" (ResNet-50), "resnet34", "mobilenet_v3_small",
+                "mobilenet_v3_large", "efficientnet_b0" or "depthwise" (small CNN trained from scratch).
             freeze_cnn (bool): Whether to freeze the CNN extractor.
             freeze_cnn_layers (int or None): Number of initial CNN modules to freeze.
                 For VGG16, this applies to vgg.features; for ResNet, to self.features.
@@ -323,6 +724,13 @@ class AVDNet(nn.Module):
             freeze_encoder_layers (int): Number of initial Wav2Vec encoder layers to freeze.
             d_model, nhead, num_layers: Parameters for the fusion Transformer.
             dense_hidden_dims: Hidden layer sizes for the dense classifier.
+            wav2vec_layers (int or None): Number of Wav2Vec encoder layers to keep (None keeps all 24).
+            fusion_token_reduction, fusion_reduction_factor, fusion_queries: Token reduction of the fusion
+                Transformer (see FusionTransformer).
+            lora_rank, lora_alpha: Low-rank adapters in the Wav2Vec encoder (see Wav2VecFeatureExtractor),
+                lora_rank=0 disables them. Checkpoints of models with adapters only store the trainable weights.
+            cnn_grid (tuple or None): (H, W) of the CNN feature maps, sizing the 2D positional encoding.
+                None measures it with a dummy LFCC input (the result is stored in the config).
         """
         super(AVDNet, self).__init__()
 
@@ -336,7 +744,13 @@ class AVDNet(nn.Module):
             "d_model": d_model,
             "nhead": nhead,
             "num_layers": num_layers,
-            "dense_hidden_dims": dense_hidden_dims
+            "dense_hidden_dims": dense_hidden_dims,
+            "wav2vec_layers": wav2vec_layers,
+            "fusion_token_reduction": fusion_token_reduction,
+            "fusion_reduction_factor": fusion_reduction_factor,
+            "fusion_queries": fusion_queries,
+            "lora_rank": lora_rank,
+            "lora_alpha": lora_alpha
         }
 
         # Select CNN backbone and set the expected output channels.
@@ -354,21 +768,134 @@ class AVDNet(nn.Module):
                                                         freeze_resnet_layers=freeze_cnn_layers)
             cnn_channels = 512 # for resnet34
 
+        elif backbone.lower() in EFFICIENT_BACKBONES:
+            self.cnn_extractor = EfficientFeatureExtractor(model_name=EFFICIENT_BACKBONES[backbone.lower()],
+                                                           freeze=freeze_cnn, freeze_layers=freeze_cnn_layers)
+            cnn_channels = self.cnn_extractor.out_channels
+
+        elif backbone.lower() == "depthwise":
+            self.cnn_extractor = DepthwiseCNNFeatureExtractor(freeze=freeze_cnn, freeze_layers=freeze_cnn_layers)
+            cnn_channels = self.cnn_extractor.out_channels
+
         else:
-            raise ValueError("Unsupported backbone. Choose 'vgg' or 'resnet'.")
+            raise ValueError("Unsupported backbone. Choose 'vgg', 'resnet', 'resnet34', 'mobilenet_v3_small', "
+                             "'mobilenet_v3_large', 'efficientnet_b0' or 'depthwise'.")
+
+        if cnn_grid is None:
+            cnn_grid = self._measure_cnn_grid()
+        self.config["cnn_grid"] = tuple(cnn_grid)
 
         self.wav2vec_extractor = Wav2VecFeatureExtractor(freeze=freeze_wav2vec,
                                                          freeze_feature_extractor=freeze_feature_extractor,
-                                                         freeze_encoder_layers=freeze_encoder_layers)
+                                                         freeze_encoder_layers=freeze_encoder_layers,
+                                                         num_encoder_layers=wav2vec_layers,
+                                                         lora_rank=lora_rank,
+                                                         lora_alpha=lora_alpha)
         self.fusion = FusionTransformer(cnn_in_channels=cnn_channels,
                                         wav2vec_in_dim=1024,  # for wav2vec2-large
                                         d_model=d_model,
                                         nhead=nhead,
-                                        num_layers=num_layers)
+                                        num_layers=num_layers,
+                                        token_reduction=fusion_token_reduction,
+                                        reduction_factor=fusion_reduction_factor,
+                                        num_queries=fusion_queries,
+                                        cnn_grid=cnn_grid)
 
         self.bn = nn.BatchNorm1d(d_model)
         self.classifier = DenseClassifier(input_dim=d_model, hidden_dims=dense_hidden_dims)
 
+        # Execution mode (not part of the config): see enable_branch_parallelism
+        self.branch_executor = None
+        self.branch_threads = (None, None)
+
+    def _measure_cnn_grid(self):
+        """(H, W) of the CNN feature maps for a 4 seconds LFCC input."""
+        was_training = self.cnn_extractor.training
+        self.cnn_extractor.eval()  # do not update the BatchNorm statistics
+        with torch.no_grad():
+            _, _, H, W = self.cnn_extractor(torch.zeros(1, 1, *LFCC_SHAPE)).shape
+        self.cnn_extractor.train(was_training)
+        return H, W
+
+    def enable_activation_checkpointing(self, wav2vec=True, fusion=True, cnn_segments=2):
+        """
+        Recomputes activations in the backward pass instead of keeping them (training only):
+        every Wav2Vec encoder layer and fusion Transformer layer the gradient flows through, and the
+        trainable tail of the CNN trunk split in `cnn_segments` segments (0 disables it).
+        """
+        for layer in self.wav2vec_extractor.model.encoder.layers:
+            set_activation_checkpointing(layer, wav2vec)
+        for layer in self.fusion.transformer_encoder.layers:
+            set_activation_checkpointing(layer, fusion)
+        self.cnn_extractor.checkpoint_segments = cnn_segments
+
+    def disable_activation_checkpointing(self):
+        self.enable_activation_checkpointing(wav2vec=False, fusion=False, cnn_segments=0)
+
+    def merge_lora(self):
+        """Folds the Wav2Vec adapters into the base weights, the model is then saved and loaded as a plain AVDNet."""
+        self.wav2vec_extractor.merge_lora()
+        self.config["lora_rank"] = 0
+        return self
+
+    def enable_branch_parallelism(self, cnn_threads=None, wav2vec_threads=None):
+        """
+        Runs the CNN and Wav2Vec branches concurrently: the Wav2Vec branch on a dedicated thread
+        and the CNN branch on the calling thread, joining at the fusion transformer.
+
+        Args:
+            cnn_threads (int or None): Intra-op threads used by the CNN branch (None keeps the current setting).
+            wav2vec_threads (int or None): Intra-op threads used by the Wav2Vec branch (None keeps the default).
+        """
+        self.disable_branch_parallelism()
+        self.branch_threads = (cnn_threads, wav2vec_threads)
+        self.branch_executor = ThreadPoolExecutor(max_workers=1, initializer=_set_num_threads, initargs=(wav2vec_threads,))
+
+    def disable_branch_parallelism(self):
+        if self.branch_executor is not None:
+            self.branch_executor.shutdown()
+        self.branch_executor = None
+        self.branch_threads = (None, None)
+
+    def __getstate__(self):
+        # The executor can not be pickled/deep-copied, copies run sequentially
+        state = self.__dict__.copy()
+        state["branch_executor"] = None
+        state["branch_threads"] = (None, None)
+        return state
+
+    def _run_wav2vec(self, audio, grad_enabled):
+        with torch.set_grad_enabled(grad_enabled):  # grad mode is thread local
+            return self.wav2vec_extractor(audio)
+
+    def _run_cnn(self, image):
+        cnn_threads = self.branch_threads[0]
+        if cnn_threads is None:
+            return self.cnn_extractor(image)
+        previous_threads = torch.get_num_threads()
+        torch.set_num_threads(cnn_threads)
+        try:
+            return self.cnn_extractor(image)
+        finally:
+            torch.set_num_threads(previous_threads)
+
+    def forward_features(self, image, audio):
+        """
+        Runs everything up to the classifier.
+        Returns:
+            Tensor of shape [B, d_model] (normalized fused feature, input of self.classifier).
+        """
+        audio = audio.squeeze(1)  # Removes the channel dimension
+        if self.branch_executor is not None:
+            wav2vec_future = self.branch_executor.submit(self._run_wav2vec, audio, torch.is_grad_enabled())
+            cnn_feat = self._run_cnn(image)  # shape depends on backbone
+            wav2vec_feat = wav2vec_future.result()  # [B, T, 1024]
+        else:
+            cnn_feat = self.cnn_extractor(image)  # shape depends on backbone
+            wav2vec_feat = self.wav2vec_extractor(audio)  # [B, T, 1024]
+        fused_feature = self.fusion(cnn_feat, wav2vec_feat)  # [B, d_model]
+        return self.bn(fused_feature)
+
     def forward(self, image, audio):
         """
         Args:
@@ -377,11 +904,7 @@ class AVDNet(nn.Module):
         Returns:
             Tensor of shape [B, 1] (logit for binary classification).
         """
-        cnn_feat = self.cnn_extractor(image)  # shape depends on backbone
-        audio = audio.squeeze(1)  # Removes the channel dimension
-        wav2vec_feat = self.wav2vec_extractor(audio)  # [B, T]
-        fused_feature = self.fusion(cnn_feat, wav2vec_feat)  # [B, d_model]
-        fused_feature = self.bn(fused_feature)
+        fused_feature = self.forward_features(image, audio)  # [B, d_model]
         output = self.classifier(fused_feature)  # [B, 1]
         return output
 
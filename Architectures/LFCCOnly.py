@@ -0,0 +1,43 @@
+import torch.nn as nn
+
+from Architectures.AVDNetV2 import VGG16FeatureExtractor, DenseClassifier
+
+
+class LFCCOnly(nn.Module):
+    def __init__(self, freeze_cnn=True, freeze_cnn_layers=None, dense_hidden_dims=None, dropout=0.1):
+        """
+        Cheap LFCC-only detector: the VGG16 branch of AVDNet, global average pooled, followed by a dense classifier.
+        Takes the same (image, audio) inputs as AVDNet and ignores the audio, so it can be trained with
+        train_model and used as the first stage of a cascade.
+
+        Args:
+            freeze_cnn (bool): Whether to freeze the VGG16 extractor.
+            freeze_cnn_layers (int or None): Number of initial VGG16 modules to freeze.
+            dense_hidden_dims: Hidden layer sizes for the dense classifier.
+            dropout: Dropout rate of the dense classifier.
+        """
+        super(LFCCOnly, self).__init__()
+
+        self.config = {
+            "freeze_cnn": freeze_cnn,
+            "freeze_cnn_layers": freeze_cnn_layers,
+            "dense_hidden_dims": dense_hidden_dims,
+            "dropout": dropout
+        }
+
+        self.cnn_extractor = VGG16FeatureExtractor(freeze=freeze_cnn, freeze_vgg_layers=freeze_cnn_layers)
+        self.pool = nn.AdaptiveAvgPool2d((1, 1))
+        self.bn = nn.BatchNorm1d(512)
+        self.classifier = DenseClassifier(input_dim=512, hidden_dims=dense_hidden_dims, dropout=dropout)
+
+    def forward(self, image, audio=None):
+        """
+        Args:
+            image: Tensor of shape [B, 1, H, W] (LFCC features).
+            audio: Ignored, kept for interface compatibility with AVDNet.
+        Returns:
+            Tensor of shape [B, 1] (logit for binary classification).
+        """
+        cnn_feat = self.cnn_extractor(image)  # [B, 512, H_out, W_out]
+        pooled = self.pool(cnn_feat).flatten(1)  # [B, 512]
+        return self.classifier(self.bn(pooled))
@@ -0,0 +1,119 @@
+import torch.nn as nn
+
+from Architectures.AVDNetV2 import DenseClassifier, wav2vec_state
+from transformers import Wav2Vec2Model
+from transformers.modeling_utils import no_init_weights
+
+
+# =============================================================================
+# 1. Small CNN over the LFCC features
+# =============================================================================
+class SmallLFCCCNN(nn.Module):
+    def __init__(self, channels=(16, 32, 64, 128)):
+        """
+        A few Conv-BN-ReLU-MaxPool blocks followed by global average pooling.
+
+        Args:
+            channels: Output channels of each block (the input has 1 channel).
+        """
+        super(SmallLFCCCNN, self).__init__()
+        layers = []
+        in_channels = 1
+        for out_channels in channels:
+            layers.append(nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1, bias=False))
+            layers.append(nn.BatchNorm2d(out_channels))
+            layers.append(nn.ReLU())
+            layers.append(nn.MaxPool2d(2))
+            in_channels = out_channels
+        self.features = nn.Sequential(*layers)
+        self.pool = nn.AdaptiveAvgPool2d((1, 1))
+        self.out_dim = in_channels
+
+    def forward(self, x):
+        """
+        x: Tensor of shape [B, 1, H, W] (LFCC features)
+        Returns: [B, channels[-1]]
+        """
+        return self.pool(self.features(x)).flatten(1)
+
+
+# =============================================================================
+# 2. wav2vec2-base encoder with mean pooling
+# =============================================================================
+class Wav2VecBaseEncoder(nn.Module):
+    def __init__(self, model_name="facebook/wav2vec2-base", freeze_feature_extractor=True):
+        """
+        Pretrained wav2vec2-base (95M parameters, 768 hidden) mean pooled over time.
+
+        Args:
+            model_name (str): Pretrained wav2vec2 checkpoint to start from.
+            freeze_feature_extractor (bool): If True, freeze the convolutional feature extractor.
+        """
+        super(Wav2VecBaseEncoder, self).__init__()
+        config, state = wav2vec_state(model_name)
+        with no_init_weights():
+            self.model = Wav2Vec2Model(config)
+        self.model.load_state_dict(state)
+        self.out_dim = config.hidden_size
+
+        if freeze_feature_extractor:
+            for param in self.model.feature_extractor.parameters():
+                param.requires_grad = False
+
+    def forward(self, x):
+        """
+        x: Tensor of shape [B, T] (raw audio waveform)
+        Returns: [B, hidden_size]
+        """
+        return self.model(x).last_hidden_state.mean(dim=1)
+
+
+# =============================================================================
+# 3. Student model
+# =============================================================================
+class StudentNet(nn.Module):
+    def __init__(self, student="cnn", cnn_channels=(16, 32, 64, 128), freeze_feature_extractor=True,
+                 dense_hidden_dims=None, dropout=0.1):
+        """
+        Compact model distilled from AVDNet. Takes the same (image, audio) inputs and returns a logit.
+
+        Args:
+            student (str): "cnn" for a small CNN over the LFCC features, "wav2vec2-base" for a
+              wav2vec2-base encoder over the raw waveform.
+            cnn_channels: Channels of the small CNN blocks (student="cnn").
+            freeze_feature_extractor (bool): Freeze the wav2vec2 convolutional feature extractor (student="wav2vec2-base").
+            dense_hidden_dims: Hidden layer sizes for the dense classifier.
+            dropout: Dropout rate of the dense classifier.
+        """
+        super(StudentNet, self).__init__()
+
+        self.config = {
+            "student": student,
+            "cnn_channels": list(cnn_channels),
+            "freeze_feature_extractor": freeze_feature_extractor,
+            "dense_hidden_dims": dense_hidden_dims,
+            "dropout": dropout
+        }
+
+        if student == "cnn":
+            self.encoder = SmallLFCCCNN(channels=cnn_channels)
+        elif student == "wav2vec2-base":
+            self.encoder = Wav2VecBaseEncoder(freeze_feature_extractor=freeze_feature_extractor)
+        else:
+            raise ValueError("Unsupported student. Choose 'cnn' or 'wav2vec2-base'.")
+
+        self.classifier = DenseClassifier(input_dim=self.encoder.out_dim, hidden_dims=dense_hidden_dims, dropout=dropout)
+
+    def forward(self, image, audio):
+        """
+        Args:
+            image: Tensor of shape [B, 1, H, W] (LFCC features), used by the CNN student.
+            audio: Tensor of shape [B, 1, T] (raw waveform), used by the wav2vec2-base student.
+        Returns:
+            Tensor of shape [B, 1] (logit for binary classification).
+        """
+        if self.config["student"] == "cnn":
+            features = self.encoder(image)
+        else:
+            features = self.encoder(audio.squeeze(1))
+        return self.classifier(features)
@@ -0,0 +1,37 @@
+import importlib
+
+# Maps the `model_class` saved in a checkpoint to the module defining it.
+# Modules are only imported when a class is requested, so that loading a light model
+# does not pull transformers/torchvision in.
+MODEL_REGISTRY = {
+    "AVDNet": "Architectures.AVDNetV2",
+    "LFCCOnly": "Architectures.LFCCOnly",
+    "StudentNet": "Architectures.StudentNet",
+    "DeepFakeDetector": "Architectures.AVDNet",
+    "DeepFakeDetection": "Architectures.VGG16",
+    "FeaturesOnly": "Architectures.VGG16_FeaturesOnly",
+    "Wav2VecOnly": "Architectures.VGG16_Wav2VecOnly",
+}
+
+
+def register_model(class_name, module_name):
+    """Registers (or overrides) the module a model class is imported from."""
+    MODEL_REGISTRY[class_name] = module_name
+
+
+def get_model_class(class_name):
+    """
+    :param class_name: The class name as stored in the checkpoint `model_class` field.
+    :return: The class, importing its module on first use.
+    """
+    if class_name not in MODEL_REGISTRY:
+        raise ValueError(f"⚠️ Class `{class_name}` is not registered.\n"
+                         f"👉 Add it to MODEL_REGISTRY in Architectures/registry.py or call register_model().\n"
+                         f"👉 Alternatively, pass `model_class` explicitly to `load_model()`.")
+
+    module_name = MODEL_REGISTRY[class_name]
+    module = importlib.import_module(module_name)
+    try:
+        return getattr(module, class_name)
+    except AttributeError:
+        raise ValueError(f"⚠️ Class `{class_name}` not found in `{module_name}`.")
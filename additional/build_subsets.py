@@ -0,0 +1,110 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from constants import HOURS
+
+# Builds the train/validation/test subset CSVs of a given total duration from a manifest (e.g. the filtered
+# manifest of validate_dataset.py: path, label, source, duration), replacing make_dataset_csv_of_size_x.py.
+# - splits are assigned by hashing a group column (the path, or a speaker column), so a file (speaker) always
+#   lands in the same split whatever the subset size: no leak between splits and no drift between rebuilds
+# - within each split the duration of every class is shared equally between the sources (a source with too
+#   little audio gives its share to the others) and the rows are taken in a seeded hash order, not from the head
+#   of each source CSV
+
+SPLITS = (("train", 0.8), ("validation", 0.1), ("test", 0.1))
+CLASS_RATIOS = {1: 0.44, 0: 0.56}  # fake, real
+
+
+def unit_hash(values, salt=""):
+    """Deterministic hash of every value mapped to [0, 1) (vectorized, independent of the row order)."""
+    hashes = pd.util.hash_pandas_object(pd.Series(values).astype(str) + salt, index=False).to_numpy()
+    return (hashes >> np.uint64(11)) / np.float64(2 ** 53)  # 53 bits: exactly representable, strictly below 1
+
+
+def assign_splits(manifest, group_column="path", splits=SPLITS):
+    """Split name of every row, from the hash of its group column."""
+    bounds = np.cumsum([ratio for _, ratio in splits])
+    bins = np.searchsorted(bounds / bounds[-1], unit_hash(manifest[group_column], "split"), side="right")
+    return np.array([name for name, _ in splits])[bins]
+
+
+def water_fill(available, target):
+    """Shares `target` equally between strata, capped at what each one has; leftovers go to the others."""
+    allocation = pd.Series(0.0, index=available.index)
+    remaining = target
+    for i, (stratum, amount) in enumerate(available.sort_values().items()):
+        allocation[stratum] = min(amount, remaining / (len(available) - i))
+        remaining -= allocation[stratum]
+    return allocation
+
+
+def build_subsets(manifest, hours=HOURS, rows=None, stratify_column="source", group_column="path", seed=0,
+                  class_ratios=CLASS_RATIOS, splits=SPLITS, default_seconds=4.0):
+    """
+    Selects the rows of every split.
+
+    :param manifest: DataFrame with path, label, the stratify column and (optionally) duration in seconds.
+    :param hours: Total duration of the three splits (ignored when rows is given).
+    :param rows: Total number of rows instead of a duration.
+    :param stratify_column: Source/technique column the classes are stratified by.
+    :param group_column: Rows sharing it always go to the same split (e.g. a speaker column).
+    :param seed: Seed of the sampling order (the split assignment does not depend on it).
+    :param default_seconds: Duration of the rows without a duration column.
+    :return: Dictionary split name -> selected rows.
+    """
+    manifest = manifest.reset_index(drop=True)
+    if stratify_column not in manifest.columns:
+        manifest = manifest.assign(**{stratify_column: ""})
+    weight = np.ones(len(manifest)) if rows is not None else \
+        manifest["duration"].to_numpy(dtype=float) if "duration" in manifest.columns else \
+        np.full(len(manifest), default_seconds)
+    total = rows if rows is not None else hours * 3600.0
+
+    manifest = manifest.assign(_split=assign_splits(manifest, group_column, splits), _weight=weight,
+                               _order=unit_hash(manifest["path"], f"order{seed}"))
+    manifest = manifest.sort_values("_order", kind="stable")
+
+    # quota of every (split, label, stratum)
+    available = manifest.groupby(["_split", "label", stratify_column])["_weight"].sum()
+    split_ratios = dict(splits)
+    quotas = pd.concat([water_fill(strata, total * split_ratios[split] * class_ratios[label])
+                        for (split, label), strata in available.groupby(level=[0, 1]) if label in class_ratios])
+
+    # rows are taken in hash order until their stratum quota is reached
+    cumulative = manifest.groupby(["_split", "label", stratify_column])["_weight"].cumsum()
+    quota = quotas.reindex(pd.MultiIndex.from_frame(manifest[["_split", "label", stratify_column]])).to_numpy()
+    selected = manifest[cumulative.to_numpy() <= np.nan_to_num(quota)]
+
+    subsets = {}
+    for split, _ in splits:
+        subset = selected[selected["_split"] == split]
+        subsets[split] = subset.drop(columns=["_split", "_weight", "_order"])
+        unit = "rows" if rows is not None else "h"
+        amount = subset["_weight"].sum() / (1 if rows is not None else 3600)
+        print(f"{split}: {len(subset)} rows, {amount:.1f} {unit}, "
+              f"{subset['label'].value_counts(normalize=True).round(2).to_dict()} per label")
+    return subsets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build duration-aware stratified train/validation/test CSVs.")
+    parser.add_argument("manifest", help="CSV with path, label, source and duration columns (see validate_dataset.py)")
+    parser.add_argument("--output-dir", default="../data/Inputs")
+    parser.add_argument("--hours", type=float, default=HOURS)
+    parser.add_argument("--rows", type=int, default=None, help="total number of rows instead of --hours")
+    parser.add_argument("--stratify", default="source", help="source/technique column")
+    parser.add_argument("--group", default="path", help="column kept in a single split, e.g. speaker")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    subsets = build_subsets(pd.read_csv(args.manifest, keep_default_na=False), hours=args.hours, rows=args.rows,
+                            stratify_column=args.stratify, group_column=args.group, seed=args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+    size = f"{args.rows}rows" if args.rows is not None else f"{args.hours:g}h"
+    for split, subset in subsets.items():
+        path = os.path.join(args.output_dir, f"{split}_{size}.csv")
+        subset.to_csv(path, index=False)
+        print(f"Saved {path}")
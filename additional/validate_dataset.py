@@ -0,0 +1,205 @@
+import argparse
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from audio_methods import AUDIO_EXTENSIONS
+
+# Integrity check of a dataset (audio files and/or wav2vec matrices) on a process pool.
+# Only the file headers are read (NPY header, RIFF chunks) except for formats without a parsable
+# header (pickled matrices, compressed audio), which are fully decoded.
+# Run it with the repository root on the path (e.g. PYTHONPATH=. python additional/validate_dataset.py ...).
+
+
+def read_npy_header(path):
+    """Returns (shape, dtype) from the header of a .npy file, without reading the array."""
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version not in ((1, 0), (2, 0), (3, 0)):
+            raise ValueError(f"unsupported NPY format version {version}")
+        # 3.0 only differs from 2.0 by an UTF-8 header (used for non-ASCII field names)
+        shape, _, dtype = np.lib.format._read_array_header(f, version)
+    return shape, dtype
+
+
+def read_wav_header(path):
+    """
+    Parses the RIFF chunks of a WAV file up to its data chunk.
+    Returns a dict with sample_rate, channels, bits_per_sample, frames and truncated (data chunk longer than the file).
+    """
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff not in (b"RIFF", b"RF64") or wave != b"WAVE":
+            raise ValueError("not a RIFF/WAVE file")
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("no data chunk")
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                _, channels, sample_rate, _, block_align, bits_per_sample = struct.unpack("<HHIIHH", f.read(16))
+                fmt = {"sample_rate": sample_rate, "channels": channels, "bits_per_sample": bits_per_sample,
+                       "block_align": block_align}
+                f.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise ValueError("data chunk before fmt chunk")
+                available = file_size - f.tell()
+                return {"sample_rate": fmt["sample_rate"], "channels": fmt["channels"],
+                        "bits_per_sample": fmt["bits_per_sample"],
+                        "frames": min(chunk_size, available) // max(fmt["block_align"], 1),
+                        "truncated": chunk_size > available and chunk_size != 0xFFFFFFFF}
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)  # chunks are word aligned
+
+
+def audio_info(path):
+    """Header information of an audio file (RIFF parsing for WAV, decoding by torchaudio for the other codecs)."""
+    if path.lower().endswith(".wav"):
+        return read_wav_header(path)
+    import torchaudio
+    waveform, sample_rate = torchaudio.load(path)
+    return {"sample_rate": sample_rate, "channels": waveform.shape[0], "bits_per_sample": None,
+            "frames": waveform.shape[1], "truncated": False}
+
+
+def validate_matrix(path, expected_shape):
+    shape, dtype = read_npy_header(path)
+    if dtype == object:  # pickled content, the header does not describe it
+        shape = np.shape(np.load(path, allow_pickle=True))
+    if expected_shape is not None and tuple(shape) != tuple(expected_shape):
+        return {"issue": f"shape {tuple(shape)} instead of {tuple(expected_shape)}", "shape": str(tuple(shape))}
+    return {"issue": "", "shape": str(tuple(shape))}
+
+
+def validate_audio(path, sample_rate, channels, min_seconds):
+    info = audio_info(path)
+    duration = info["frames"] / info["sample_rate"] if info["sample_rate"] else 0.0
+    issues = []
+    if info["frames"] == 0:
+        issues.append("empty")
+    elif duration < min_seconds:
+        issues.append(f"{duration:.2f}s shorter than {min_seconds}s")
+    if info["truncated"]:
+        issues.append("truncated data chunk")
+    if sample_rate is not None and info["sample_rate"] != sample_rate:
+        issues.append(f"sample rate {info['sample_rate']}")
+    if channels is not None and info["channels"] != channels:
+        issues.append(f"{info['channels']} channels")
+    return {"issue": ", ".join(issues), "duration": duration, "sample_rate": info["sample_rate"],
+            "channels": info["channels"]}
+
+
+def validate_file(job):
+    """Worker: validates one (path, kind, options) job, never raises."""
+    path, kind, options = job
+    if not os.path.exists(path):
+        return {"issue": "missing"}
+    if os.path.getsize(path) == 0:
+        return {"issue": "zero-length file"}
+    try:
+        if kind == "matrix":
+            return validate_matrix(path, options["expected_shape"])
+        return validate_audio(path, options["sample_rate"], options["channels"], options["min_seconds"])
+    except Exception as error:  # corrupt headers, undecodable audio, unreadable files
+        return {"issue": f"unreadable: {error}"}
+
+
+def build_manifest(root_dir):
+    """
+    Manifest of every audio file under root_dir: path, label (0 under a Real folder, 1 under Fake)
+    and source (the folder below Real/Fake).
+    """
+    rows = []
+    for directory, _, files in os.walk(root_dir):
+        parts = os.path.relpath(directory, root_dir).split(os.sep)
+        class_index = next((i for i, part in enumerate(parts) if part.lower() in ("real", "fake")), None)
+        label = -1 if class_index is None else int(parts[class_index].lower() == "fake")
+        source = parts[class_index + 1] if class_index is not None and class_index + 1 < len(parts) else ""
+        rows += [{"path": os.path.join(directory, file), "label": label, "source": source}
+                 for file in sorted(files) if file.lower().endswith(AUDIO_EXTENSIONS)]
+    return pd.DataFrame(rows)
+
+
+def validate_dataset(manifest, output_manifest, report_path, audio_column="path", matrix_column=None,
+                     audio_root="", matrix_root="", sample_rate=16000, channels=1, min_seconds=0.1,
+                     expected_shape=None, num_workers=None):
+    """
+    Validates the audio files and/or wav2vec matrices of a manifest on a process pool and writes
+    the rows without any issue (with the duration of their audio) to `output_manifest` and every issue to
+    `report_path`.
+
+    :param manifest: DataFrame (or CSV path) with a column of audio paths and/or of matrix paths.
+    :param audio_column: Column of the audio paths (relative to audio_root), None to skip the audio.
+    :param matrix_column: Column of the wav2vec matrix paths (relative to matrix_root), None to skip them.
+    :param sample_rate: Expected sample rate, None to accept any.
+    :param channels: Expected number of channels, None to accept any.
+    :param min_seconds: Shorter audio files are rejected.
+    :param expected_shape: Expected matrix shape, e.g. (1, 199, 29), None to only check readability.
+    :return: The filtered manifest.
+    """
+    if isinstance(manifest, str):
+        manifest = pd.read_csv(manifest)
+    manifest = manifest.reset_index(drop=True)
+    options = {"sample_rate": sample_rate, "channels": channels, "min_seconds": min_seconds,
+               "expected_shape": expected_shape}
+
+    columns = [(column, root, kind) for column, root, kind in ((audio_column, audio_root, "audio"),
+                                                                (matrix_column, matrix_root, "matrix"))
+               if column is not None and column in manifest.columns]
+    issues = pd.Series("", index=manifest.index)
+    report = []
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for column, root, kind in columns:
+            paths = [os.path.join(root, path) for path in manifest[column].astype(str)]
+            jobs = [(path, kind, options) for path in paths]
+            results = list(pool.map(validate_file, jobs, chunksize=256))
+            if kind == "audio":
+                manifest = manifest.assign(duration=[result.get("duration", 0.0) for result in results])
+            for index, path, result in zip(manifest.index, paths, results):
+                if result["issue"]:
+                    issues[index] += f"{column}: {result['issue']}; "
+                    report.append({"path": path, "kind": kind, "issue": result["issue"]})
+
+    valid = manifest[issues == ""]
+    for path in (output_manifest, report_path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+    valid.to_csv(output_manifest, index=False)
+    report = pd.DataFrame(report, columns=["path", "kind", "issue"])
+    report.to_csv(report_path, index=False)
+
+    print(f"{len(valid)} / {len(manifest)} rows valid, manifest saved to {output_manifest}")
+    if len(report):
+        print(report["issue"].str.split(":").str[0].value_counts().to_string())
+    print(f"Report saved to {report_path}")
+    return valid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Validate the audio files and wav2vec matrices of a dataset.")
+    parser.add_argument("input", help="manifest CSV, or a dataset folder (Real/Fake tree) to build it from")
+    parser.add_argument("--output", default="../data/Inputs/manifest_valid.csv", help="filtered manifest")
+    parser.add_argument("--report", default="../data/Inputs/validation_report.csv")
+    parser.add_argument("--audio-column", default="path")
+    parser.add_argument("--audio-root", default="")
+    parser.add_argument("--matrix-column", default=None, help="e.g. Wav2VecPath")
+    parser.add_argument("--matrix-root", default="")
+    parser.add_argument("--expected-shape", type=int, nargs="+", default=None, help="e.g. 1 199 29")
+    parser.add_argument("--sample-rate", type=int, default=16000, help="0 to accept any sample rate")
+    parser.add_argument("--channels", type=int, default=1, help="0 to accept any number of channels")
+    parser.add_argument("--min-seconds", type=float, default=0.1)
+    parser.add_argument("--num-workers", type=int, default=None)
+    args = parser.parse_args()
+
+    manifest = build_manifest(args.input) if os.path.isdir(args.input) else pd.read_csv(args.input)
+    validate_dataset(manifest, args.output, args.report, audio_column=args.audio_column,
+                     matrix_column=args.matrix_column, audio_root=args.audio_root, matrix_root=args.matrix_root,
+                     sample_rate=args.sample_rate or None, channels=args.channels or None,
+                     min_seconds=args.min_seconds, expected_shape=args.expected_shape,
+                     num_workers=args.num_workers)
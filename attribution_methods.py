@@ -0,0 +1,224 @@
+import argparse
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from constants import *
+from data_methods import get_dataloader
+from head_methods import extract_fused_features, feature_paths
+from model_methods import load_model
+
+
+def export_embeddings(model, loader, prefix):
+    """
+    Writes the fused embeddings of a labeled corpus to a float16 store (`{prefix}_features.npy`) and the
+    metadata of every item (path, label, language, technique) to `{prefix}_metadata.csv`, in the same order.
+
+    :param model: Trained AVDNet.
+    :param loader: Unshuffled DataLoader over a dataset with get_metadata (RecursiveFakeAudioDataset, RawAudioDatasetLoader).
+    :param prefix: Output path prefix.
+    :return: The (embeddings, metadata) paths.
+    """
+    features_path, _ = extract_fused_features(model, loader, prefix, dtype=np.float16)
+    metadata_path = f"{prefix}_metadata.csv"
+    pd.DataFrame([loader.dataset.get_metadata(i) for i in range(len(loader.dataset))]).to_csv(metadata_path, index=False)
+    return features_path, metadata_path
+
+
+def load_embeddings(prefix):
+    """Returns the (float16 memmap of embeddings, metadata DataFrame) written by export_embeddings."""
+    features_path, _ = feature_paths(prefix)
+    return np.load(features_path, mmap_mode="r"), pd.read_csv(f"{prefix}_metadata.csv", keep_default_na=False)
+
+
+def normalize(vectors):
+    """L2-normalizes rows (float32), so that the squared distance is 2 - 2 * cosine similarity."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-8)
+
+
+class IVFIndex:
+    def __init__(self, n_lists=64, n_probe=8):
+        """
+        Inverted file index over L2-normalized embeddings: the vectors are clustered with k-means and a query
+        is only compared to the vectors of its `n_probe` closest clusters.
+
+        Args:
+            n_lists (int): Number of k-means clusters (inverted lists).
+            n_probe (int): Number of clusters searched per query (n_probe = n_lists gives exact search).
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.centroids = None  # [n_lists, D]
+        self.vectors = None  # [N, D] float16, sorted by cluster
+        self.ids = None  # [N] original row of every sorted vector
+        self.offsets = None  # [n_lists + 1] start of every cluster in the sorted arrays
+
+    def fit(self, embeddings, iterations=20, sample_size=100000, seed=42):
+        """Trains the centroids on (a sample of) `embeddings` and fills the inverted lists with all of them."""
+        vectors = normalize(embeddings)
+        generator = np.random.default_rng(seed)
+        n_lists = min(self.n_lists, len(vectors))
+
+        sample = vectors
+        if len(vectors) > sample_size:
+            sample = vectors[generator.choice(len(vectors), sample_size, replace=False)]
+        centroids = sample[generator.choice(len(sample), n_lists, replace=False)]
+
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = sample[assignments == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+                else:  # re-seed empty clusters
+                    centroids[c] = sample[generator.integers(len(sample))]
+            centroids = normalize(centroids)
+
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind="stable")
+        self.n_lists = n_lists
+        self.centroids = centroids
+        self.vectors = vectors[order].astype(np.float16)
+        self.ids = order.astype(np.int64)
+        self.offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+        return self
+
+    def search(self, queries, k=10):
+        """
+        :param queries: Array of shape [Q, D].
+        :param k: Number of neighbours.
+        :return: (distances [Q, k], ids [Q, k]) sorted by increasing squared distance, ids are -1 when
+            the probed lists hold less than k vectors.
+        """
+        queries = normalize(queries)
+        n_probe = min(self.n_probe, self.n_lists)
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :n_probe]
+
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, query in enumerate(queries):
+            rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in probes[q]])
+            if len(rows) == 0:
+                continue
+            candidate_distances = 2.0 - 2.0 * (self.vectors[rows].astype(np.float32) @ query)
+            top = np.argsort(candidate_distances)[:k] if len(rows) <= k \
+                else np.argpartition(candidate_distances, k - 1)[:k]
+            top = top[np.argsort(candidate_distances[top])]
+            distances[q, :len(top)] = candidate_distances[top]
+            ids[q, :len(top)] = self.ids[rows[top]]
+        return distances, ids
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, vectors=self.vectors, ids=self.ids, offsets=self.offsets,
+                 n_probe=self.n_probe)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(n_lists=len(data["centroids"]), n_probe=int(data["n_probe"]))
+        index.centroids, index.vectors, index.ids, index.offsets = (data["centroids"], data["vectors"],
+                                                                    data["ids"], data["offsets"])
+        return index
+
+
+class SourceAttributor:
+    def __init__(self, index, metadata, key="technique", k=10):
+        """
+        Attributes embeddings to the generator of their nearest neighbours (similarity weighted vote).
+
+        Args:
+            index (IVFIndex): Index over the embeddings of the labeled corpus.
+            metadata (DataFrame): Metadata of the corpus, row i describes embedding i.
+            key (str): Metadata column to attribute ("technique" or "language").
+            k (int): Number of neighbours voting.
+        """
+        self.index = index
+        self.sources = metadata[key].astype(str).to_numpy()
+        self.k = k
+
+    def attribute(self, embeddings):
+        """Returns one (source, confidence) pair per embedding, confidence being the share of the vote."""
+        distances, ids = self.index.search(embeddings, self.k)
+        results = []
+        for row_distances, row_ids in zip(distances, ids):
+            votes = defaultdict(float)
+            for distance, i in zip(row_distances, row_ids):
+                if i >= 0:
+                    votes[self.sources[i]] += 1.0 / (distance + 1e-6)
+            if not votes:
+                results.append((None, 0.0))
+                continue
+            source = max(votes, key=votes.get)
+            results.append((source, votes[source] / sum(votes.values())))
+        return results
+
+
+def build_attribution_index(prefix, n_lists=64, n_probe=8):
+    """Builds and saves (`{prefix}_ivf.npz`) the IVF index of an embedding store."""
+    embeddings, _ = load_embeddings(prefix)
+    return IVFIndex(n_lists=n_lists, n_probe=n_probe).fit(embeddings).save(f"{prefix}_ivf.npz")
+
+
+def load_attributor(prefix, key="technique", k=10):
+    _, metadata = load_embeddings(prefix)
+    return SourceAttributor(IVFIndex.load(f"{prefix}_ivf.npz"), metadata, key=key, k=k)
+
+
+def score_and_attribute(checkpoint_path, prefix, paths, key="technique", k=10):
+    """
+    Scores audio files with an AVDNet checkpoint and attributes each of them to its most likely generator
+    from the same forward pass. Returns one (probability, source, confidence) tuple per file.
+    """
+    from inference_methods import AudioScorer
+    from audio_methods import extract_lfcc_torchaudio
+
+    scorer = AudioScorer(checkpoint_path)
+    attributor = load_attributor(prefix, key=key, k=k)
+
+    waveforms = [scorer.load(path) for path in paths]
+    lfcc_batch = torch.stack([extract_lfcc_torchaudio(waveform, sr) for waveform, sr in waveforms])
+    audio_batch = torch.stack([waveform for waveform, _ in waveforms])
+
+    with torch.no_grad():
+        embeddings = scorer.model.forward_features(lfcc_batch.to(scorer.device), audio_batch.to(scorer.device))
+        probabilities = torch.sigmoid(scorer.model.classifier(embeddings)).view(-1).cpu().tolist()
+
+    start = time.perf_counter()
+    attributions = attributor.attribute(embeddings.cpu().numpy())
+    print(f"attribution time = {(time.perf_counter() - start) * 1000 / len(paths):.2f} ms per clip")
+    return [(probability, source, confidence) for probability, (source, confidence) in zip(probabilities, attributions)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake-source attribution with a nearest-neighbour index of fused embeddings.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="export the fused embeddings of a labeled corpus")
+    export_parser.add_argument("checkpoint", help="checkpoint of the trained AVDNet")
+    export_parser.add_argument("--root-dir", default=DATASET_FOLDER)
+    export_parser.add_argument("--split", default="Fake", help="'Fake' for a language/technique tree, or Train/Validation/Test")
+    export_parser.add_argument("--output", default="embeddings/corpus", help="output prefix of the embedding store")
+    export_parser.add_argument("--batch-size", type=int, default=16)
+    export_parser.add_argument("--n-lists", type=int, default=64)
+    export_parser.add_argument("--n-probe", type=int, default=8)
+
+    attribute_parser = subparsers.add_parser("attribute", help="score audio files and attribute them to a generator")
+    attribute_parser.add_argument("checkpoint", help="checkpoint of the trained AVDNet")
+    attribute_parser.add_argument("files", nargs="+")
+    attribute_parser.add_argument("--index", default="embeddings/corpus", help="prefix of the embedding store")
+    attribute_parser.add_argument("--key", default="technique", choices=["technique", "language"])
+    attribute_parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        loader = get_dataloader(args.split, args.root_dir, batch_size=args.batch_size, shuffle=False, num_workers=2)
+        print(export_embeddings(load_model(args.checkpoint), loader, args.output))
+        print(build_attribution_index(args.output, n_lists=args.n_lists, n_probe=args.n_probe))
+    else:
+        for path, (probability, source, confidence) in zip(args.files, score_and_attribute(
+                args.checkpoint, args.index, args.files, key=args.key, k=args.k)):
+            print(f"{probability:.4f}\t{source}\t{confidence:.2f}\t{path}")
@@ -0,0 +1,204 @@
+import argparse
+import os
+import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import torch
+import torchaudio
+import torchaudio.transforms as T
+import torch.nn.functional as F
+
+# Audio preprocessing shared by the datasets and the inference entry points.
+# Keep this module free of pandas/sklearn so that scoring starts fast.
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".mp3", ".opus", ".ogg")
+
+
+@lru_cache(maxsize=16)
+def get_resampler(orig_freq, new_freq):
+    """Resampling kernel from orig_freq to new_freq, built once per pair of rates (and per process)."""
+    return T.Resample(orig_freq, new_freq)
+
+
+def to_mono(waveform):
+    """Averages the channels of a (channels, samples) waveform."""
+    return waveform.mean(dim=0, keepdim=True) if waveform.shape[0] > 1 else waveform
+
+
+def resample(waveform, orig_freq, new_freq=16000):
+    if orig_freq == new_freq:
+        return waveform
+    with torch.no_grad():
+        return get_resampler(orig_freq, new_freq)(waveform)
+
+
+def load_audio(path, sample_rate=16000, format=None):
+    """
+    Decodes any audio file torchaudio can read (WAV, FLAC, MP3, Opus, ...) to a mono waveform at `sample_rate`.
+    Drop-in for torchaudio.load: returns (waveform of shape (1, samples), sample_rate).
+
+    Args:
+        path (str or file-like): Audio file.
+        sample_rate (int): Target sample rate (wav2vec2 and the LFCC expect 16kHz).
+        format (str): Container/codec, needed for file-like objects without a name.
+    """
+    waveform, sr = torchaudio.load(path, format=format)
+    return resample(to_mono(waveform), sr, sample_rate), sample_rate
+
+
+def load_audio_batch(paths, sample_rate=16000):
+    """
+    Batched load_audio: the files sharing a source rate are padded into one tensor and resampled in one call.
+    Returns the (1, samples) waveforms in the order of `paths`.
+    """
+    decoded = [torchaudio.load(path) for path in paths]
+    waveforms = [None] * len(paths)
+    for rate in {sr for _, sr in decoded}:
+        indices = [i for i, (_, sr) in enumerate(decoded) if sr == rate]
+        mono = [to_mono(decoded[i][0])[0] for i in indices]
+        batch = torch.nn.utils.rnn.pad_sequence(mono, batch_first=True)  # [B, max samples]
+        batch = resample(batch, rate, sample_rate)
+        for i, waveform, row in zip(indices, mono, batch):
+            length = -(-waveform.shape[0] * sample_rate // rate)  # the padding is cut off again
+            waveforms[i] = row[:length].unsqueeze(0)
+    return waveforms
+
+
+def _preprocess_files(jobs, sample_rate):
+    """Worker of preprocess_audio_tree: converts a batch of (input, output) files, returns the failures."""
+    torch.set_num_threads(1)  # one process per core already
+    failures = []
+    try:
+        waveforms = load_audio_batch([source for source, _ in jobs], sample_rate)
+    except RuntimeError:  # an unreadable file in the batch, retry them one by one
+        waveforms = []
+        for source, _ in jobs:
+            try:
+                waveforms.append(load_audio(source, sample_rate)[0])
+            except RuntimeError as error:
+                failures.append((source, str(error)))
+                waveforms.append(None)
+    for (_, destination), waveform in zip(jobs, waveforms):
+        if waveform is not None:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            torchaudio.save(destination, waveform, sample_rate, encoding="PCM_S", bits_per_sample=16)
+    return failures
+
+
+def preprocess_audio_tree(input_dir, output_dir, sample_rate=16000, num_workers=None, batch_size=32):
+    """
+    Offline version of load_audio over a whole dataset tree, on a process pool: every audio file is converted
+    to a 16 bit mono WAV at `sample_rate` with the same relative path (extension .wav), the other files
+    (CSVs, ...) are copied unchanged. CSVs listing non-WAV file names must be updated to the .wav names.
+
+    :return: List of the (path, error) of the files that could not be decoded.
+    """
+    jobs = []
+    for directory, _, files in os.walk(input_dir):
+        for file in sorted(files):
+            source = os.path.join(directory, file)
+            destination = os.path.join(output_dir, os.path.relpath(source, input_dir))
+            if file.lower().endswith(AUDIO_EXTENSIONS):
+                jobs.append((source, os.path.splitext(destination)[0] + ".wav"))
+            else:
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.copyfile(source, destination)
+
+    failures = []
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        batches = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+        for batch_failures in pool.map(_preprocess_files, batches, [sample_rate] * len(batches)):
+            failures += batch_failures
+    print(f"Converted {len(jobs) - len(failures)} files to {sample_rate} Hz mono WAV in {output_dir}, "
+          f"{len(failures)} failed")
+    return failures
+
+
+def fix_length(waveform, expected_length):
+    """
+    Pad with zeros or truncate a waveform of shape (channels, samples) to exactly `expected_length` samples.
+    """
+    if waveform.shape[1] < expected_length:
+        pad_size = expected_length - waveform.shape[1]
+        waveform = F.pad(waveform, (0, pad_size))  # Pad with zeros
+    elif waveform.shape[1] > expected_length:
+        waveform = waveform[:, :expected_length]  # Truncate
+    return waveform
+
+
+def crop_offsets(waveform, crop_length, n_crops, mode="random", hop_length=4000):
+    """
+    Start offsets of `n_crops` crops of `crop_length` samples in a waveform of shape (channels, samples).
+
+    Args:
+        mode (str): "first" for consecutive crops from the start, "random" for uniform random offsets,
+            "energy" for the highest-energy crops (non-overlapping when the waveform is long enough).
+        hop_length (int): Offset resolution of the "energy" crops (default: 0.25 s at 16 kHz).
+
+    Returns:
+        list: n_crops offsets (0 for waveforms shorter than crop_length, fix_length pads them).
+    """
+    max_offset = waveform.shape[1] - crop_length
+    if max_offset <= 0:
+        return [0] * n_crops
+    if mode == "first":
+        return [min(i * crop_length, max_offset) for i in range(n_crops)]
+    if mode == "random":
+        return [random.randint(0, max_offset) for _ in range(n_crops)]
+    if mode != "energy":
+        raise ValueError(f"Unknown crop mode `{mode}`, expected 'first', 'random' or 'energy'.")
+
+    cumulative = F.pad(waveform.pow(2).mean(dim=0).cumsum(0), (1, 0))
+    candidates = torch.arange(0, max_offset + 1, hop_length)
+    energies = cumulative[candidates + crop_length] - cumulative[candidates]
+    ranked = candidates[torch.argsort(energies, descending=True)].tolist()
+
+    offsets = []
+    for offset in ranked:  # greedy: highest energy first, skipping crops overlapping a chosen one
+        if all(abs(offset - chosen) >= crop_length for chosen in offsets):
+            offsets.append(offset)
+            if len(offsets) == n_crops:
+                return offsets
+    # the waveform is too short for n_crops disjoint crops, complete with the best overlapping ones
+    offsets += [offset for offset in ranked if offset not in offsets][:n_crops - len(offsets)]
+    return (offsets * n_crops)[:n_crops]
+
+
+def extract_lfcc_torchaudio(waveform, sample_rate=16000, n_lfcc=80, n_filter=128, log_lf=False):
+    """
+    Extract LFCC features from waveform using torchaudio.
+
+    Args:
+        waveform (torch.Tensor): Audio tensor of shape (1, samples)
+        sample_rate (int): Sample rate of audio (default: 16kHz)
+        n_lfcc (int): Number of LFCC coefficients (default: 40)
+        n_filter (int): Number of linear filters (default: 128)
+        log_lf (bool): Whether to apply log scale on LFCC (default: False)
+
+    Returns:
+        torch.Tensor: LFCC features of shape (1, n_lfcc, time_steps)
+    """
+    lfcc_transform = T.LFCC(
+        sample_rate=sample_rate,
+        n_lfcc=n_lfcc,
+        n_filter=n_filter,
+        log_lf=log_lf
+    )
+
+    lfcc_features = lfcc_transform(waveform)  # (1, n_lfcc, time_steps)
+
+    return lfcc_features
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a dataset tree to 16kHz mono WAV (WAV/FLAC/MP3/Opus inputs).")
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--num-workers", type=int, default=None)
+    args = parser.parse_args()
+
+    for path, error in preprocess_audio_tree(args.input_dir, args.output_dir, args.sample_rate, args.num_workers):
+        print(f"⚠️ {path}: {error}")
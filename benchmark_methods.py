@@ -0,0 +1,339 @@
+import os
+import threading
+import time
+
+from constants import *
+from audio_methods import extract_lfcc_torchaudio
+
+
+def synthetic_batch(batch_size, device=DEVICE):
+    """Random (lfcc, waveform) inputs with the shapes produced by the datasets (4 seconds of 16kHz audio)."""
+    audio = torch.randn(batch_size, 1, SAMPLE_RATE * CLIP_SECONDS) * 0.1
+    image = extract_lfcc_torchaudio(audio, SAMPLE_RATE)  # [B, 1, n_lfcc, time_steps]
+    return image.to(device), audio.to(device)
+
+
+def synchronize(device=DEVICE):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def measure_latency(model, inputs, warmup=2, repeats=10):
+    """
+    Measures the inference latency of `model` on a fixed batch.
+
+    :param model: Model called as model(*inputs).
+    :param inputs: Tuple of input tensors, the first dimension being the batch.
+    :param warmup: Number of untimed runs.
+    :param repeats: Number of timed runs averaged.
+    :return: Dictionary with latency_ms (per batch) and samples_per_sec.
+    """
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(*inputs)
+        synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(*inputs)
+        synchronize()
+    model.train(was_training)
+
+    latency = (time.perf_counter() - start) / repeats
+    return {"latency_ms": latency * 1000, "samples_per_sec": inputs[0].shape[0] / latency}
+
+
+def count_parameters(model):
+    """Returns (total, trainable) number of parameters."""
+    total = sum(param.numel() for param in model.parameters())
+    trainable = sum(param.numel() for param in model.parameters() if param.requires_grad)
+    return total, trainable
+
+
+def current_rss_mb():
+    """Resident memory of the process in MB (Linux /proc, 0 elsewhere)."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0.0
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+class PeakMemoryMonitor:
+    def __init__(self, interval=0.005, device=DEVICE):
+        """
+        Context manager recording the peak memory used inside its block: the process RSS sampled
+        by a background thread every `interval` seconds and, on CUDA, the peak allocated memory.
+        """
+        self.interval = interval
+        self.device = torch.device(device)
+        self.peak_rss_mb = 0.0
+        self.peak_cuda_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.peak_rss_mb = current_rss_mb()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+        if self.device.type == "cuda":
+            self.peak_cuda_mb = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        return False
+
+
+def profile_inference(model, batch_size=LATENCY_BATCH_SIZE, warmup=2, repeats=5):
+    """
+    Serving cost of a model on a fixed synthetic batch: latency, throughput, parameter count and peak memory.
+
+    :return: Dictionary with latency_ms, samples_per_sec, parameters, trainable_parameters,
+        peak_rss_mb and peak_cuda_mb (0 on CPU).
+    """
+    inputs = synthetic_batch(batch_size)
+    with PeakMemoryMonitor() as memory:
+        timing = measure_latency(model, inputs, warmup=warmup, repeats=repeats)
+    total, trainable = count_parameters(model)
+    return {**timing, "parameters": total, "trainable_parameters": trainable,
+            "peak_rss_mb": memory.peak_rss_mb, "peak_cuda_mb": memory.peak_cuda_mb}
+
+
+def benchmark_branch_parallelism(model, batch_sizes=(1, 2, 4, 8), cnn_threads=None, wav2vec_threads=None, repeats=10):
+    """
+    Compares the sequential forward of an AVDNet with the branch-parallel one for several batch sizes.
+    By default a quarter of the cores goes to the CNN branch and the rest to the (heavier) Wav2Vec branch.
+    Returns one result dictionary per batch size.
+    """
+    cores = os.cpu_count() or 2
+    cnn_threads = cnn_threads or max(1, cores // 4)
+    wav2vec_threads = wav2vec_threads or max(1, cores - cnn_threads)
+
+    results = []
+    for batch_size in batch_sizes:
+        inputs = synthetic_batch(batch_size)
+
+        model.disable_branch_parallelism()
+        sequential = measure_latency(model, inputs, repeats=repeats)
+        model.enable_branch_parallelism(cnn_threads=cnn_threads, wav2vec_threads=wav2vec_threads)
+        parallel = measure_latency(model, inputs, repeats=repeats)
+        model.disable_branch_parallelism()
+
+        results.append({"batch_size": batch_size,
+                        "sequential_ms": sequential["latency_ms"],
+                        "parallel_ms": parallel["latency_ms"],
+                        "speedup": sequential["latency_ms"] / parallel["latency_ms"]})
+        print(f"batch size {batch_size}: sequential = {sequential['latency_ms']:.1f} ms, "
+              f"parallel = {parallel['latency_ms']:.1f} ms, speedup = {results[-1]['speedup']:.2f}x "
+              f"(threads: cnn = {cnn_threads}, wav2vec = {wav2vec_threads})")
+    return results
+
+
+def measure_training_step(model, inputs, warmup=1, repeats=3):
+    """
+    Measures a training step (forward + backward, no optimizer update) of `model` on a fixed batch.
+    The buffers (BatchNorm running statistics) updated by the random batches are restored afterwards.
+    Returns a dictionary with step_ms, peak_rss_mb and peak_cuda_mb.
+    """
+    buffers = {name: buffer.detach().clone() for name, buffer in model.named_buffers()}
+    try:
+        return _measure_training_step(model, inputs, warmup, repeats)
+    finally:
+        with torch.no_grad():
+            for name, buffer in model.named_buffers():
+                buffer.copy_(buffers[name])
+
+
+def _measure_training_step(model, inputs, warmup, repeats):
+    was_training = model.training
+    model.train()
+    labels = torch.randint(0, 2, (inputs[0].shape[0],), device=inputs[0].device).float()
+    criterion = torch.nn.BCEWithLogitsLoss()
+
+    def step():
+        model.zero_grad(set_to_none=True)
+        criterion(model(*inputs).view(-1), labels).backward()
+
+    for _ in range(warmup):
+        step()
+    model.zero_grad(set_to_none=True)
+    synchronize()
+    with PeakMemoryMonitor() as memory:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            step()
+        synchronize()
+    model.zero_grad(set_to_none=True)
+    model.train(was_training)
+
+    return {"step_ms": (time.perf_counter() - start) / repeats * 1000,
+            "peak_rss_mb": memory.peak_rss_mb, "peak_cuda_mb": memory.peak_cuda_mb}
+
+
+def benchmark_activation_checkpointing(model, batch_sizes=(8, 16), cnn_segments=2, repeats=3):
+    """
+    Compares the training step time and peak memory of an AVDNet with and without activation checkpointing.
+    Returns one result dictionary per batch size.
+    """
+    results = []
+    for batch_size in batch_sizes:
+        inputs = synthetic_batch(batch_size)
+
+        model.disable_activation_checkpointing()
+        baseline = measure_training_step(model, inputs, repeats=repeats)
+        model.enable_activation_checkpointing(cnn_segments=cnn_segments)
+        checkpointed = measure_training_step(model, inputs, repeats=repeats)
+        model.disable_activation_checkpointing()
+
+        memory_key = "peak_cuda_mb" if torch.device(DEVICE).type == "cuda" else "peak_rss_mb"
+        results.append({"batch_size": batch_size,
+                        "baseline_ms": baseline["step_ms"], "checkpointed_ms": checkpointed["step_ms"],
+                        "baseline_mb": baseline[memory_key], "checkpointed_mb": checkpointed[memory_key]})
+        print(f"batch size {batch_size}: step = {baseline['step_ms']:.0f} ms -> {checkpointed['step_ms']:.0f} ms "
+              f"({checkpointed['step_ms'] / baseline['step_ms']:.2f}x), peak memory = {baseline[memory_key]:.0f} MB "
+              f"-> {checkpointed[memory_key]:.0f} MB")
+    return results
+
+
+def is_out_of_memory(error):
+    """True for the allocation failures of the CUDA and CPU allocators."""
+    message = str(error).lower()
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def memory_cap_mb(device=DEVICE):
+    """90% of the memory of the GPU, or of the host memory still available plus what the process already holds."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory / 2 ** 20 * 0.9
+    try:
+        with open("/proc/meminfo") as f:
+            available_kb = next(int(line.split()[1]) for line in f if line.startswith("MemAvailable:"))
+    except (OSError, StopIteration, ValueError):
+        return None
+    return (available_kb / 1024 + current_rss_mb()) * 0.9
+
+
+def find_max_batch_size(model, mode="train", batch_sizes=(1, 2, 4, 8, 16, 32, 64, 128), memory_cap=None,
+                        knee_tolerance=0.05, repeats=3):
+    """
+    Probes increasing batch sizes of a training step (forward + backward) or of inference and measures their
+    throughput and peak memory. Probing stops at the first batch size that runs out of memory or exceeds the cap.
+    The weights and BatchNorm statistics of the model are left unchanged, training probes start at batch size 2.
+
+    :param model: AVDNet (or any model called as model(lfcc, audio)).
+    :param mode: "train" or "inference".
+    :param batch_sizes: Increasing batch sizes to probe.
+    :param memory_cap: Peak memory allowed in MB (CUDA allocated memory on GPU, RSS on CPU), None for
+        BATCH_SIZE_MEMORY_CAP_MB or, if unset, memory_cap_mb().
+    :param knee_tolerance: The knee is the smallest batch size within this fraction of the best throughput.
+    :return: Dictionary with max_batch_size (largest batch under the cap), knee_batch_size, their samples_per_sec,
+        the memory_cap_mb used and the measurement of every probe (None values when even the first batch did not fit).
+    """
+    if memory_cap is None:
+        memory_cap = BATCH_SIZE_MEMORY_CAP_MB if BATCH_SIZE_MEMORY_CAP_MB is not None else memory_cap_mb()
+    memory_key = "peak_cuda_mb" if torch.device(DEVICE).type == "cuda" else "peak_rss_mb"
+
+    if mode == "train":  # BatchNorm can not train on a single sample
+        batch_sizes = [batch_size for batch_size in batch_sizes if batch_size > 1]
+
+    probes = []
+    for batch_size in batch_sizes:
+        try:
+            inputs = synthetic_batch(batch_size)
+            if mode == "train":
+                step = measure_training_step(model, inputs, repeats=repeats)
+                samples_per_sec = batch_size / step["step_ms"] * 1000
+                peak_mb = step[memory_key]
+            else:
+                with PeakMemoryMonitor() as memory:
+                    samples_per_sec = measure_latency(model, inputs, warmup=1, repeats=repeats)["samples_per_sec"]
+                peak_mb = getattr(memory, memory_key)
+        except RuntimeError as error:
+            if not is_out_of_memory(error):
+                raise
+            print(f"{mode} batch size {batch_size}: out of memory")
+            break
+        finally:
+            inputs = None
+            model.zero_grad(set_to_none=True)
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        fits = memory_cap is None or peak_mb <= memory_cap
+        probes.append({"batch_size": batch_size, "samples_per_sec": samples_per_sec, "peak_mb": peak_mb, "fits": fits})
+        print(f"{mode} batch size {batch_size}: {samples_per_sec:.1f} samples/s, peak memory = {peak_mb:.0f} MB")
+        if not fits:
+            break
+
+    fitting = [probe for probe in probes if probe["fits"]]
+    if not fitting:
+        return {"mode": mode, "max_batch_size": None, "knee_batch_size": None, "memory_cap_mb": memory_cap,
+                "probes": probes}
+
+    best_throughput = max(probe["samples_per_sec"] for probe in fitting)
+    knee = next(probe for probe in fitting if probe["samples_per_sec"] >= (1 - knee_tolerance) * best_throughput)
+    return {"mode": mode,
+            "max_batch_size": fitting[-1]["batch_size"], "max_samples_per_sec": fitting[-1]["samples_per_sec"],
+            "knee_batch_size": knee["batch_size"], "knee_samples_per_sec": knee["samples_per_sec"],
+            "memory_cap_mb": memory_cap, "probes": probes}
+
+
+def profile_batch_sizes(model, memory_cap=None, **kwargs):
+    """
+    Runs find_max_batch_size for inference and training (in that order: on CPU the RSS of the process does not
+    shrink back after the larger training probes). The result is what save_model stores in a checkpoint.
+    """
+    device = torch.cuda.get_device_name(DEVICE) if torch.device(DEVICE).type == "cuda" else "cpu"
+    inference = find_max_batch_size(model, mode="inference", memory_cap=memory_cap, **kwargs)
+    train = find_max_batch_size(model, mode="train", memory_cap=memory_cap, **kwargs)
+    return {"device": device, "inference": inference, "train": train}
+
+
+if __name__ == "__main__":
+    import argparse
+    from model_methods import load_model
+    from Architectures.registry import get_model_class
+
+    parser = argparse.ArgumentParser(description="Benchmark the branch-parallel AVDNet forward, "
+                                                 "activation checkpointing in training or the batch size.")
+    parser.add_argument("--checkpoint", default=None, help="AVDNet checkpoint (default: an untrained default AVDNet)")
+    parser.add_argument("--cnn-threads", type=int, default=None)
+    parser.add_argument("--wav2vec-threads", type=int, default=None)
+    parser.add_argument("--activation-checkpointing", action="store_true",
+                        help="report training step time and peak memory with/without activation checkpointing")
+    parser.add_argument("--find-batch-size", action="store_true",
+                        help="probe the training/inference batch sizes and store the result in the checkpoint")
+    parser.add_argument("--memory-cap-mb", type=float, default=None)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=None)
+    args = parser.parse_args()
+
+    model = load_model(args.checkpoint) if args.checkpoint else get_model_class("AVDNet")().to(DEVICE)
+    if args.find_batch_size:
+        from model_methods import save_batch_size_profile
+        profile = profile_batch_sizes(model, memory_cap=args.memory_cap_mb,
+                                      batch_sizes=args.batch_sizes or (1, 2, 4, 8, 16, 32, 64, 128))
+        for mode in ("inference", "train"):
+            print(f"{mode}: max batch size = {profile[mode]['max_batch_size']}, "
+                  f"knee = {profile[mode]['knee_batch_size']} (memory cap = {profile[mode]['memory_cap_mb']} MB)")
+        if args.checkpoint:
+            save_batch_size_profile(args.checkpoint, profile)
+            print(f"Batch size profile stored in {args.checkpoint}")
+    elif args.activation_checkpointing:
+        benchmark_activation_checkpointing(model, batch_sizes=args.batch_sizes or (8, 16))
+    else:
+        benchmark_branch_parallelism(model, batch_sizes=args.batch_sizes or (1, 2, 4, 8),
+                                     cnn_threads=args.cnn_threads, wav2vec_threads=args.wav2vec_threads)
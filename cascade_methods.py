@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch.nn as nn
+
+from constants import *
+from model_methods import save_model, load_model
+
+
+class CascadeDetector(nn.Module):
+    def __init__(self, cheap_model, full_model, low, high):
+        """
+        Two stage detector: every clip is scored by `cheap_model`, only the clips whose probability
+        falls in the uncertainty band [low, high] are escalated to `full_model`.
+        Both models take (image, audio) and return logits of shape [B, 1], and so does the cascade.
+
+        Args:
+            cheap_model: Fast first stage (e.g. LFCCOnly).
+            full_model: Fused model used for uncertain clips (e.g. AVDNet).
+            low, high (float): Uncertainty band on the cheap model probability (escalate when low <= p <= high).
+        """
+        super(CascadeDetector, self).__init__()
+        self.cheap_model = cheap_model
+        self.full_model = full_model
+        self.low = low
+        self.high = high
+        self.seen = 0
+        self.escalated = 0
+
+    def forward(self, image, audio):
+        logits = self.cheap_model(image, audio).view(-1, 1)
+        probabilities = torch.sigmoid(logits).view(-1)
+        escalate = (probabilities >= self.low) & (probabilities <= self.high)
+
+        if escalate.any():
+            logits = logits.clone()
+            logits[escalate] = self.full_model(image[escalate], audio[escalate]).view(-1, 1)
+
+        self.seen += escalate.numel()
+        self.escalated += int(escalate.sum().item())
+        return logits
+
+    def escalation_rate(self):
+        return self.escalated / max(self.seen, 1)
+
+
+def save_cascade(path, cheap_model_path, full_model_path, calibration):
+    """Saves the cascade definition (checkpoint paths and calibrated band) as a JSON file."""
+    with open(path, "w") as f:
+        json.dump({"cheap_model": cheap_model_path, "full_model": full_model_path, **calibration}, f, indent=4)
+    return path
+
+
+def load_cascade(path):
+    """
+    :param path: JSON file written by save_cascade.
+    :return: CascadeDetector on DEVICE, with a `checkpoint_paths` attribute listing the files it depends on.
+    """
+    with open(path) as f:
+        definition = json.load(f)
+
+    cascade = CascadeDetector(load_model(definition["cheap_model"]), load_model(definition["full_model"]),
+                              definition["low"], definition["high"])
+    cascade.checkpoint_paths = [path, definition["cheap_model"], definition["full_model"]]
+    return cascade.to(DEVICE)
+
+
+def collect_scores(model, loader):
+    """Returns (probabilities, labels) of a model over a whole DataLoader."""
+    model.eval()
+    all_scores, all_labels = [], []
+    with torch.no_grad():
+        for input_1, input_2, y_batch in loader:
+            logits = model(input_1.to(DEVICE), input_2.to(DEVICE)).view(-1)
+            all_scores.extend(torch.sigmoid(logits).cpu().numpy())
+            all_labels.extend(y_batch.numpy())
+    return np.array(all_scores), np.array(all_labels)
+
+
+def calibrate_band(cheap_scores, full_scores, labels, target_eer, n_candidates=50):
+    """
+    Finds the narrowest uncertainty band (lowest escalation rate) for which the cascade reaches `target_eer`.
+
+    :param cheap_scores: Cheap model probabilities on the validation set.
+    :param full_scores: Full model probabilities on the same clips.
+    :param labels: Ground truth labels.
+    :param target_eer: EER the cascade must not exceed.
+    :param n_candidates: Number of quantiles of the cheap scores tried as band limits.
+    :return: Dictionary with low, high, validation_eer, escalation_rate and target_eer.
+    """
+    from data_methods import calculate_eer
+
+    cheap_eer = calculate_eer(labels, cheap_scores)
+    if cheap_eer <= target_eer:
+        # The cheap model is good enough on its own: an empty band never escalates
+        return {"low": 1.0, "high": 0.0, "validation_eer": cheap_eer, "escalation_rate": 0.0, "target_eer": target_eer}
+
+    best = {"low": 0.0, "high": 1.0, "validation_eer": calculate_eer(labels, full_scores),
+            "escalation_rate": 1.0, "target_eer": target_eer}
+    if best["validation_eer"] > target_eer:
+        print(f"Warning: the full model EER ({best['validation_eer']:.4f}) is above the target, escalating everything.")
+        return best
+
+    candidates = np.unique(np.quantile(cheap_scores, np.linspace(0, 1, n_candidates + 1)))
+    for i, low in enumerate(candidates):
+        for high in candidates[i:]:
+            escalate = (cheap_scores >= low) & (cheap_scores <= high)
+            escalation_rate = escalate.mean()
+            if escalation_rate >= best["escalation_rate"]:
+                continue
+
+            eer = calculate_eer(labels, np.where(escalate, full_scores, cheap_scores))
+            if eer <= target_eer:
+                best = {"low": float(low), "high": float(high), "validation_eer": float(eer),
+                        "escalation_rate": float(escalation_rate), "target_eer": target_eer}
+    return best
+
+
+def calibrate_cascade(cheap_model_path, full_model_path, target_eer, output_path, batch_size=16):
+    """Calibrates the uncertainty band on the Validation split and saves the cascade definition."""
+    from data_methods import get_dataloader
+
+    val_loader = get_dataloader("Validation", DATASET_FOLDER, batch_size=batch_size, shuffle=False, num_workers=2)
+    cheap_scores, labels = collect_scores(load_model(cheap_model_path), val_loader)
+    full_scores, _ = collect_scores(load_model(full_model_path), val_loader)
+
+    calibration = calibrate_band(cheap_scores, full_scores, labels, target_eer)
+    print(f"Band = [{calibration['low']:.4f}, {calibration['high']:.4f}], "
+          f"validation EER = {calibration['validation_eer'] * 100:.2f}%, "
+          f"escalation rate = {calibration['escalation_rate'] * 100:.1f}%")
+    return save_cascade(output_path, cheap_model_path, full_model_path, calibration)
+
+
+def train_cheap_model(output_path, learning_rate=1e-4, weight_decay=1e-5, batch_size=BATCH_SIZE,
+                      freeze_cnn_layers=10, dense_hidden_dims=(256, 64)):
+    """Trains the LFCCOnly first stage on the Train split with the usual training loop."""
+    import optuna
+    from data_methods import get_dataloader
+    from optimization import EarlyStopping, setup_optimizer
+    from train_methods import train_model
+    from Architectures.registry import get_model_class
+
+    model = get_model_class("LFCCOnly")(freeze_cnn=True, freeze_cnn_layers=freeze_cnn_layers,
+                                        dense_hidden_dims=list(dense_hidden_dims)).to(DEVICE)
+    train_loader = get_dataloader("Train", DATASET_FOLDER, batch_size=batch_size, num_workers=2, fraction=PARTIAL_TRAINING)
+    val_loader = get_dataloader("Validation", DATASET_FOLDER, batch_size=batch_size, num_workers=2, fraction=PARTIAL_TRAINING)
+
+    trial = optuna.trial.FixedTrial({})
+    trial.set_user_attr("run_name", f"cheap_{os.path.splitext(os.path.basename(output_path))[0]}")
+    train_model(float('inf'), torch.nn.BCEWithLogitsLoss(), EarlyStopping(patience=PATIENCE), model,
+                setup_optimizer(model, learning_rate, weight_decay), train_loader, trial, val_loader)
+
+    # keep the best epoch, as saved by train_model
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    save_model(load_model(trial.user_attrs["best_model_path"]), output_path)
+    print(f"Cheap model saved to {output_path}")
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Confidence-gated cascade (cheap LFCC model first, AVDNet when uncertain).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser("train-cheap", help="train the LFCCOnly first stage")
+    train_parser.add_argument("--output", default="checkpoints/lfcc_only.pth")
+    train_parser.add_argument("--learning-rate", type=float, default=1e-4)
+
+    calibrate_parser = subparsers.add_parser("calibrate", help="calibrate the uncertainty band on the Validation split")
+    calibrate_parser.add_argument("--cheap", required=True, help="checkpoint of the cheap model")
+    calibrate_parser.add_argument("--full", required=True, help="checkpoint of the full model")
+    calibrate_parser.add_argument("--target-eer", type=float, default=0.05)
+    calibrate_parser.add_argument("--output", default="checkpoints/cascade.json")
+    args = parser.parse_args()
+
+    if args.command == "train-cheap":
+        train_cheap_model(args.output, learning_rate=args.learning_rate)
+    else:
+        calibrate_cascade(args.cheap, args.full, args.target_eer, args.output)
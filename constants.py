@@ -1,3 +1,4 @@
+from functools import lru_cache
 import warnings
 warnings.filterwarnings("ignore")  # Suppress user warnings
 
@@ -25,15 +26,53 @@ PATIENCE = 4
 PARTIAL_TRAINING = 1 # between 0-1 how much of the data to use
 
 DEBUGMODE = False
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print("Runnig on device:", DEVICE)
+# DEVICE ("cuda" when available, else "cpu") is resolved on its first use (see __getattr__ at the end of the file),
+# importing the constants does not query CUDA
+
+
+@lru_cache(maxsize=None)
+def get_device():
+    """The torch device of the project, CUDA is queried on the first call only."""
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 # The model parameters
 BATCH_SIZE = 16
+MICRO_BATCH_SIZE = 16 # largest batch run at once in the study, bigger effective batch sizes accumulate gradients
 DROP_OUT = 0.3
+LATENCY_OBJECTIVE = False # adds the measured inference latency (minimized) as a 4th objective of the study
+LATENCY_BATCH_SIZE = 8 # batch size of the synthetic batch used to measure the serving cost of every trial
+COMPUTE_BUDGET_GFLOPS = None # trials whose estimated GFLOPs per training sample exceed it are pruned before loading, None disables it
+MEMORY_BUDGET_MB = None # trials whose estimated training memory (weights, optimizer, activations) exceeds it are pruned, None disables it
+ACTIVATION_CHECKPOINTING = False # recompute the wav2vec2/fusion/CNN activations in the backward pass: less memory for ~30% more compute
+WAV2VEC_LORA_RANK = 0 # > 0 fine-tunes wav2vec2 through low-rank adapters of this rank instead of unfreezing layers
+PROFILE_BATCH_SIZES = False # probe the training/inference batch sizes of the best model and store the result in its checkpoint
+BATCH_SIZE_MEMORY_CAP_MB = None # memory the batch-size probe may use, None for 90% of the device (or available host) memory
+SNAPSHOT_EVERY_STEPS = 200 # optimizer steps between training-state snapshots of a trial (0: only at the end of every epoch)
+RESUME_INTERRUPTED_TRIALS = True # with LOAD_TRAINING, re-run the trials left RUNNING by a killed process from their last snapshot
+CROPS_PER_FILE = 1 # 4 second crops taken from every decoded training file (> 1 uses the audio past the first 4 seconds)
+CROP_MODE = "first" # "first", "random" or "energy" (highest-energy) crops of the training files
 
 # logs path
 TRAINING_DATA_PATH = 'data/results/'  # Directory for saving training results
 
+# Inference
+SAMPLE_RATE = 16000
+CLIP_SECONDS = 4 # length the waveforms are padded/truncated to before scoring
+PREDICTION_CACHE_SIZE = 10000 # max entries kept in the in-memory LRU tier (0 disables it)
+PREDICTION_CACHE_DB = None # path of the on-disk SQLite tier, None to keep the cache in memory only
+PREDICTION_CACHE_MAX_DISK_ENTRIES = 1000000 # rows kept in the on-disk tier before evicting
+PREDICTION_CACHE_TTL = None # seconds before a cached prediction expires, None to never expire
+
 #a file for dynamic loading ?
+
+
+def __getattr__(name):
+    """Lazy module attributes: DEVICE."""
+    if name == "DEVICE":
+        return get_device()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# what `from constants import *` exports: every public name, as without __all__, plus the lazy DEVICE
+__all__ = [name for name in dir() if not name.startswith("_")] + ["DEVICE"]
@@ -0,0 +1,374 @@
+from constants import SAMPLE_RATE, CLIP_SECONDS
+
+# Static cost model of AVDNet configurations: parameter counts, FLOPs and activation memory are derived
+# from the layer shapes only, nothing is built nor loaded. FLOPs count a multiply-add as 2 operations.
+# Activation memory is an estimate (outputs of every layer, attention matrices included), good enough
+# to rank configurations and reject the ones that can not fit, not to predict the allocator exactly.
+
+LFCC_SHAPE = (80, SAMPLE_RATE * CLIP_SECONDS // 200 + 1)  # (n_lfcc, frames) of extract_lfcc_torchaudio
+VGG16_CFG = [64, 64, "M", 128, 128, "M", 256, 256, 256, "M", 512, 512, 512, "M", 512, 512, 512, "M"]
+RESNET_CFG = {"resnet34": ("basic", [3, 4, 6, 3]), "resnet50": ("bottleneck", [3, 4, 6, 3])}
+
+# torchvision MobileNetV3 inverted residual blocks: (input, kernel, expanded, output, squeeze-excitation, stride)
+MOBILENET_V3_CFG = {
+    "mobilenet_v3_small": (16, [(16, 3, 16, 16, True, 2), (16, 3, 72, 24, False, 2), (24, 3, 88, 24, False, 1),
+                                (24, 5, 96, 40, True, 2), (40, 5, 240, 40, True, 1), (40, 5, 240, 40, True, 1),
+                                (40, 5, 120, 48, True, 1), (48, 5, 144, 48, True, 1), (48, 5, 288, 96, True, 2),
+                                (96, 5, 576, 96, True, 1), (96, 5, 576, 96, True, 1)], 576),
+    "mobilenet_v3_large": (16, [(16, 3, 16, 16, False, 1), (16, 3, 64, 24, False, 2), (24, 3, 72, 24, False, 1),
+                                (24, 5, 72, 40, True, 2), (40, 5, 120, 40, True, 1), (40, 5, 120, 40, True, 1),
+                                (40, 3, 240, 80, False, 2), (80, 3, 200, 80, False, 1), (80, 3, 184, 80, False, 1),
+                                (80, 3, 184, 80, False, 1), (80, 3, 480, 112, True, 1), (112, 3, 672, 112, True, 1),
+                                (112, 5, 672, 160, True, 2), (160, 5, 960, 160, True, 1), (160, 5, 960, 160, True, 1)],
+                           960),
+}
+# torchvision EfficientNet-B0 stages: (expand ratio, kernel, stride, input, output, layers)
+EFFICIENTNET_B0_CFG = [(1, 3, 1, 32, 16, 1), (6, 3, 2, 16, 24, 2), (6, 5, 2, 24, 40, 2), (6, 3, 2, 40, 80, 3),
+                       (6, 5, 1, 80, 112, 3), (6, 5, 2, 112, 192, 4), (6, 3, 1, 192, 320, 1)]
+# DepthwiseCNNFeatureExtractor.CFG (output channels, stride) after a 32 channels stride 2 stem
+DEPTHWISE_CFG = [(64, 2), (128, 2), (128, 1), (256, 2), (256, 1), (256, 2)]
+
+# facebook/wav2vec2-large-960h
+WAV2VEC_CONV_LAYERS = [(512, 10, 5)] + [(512, 3, 2)] * 4 + [(512, 2, 2)] * 2  # (channels, kernel, stride)
+WAV2VEC_HIDDEN = 1024
+WAV2VEC_FFN = 4096
+WAV2VEC_HEADS = 16
+WAV2VEC_LAYERS = 24
+WAV2VEC_POS_CONV = (128, 16)  # (kernel, groups)
+
+FUSION_FFN = 2048  # nn.TransformerEncoderLayer default dim_feedforward
+BYTES_PER_FLOAT = 4
+
+
+def conv_output_size(size, kernel, stride=1, padding=0):
+    return (size + 2 * padding - kernel) // stride + 1
+
+
+class CostAccumulator:
+    def __init__(self):
+        """
+        Sums the cost of a network described layer by layer, in execution order.
+        Every branch starts with begin_branch(): activations are kept for the backward pass from the
+        first trainable layer of the branch onward (gradients never flow further back).
+        """
+        self.params = 0
+        self.trainable_params = 0
+        self.flops = 0
+        self.backward_flops = 0
+        self.train_activations = 0  # elements per sample kept for the backward pass
+        self.peak_activations = 0  # elements per sample alive at once during inference
+        self.grad_flowing = False
+
+    def begin_branch(self):
+        self.grad_flowing = False
+
+    def add(self, params, flops, activations, trainable, peak=None):
+        """
+        :param params: Parameters of the layer.
+        :param flops: Forward FLOPs per sample.
+        :param activations: Elements per sample produced by the layer (kept for the backward pass).
+        :param trainable: Whether the parameters of the layer are trained.
+        :param peak: Elements per sample alive at once while the layer runs (defaults to `activations`).
+        """
+        self.params += params
+        self.flops += flops
+        if trainable:
+            self.trainable_params += params
+            self.grad_flowing = True
+        if self.grad_flowing:
+            # gradient with respect to the input, plus the weight gradient for trainable layers
+            self.backward_flops += flops * (2 if trainable else 1)
+            self.train_activations += activations
+        self.peak_activations = max(self.peak_activations, activations if peak is None else peak)
+
+    def conv2d(self, c_in, c_out, h, w, kernel, stride=1, padding=0, bias=True, trainable=True):
+        h_out, w_out = conv_output_size(h, kernel, stride, padding), conv_output_size(w, kernel, stride, padding)
+        params = c_in * c_out * kernel * kernel + (c_out if bias else 0)
+        self.add(params, 2 * c_in * kernel * kernel * c_out * h_out * w_out, c_out * h_out * w_out, trainable,
+                 peak=c_in * h * w + c_out * h_out * w_out)
+        return h_out, w_out
+
+    def norm(self, channels, numel, trainable=True):
+        self.add(2 * channels, 4 * numel, numel, trainable)
+
+    def elementwise(self, numel, trainable=True):
+        self.add(0, numel, numel, trainable)
+
+    def linear(self, d_in, d_out, tokens=1, trainable=True):
+        self.add(d_in * d_out + d_out, 2 * d_in * d_out * tokens, d_out * tokens, trainable,
+                 peak=(d_in + d_out) * tokens)
+
+    def attention_layer(self, d_model, ffn, nhead, tokens, trainable=True, lora_rank=0):
+        """Post-norm Transformer encoder layer (self-attention + feed forward), optionally with adapters."""
+        if lora_rank > 0:
+            self.lora(d_model, ffn, tokens, lora_rank)
+            trainable = False  # the base weights are frozen, the adapters were counted above
+        for _ in range(4):  # q, k, v and output projections
+            self.linear(d_model, d_model, tokens, trainable)
+        # scores and weighted sum, the attention matrix of every head is kept for the backward pass
+        self.add(0, 4 * tokens * tokens * d_model, 2 * nhead * tokens * tokens, trainable,
+                 peak=nhead * tokens * tokens + 3 * tokens * d_model)
+        self.norm(d_model, tokens * d_model, trainable)
+        self.linear(d_model, ffn, tokens, trainable)
+        self.elementwise(tokens * ffn, trainable)  # activation
+        self.linear(ffn, d_model, tokens, trainable)
+        self.norm(d_model, tokens * d_model, trainable)
+
+    def lora(self, d_model, ffn, tokens, rank):
+        """Adapters of one encoder layer (see LORA_TARGETS): 4 attention projections and 2 feed-forward ones."""
+        shapes = [(d_model, d_model)] * 4 + [(d_model, ffn), (ffn, d_model)]
+        params = sum(rank * (d_in + d_out) for d_in, d_out in shapes)
+        flops = sum(2 * rank * (d_in + d_out) * tokens for d_in, d_out in shapes)
+        self.add(params, flops, sum(rank * tokens for _ in shapes), True)
+
+
+def _frozen(index, freeze, freeze_layers):
+    """Freezing rule of the CNN extractors: the first `freeze_layers` modules, or all of them if None."""
+    return freeze and (freeze_layers is None or index < freeze_layers)
+
+
+def vgg_cost(acc, freeze=True, freeze_layers=None, shape=LFCC_SHAPE):
+    """VGG16-bn features on the LFCC input. Returns (channels, H, W) of the output."""
+    acc.begin_branch()
+    h, w = shape
+    channels, index = 1, 0
+    for value in VGG16_CFG:
+        if value == "M":
+            h, w = h // 2, w // 2
+            acc.add(0, channels * h * w * 4, channels * h * w, False)
+            index += 1
+            continue
+        h, w = acc.conv2d(channels, value, h, w, 3, padding=1, trainable=not _frozen(index, freeze, freeze_layers))
+        acc.norm(value, value * h * w, trainable=not _frozen(index + 1, freeze, freeze_layers))
+        acc.elementwise(value * h * w, trainable=False)
+        channels, index = value, index + 3
+    return channels, h, w
+
+
+def resnet_cost(acc, model_name="resnet50", freeze=True, freeze_layers=None, shape=LFCC_SHAPE):
+    """ResNet trunk (conv1 ... layer4) on the LFCC input. Returns (channels, H, W) of the output."""
+    acc.begin_branch()
+    block, depths = RESNET_CFG[model_name]
+    expansion = 4 if block == "bottleneck" else 1
+    h, w = shape
+
+    h, w = acc.conv2d(1, 64, h, w, 7, stride=2, padding=3, bias=False, trainable=not _frozen(0, freeze, freeze_layers))
+    acc.norm(64, 64 * h * w, trainable=not _frozen(1, freeze, freeze_layers))
+    acc.elementwise(64 * h * w, trainable=False)
+    h, w = conv_output_size(h, 3, 2, 1), conv_output_size(w, 3, 2, 1)
+    acc.add(0, 9 * 64 * h * w, 64 * h * w, False)
+
+    channels = 64
+    for stage, (width, depth) in enumerate(zip([64, 128, 256, 512], depths)):
+        trainable = not _frozen(4 + stage, freeze, freeze_layers)
+        for i in range(depth):
+            stride = 2 if stage > 0 and i == 0 else 1
+            out_channels = width * expansion
+            h_in, w_in = h, w
+            if block == "bottleneck":
+                acc.conv2d(channels, width, h, w, 1, bias=False, trainable=trainable)
+                acc.norm(width, width * h * w, trainable)
+                h, w = acc.conv2d(width, width, h, w, 3, stride=stride, padding=1, bias=False, trainable=trainable)
+                acc.norm(width, width * h * w, trainable)
+                acc.conv2d(width, out_channels, h, w, 1, bias=False, trainable=trainable)
+            else:
+                h, w = acc.conv2d(channels, width, h, w, 3, stride=stride, padding=1, bias=False, trainable=trainable)
+                acc.norm(width, width * h * w, trainable)
+                acc.conv2d(width, width, h, w, 3, padding=1, bias=False, trainable=trainable)
+            acc.norm(out_channels, out_channels * h * w, trainable)
+            if stride != 1 or channels != out_channels:  # downsample shortcut
+                acc.conv2d(channels, out_channels, h_in, w_in, 1, stride=stride, bias=False, trainable=trainable)
+                acc.norm(out_channels, out_channels * h * w, trainable)
+            acc.elementwise(2 * out_channels * h * w, trainable=False)  # residual sum + relu
+            channels = out_channels
+    return channels, h, w
+
+
+def _make_divisible(value, divisor=8):
+    new_value = max(divisor, int(value + divisor / 2) // divisor * divisor)
+    return new_value + divisor if new_value < 0.9 * value else new_value
+
+
+def conv_bn_cost(acc, c_in, c_out, h, w, kernel, stride=1, groups=1, trainable=True):
+    """Conv2d (no bias) + BatchNorm + activation, grouped convolutions included. Returns (H, W) of the output."""
+    padding = (kernel - 1) // 2
+    h_out, w_out = conv_output_size(h, kernel, stride, padding), conv_output_size(w, kernel, stride, padding)
+    params = c_in // groups * c_out * kernel * kernel
+    acc.add(params, 2 * params * h_out * w_out, c_out * h_out * w_out, trainable,
+            peak=c_in * h * w + c_out * h_out * w_out)
+    acc.norm(c_out, c_out * h_out * w_out, trainable)
+    acc.elementwise(c_out * h_out * w_out, trainable=False)
+    return h_out, w_out
+
+
+def inverted_residual_cost(acc, c_in, kernel, expanded, c_out, squeeze, stride, h, w, trainable):
+    """MobileNetV3 / EfficientNet (MBConv) block. Returns (H, W) of the output."""
+    if expanded != c_in:
+        conv_bn_cost(acc, c_in, expanded, h, w, 1, trainable=trainable)
+    h, w = conv_bn_cost(acc, expanded, expanded, h, w, kernel, stride, groups=expanded, trainable=trainable)
+    if squeeze:
+        acc.add(0, expanded * h * w, expanded, False)  # global pooling
+        acc.linear(expanded, squeeze, trainable=trainable)
+        acc.linear(squeeze, expanded, trainable=trainable)
+        acc.elementwise(expanded * h * w, trainable=False)  # channel scaling
+    conv_bn_cost(acc, expanded, c_out, h, w, 1, trainable=trainable)
+    return h, w
+
+
+def efficient_cost(acc, model_name="mobilenet_v3_small", freeze=True, freeze_layers=None, shape=LFCC_SHAPE):
+    """
+    MobileNetV3 / EfficientNet-B0 trunk on the LFCC input, the module indices used by the freezing rule
+    being those of `features` (stem, blocks or stages, last convolution). Returns (channels, H, W).
+    """
+    acc.begin_branch()
+    h, w = shape
+    if model_name == "efficientnet_b0":
+        blocks = [[(c_in if i == 0 else c_out, kernel, c_in * expand if i == 0 else c_out * expand, c_out,
+                    max(1, (c_in if i == 0 else c_out) // 4), stride if i == 0 else 1) for i in range(layers)]
+                  for expand, kernel, stride, c_in, c_out, layers in EFFICIENTNET_B0_CFG]
+        stem_channels, last_channels = 32, 1280
+    else:
+        stem_channels, config, last_channels = MOBILENET_V3_CFG[model_name]
+        blocks = [[(c_in, kernel, expanded, c_out, _make_divisible(expanded // 4) if squeeze else 0, stride)]
+                  for c_in, kernel, expanded, c_out, squeeze, stride in config]
+
+    h, w = conv_bn_cost(acc, 1, stem_channels, h, w, 3, stride=2, trainable=not _frozen(0, freeze, freeze_layers))
+    for index, stage in enumerate(blocks, start=1):
+        for c_in, kernel, expanded, c_out, squeeze, stride in stage:
+            h, w = inverted_residual_cost(acc, c_in, kernel, expanded, c_out, squeeze, stride, h, w,
+                                          trainable=not _frozen(index, freeze, freeze_layers))
+    c_in = blocks[-1][-1][3]
+    h, w = conv_bn_cost(acc, c_in, last_channels, h, w, 1, trainable=not _frozen(len(blocks) + 1, freeze, freeze_layers))
+    return last_channels, h, w
+
+
+def depthwise_cost(acc, freeze=False, freeze_layers=None, shape=LFCC_SHAPE):
+    """DepthwiseCNNFeatureExtractor on the LFCC input. Returns (channels, H, W) of the output."""
+    acc.begin_branch()
+    h, w = conv_bn_cost(acc, 1, 32, *shape, 3, stride=2, trainable=not _frozen(0, freeze, freeze_layers))
+    channels = 32
+    for index, (out_channels, stride) in enumerate(DEPTHWISE_CFG, start=1):
+        trainable = not _frozen(index, freeze, freeze_layers)
+        h, w = conv_bn_cost(acc, channels, channels, h, w, 3, stride, groups=channels, trainable=trainable)
+        conv_bn_cost(acc, channels, out_channels, h, w, 1, trainable=trainable)
+        channels = out_channels
+    return channels, h, w
+
+
+def wav2vec_cost(acc, freeze=True, freeze_feature_extractor=True, freeze_encoder_layers=0, num_encoder_layers=None,
+                 lora_rank=0, num_samples=SAMPLE_RATE * CLIP_SECONDS):
+    """wav2vec2-large on the raw waveform. Returns the number of output frames T."""
+    acc.begin_branch()
+    frozen_features = (freeze and freeze_feature_extractor) or lora_rank > 0
+
+    length, channels = num_samples, 1
+    for i, (out_channels, kernel, stride) in enumerate(WAV2VEC_CONV_LAYERS):
+        out_length = conv_output_size(length, kernel, stride)
+        acc.add(channels * out_channels * kernel, 2 * channels * out_channels * kernel * out_length,
+                2 * out_channels * out_length, not frozen_features, peak=channels * length + out_channels * out_length)
+        if i == 0:  # group norm
+            acc.norm(out_channels, out_channels * out_length, not frozen_features)
+        length, channels = out_length, out_channels
+    T = length
+
+    # feature projection, positional conv and encoder norm are only frozen by the adapters
+    trainable = lora_rank == 0
+    acc.norm(channels, channels * T, trainable)
+    acc.linear(channels, WAV2VEC_HIDDEN, T, trainable)
+    kernel, groups = WAV2VEC_POS_CONV
+    acc.add(WAV2VEC_HIDDEN * WAV2VEC_HIDDEN // groups * kernel + WAV2VEC_HIDDEN + kernel,
+            2 * WAV2VEC_HIDDEN * WAV2VEC_HIDDEN // groups * kernel * T, 2 * WAV2VEC_HIDDEN * T, trainable)
+    acc.norm(WAV2VEC_HIDDEN, WAV2VEC_HIDDEN * T, trainable)
+    acc.add(WAV2VEC_HIDDEN, 0, 0, trainable)  # masked_spec_embed
+
+    layers = WAV2VEC_LAYERS if num_encoder_layers is None else min(num_encoder_layers, WAV2VEC_LAYERS)
+    for i in range(layers):
+        layer_trainable = lora_rank == 0 and not (freeze and i < freeze_encoder_layers)
+        acc.attention_layer(WAV2VEC_HIDDEN, WAV2VEC_FFN, WAV2VEC_HEADS, T, layer_trainable, lora_rank=lora_rank)
+    return T
+
+
+def fusion_cost(acc, cnn_channels, H, W, T, d_model=256, nhead=8, num_layers=2, token_reduction="none",
+                reduction_factor=4, num_queries=8):
+    """FusionTransformer (always trained)."""
+    acc.begin_branch()
+    acc.linear(cnn_channels, d_model, H * W)
+    acc.linear(WAV2VEC_HIDDEN, d_model, T)
+    acc.add((H + W + 200 + 2) * d_model + 2 * d_model, 0, 0, True)  # positional/token type embeddings, norm
+
+    if token_reduction in ("stride", "learned"):
+        T = -(-T // reduction_factor)
+        if token_reduction == "learned":
+            acc.add(d_model * reduction_factor + d_model, 2 * d_model * reduction_factor * T, d_model * T, True)
+    tokens = H * W + T
+
+    if token_reduction == "query":
+        acc.add(num_queries * d_model, 0, 0, True)
+        acc.linear(d_model, d_model, num_queries)
+        acc.linear(d_model, 2 * d_model, tokens)
+        acc.add(0, 4 * num_queries * tokens * d_model, 2 * nhead * num_queries * tokens, True)
+        acc.linear(d_model, d_model, num_queries)
+        acc.norm(d_model, num_queries * d_model)
+        tokens = num_queries
+
+    for _ in range(num_layers):
+        acc.attention_layer(d_model, FUSION_FFN, nhead, tokens)
+    acc.norm(d_model, d_model)  # AVDNet.bn
+
+
+def classifier_cost(acc, input_dim, hidden_dims=None):
+    """DenseClassifier."""
+    if hidden_dims is None:
+        hidden_dims = [input_dim // 2, input_dim // 4]
+    for h_dim in list(hidden_dims) + [1]:
+        acc.linear(input_dim, h_dim)
+        if h_dim != 1:
+            acc.norm(h_dim, h_dim)
+        input_dim = h_dim
+
+
+def estimate_avdnet_cost(batch_size=1, optimizer_states=2, backbone="vgg", freeze_cnn=True, freeze_cnn_layers=None,
+                         freeze_wav2vec=True, freeze_feature_extractor=True, freeze_encoder_layers=0, d_model=256,
+                         nhead=8, num_layers=2, dense_hidden_dims=None, wav2vec_layers=None,
+                         fusion_token_reduction="none", fusion_reduction_factor=4, fusion_queries=8,
+                         lora_rank=0, **unused):
+    """
+    Estimates the cost of an AVDNet from its constructor kwargs, without building it.
+
+    :param batch_size: Batch size used for the memory estimates.
+    :param optimizer_states: Tensors kept by the optimizer per trainable parameter (2 for Adam).
+    :return: Dictionary with the parameter counts, the GFLOPs per sample (inference and training step),
+        the activation memory per sample (MB) and the total memory of a training / inference step (MB).
+    """
+    acc = CostAccumulator()
+    if backbone.lower() == "vgg":
+        cnn_channels, H, W = vgg_cost(acc, freeze_cnn, freeze_cnn_layers)
+    elif backbone.lower() in ("resnet", "resnet34"):
+        model_name = "resnet50" if backbone.lower() == "resnet" else "resnet34"
+        cnn_channels, H, W = resnet_cost(acc, model_name, freeze_cnn, freeze_cnn_layers)
+    elif backbone.lower() in ("mobilenet_v3_small", "mobilenet_v3_large", "efficientnet_b0"):
+        cnn_channels, H, W = efficient_cost(acc, backbone.lower(), freeze_cnn, freeze_cnn_layers)
+    elif backbone.lower() == "depthwise":
+        cnn_channels, H, W = depthwise_cost(acc, freeze_cnn, freeze_cnn_layers)
+    else:
+        raise ValueError("Unsupported backbone. Choose 'vgg', 'resnet', 'resnet34', 'mobilenet_v3_small', "
+                         "'mobilenet_v3_large', 'efficientnet_b0' or 'depthwise'.")
+
+    T = wav2vec_cost(acc, freeze_wav2vec, freeze_feature_extractor, freeze_encoder_layers, wav2vec_layers, lora_rank)
+    fusion_cost(acc, cnn_channels, H, W, T, d_model, nhead, num_layers, fusion_token_reduction,
+                fusion_reduction_factor, fusion_queries)
+    classifier_cost(acc, d_model, dense_hidden_dims)
+
+    mb = BYTES_PER_FLOAT / 2 ** 20
+    weights_mb = acc.params * mb
+    training_states_mb = acc.trainable_params * (1 + optimizer_states) * mb  # gradients + optimizer states
+    return {
+        "parameters": acc.params,
+        "trainable_parameters": acc.trainable_params,
+        "inference_gflops": acc.flops / 1e9,
+        "training_gflops": (acc.flops + acc.backward_flops) / 1e9,
+        "train_activation_mb": acc.train_activations * mb,
+        "inference_activation_mb": acc.peak_activations * mb,
+        "training_memory_mb": weights_mb + training_states_mb + batch_size * acc.train_activations * mb,
+        "inference_memory_mb": weights_mb + batch_size * acc.peak_activations * mb,
+    }
@@ -1,13 +1,14 @@
 from constants import *
 import os
 import random
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
-import torchaudio
 from sklearn.metrics import accuracy_score, recall_score, f1_score, precision_score, roc_curve
 import torchaudio.transforms as T
-import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, DistributedSampler, Sampler
+from audio_methods import fix_length, extract_lfcc_torchaudio, crop_offsets, load_audio, AUDIO_EXTENSIONS
+from distributed_methods import get_rank, get_world_size
 
 # Define Dataset for Training & Validation
 class Wav2VecDataset(Dataset):
@@ -125,18 +126,49 @@ def augment_audio_fixed(waveform, sample_rate):
     return waveform, augmentations
 
 
+class DecodeCache:
+    def __init__(self, max_entries=64):
+        """
+        Small LRU cache of decoded files. Every DataLoader worker holds its own copy of the dataset,
+        hence its own cache.
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
 class RawAudioDatasetLoader(Dataset):
-    def __init__(self, root_dir, dataset_type="Train", fraction = False):
+    def __init__(self, root_dir, dataset_type="Train", fraction = False, crops_per_file=1, crop_mode="first",
+                 decode_cache_size=64):
         """
         Args:
             root_dir (str): Path to the 'database' directory containing 'Real' and 'Fake' subfolders.
             dataset_type (str): One of 'Train', 'Test', or 'Validation' (determines which CSVs to load).
+            crops_per_file (int): Number of 4 second crops taken from every file, item idx is crop
+                idx % crops_per_file of file idx // crops_per_file.
+            crop_mode (str): "first", "random" or "energy" crops, see audio_methods.crop_offsets.
+            decode_cache_size (int): Decoded files kept (per worker) so that the crops of a file are decoded once,
+                see CropBatchSampler.
         """
         self.data = []
         self.augment_prob = 0.20
         self.sample_rate = 16000
         self.expected_length = self.sample_rate * 4 # 4 seconds
         self.dataset_type = dataset_type
+        self.crops_per_file = crops_per_file
+        self.crop_mode = crop_mode
+        self.decode_cache = DecodeCache(decode_cache_size)
 
         # Recursively search for dataset_type.csv in all subdirectories
         for class_name in ["Real", "Fake"]:  # Labels inferred from folder names
@@ -163,7 +195,8 @@ class RawAudioDatasetLoader(Dataset):
                             if os.path.exists(os.path.join(source_path, dataset_type, f"{filename}")):
                                 self.data.append((os.path.join(source_path, dataset_type), filename, labels[i]))
 
-        # Shuffle all (path, filename, label) entries together
+        # Shuffle all (path, filename, label) entries together (sorted first so the order only depends on the seed)
+        self.data.sort()
         random.shuffle(self.data)
         if fraction:
             self.data = self.data[:int(len(self.data) * fraction)]
@@ -173,16 +206,30 @@ class RawAudioDatasetLoader(Dataset):
         self.labels = [entry[2] for entry in self.data]
 
     def __len__(self):
-        return len(self.file_list)
+        return len(self.file_list) * self.crops_per_file
+
+    def decode_crops(self, audio_path):
+        """Decodes a file (or takes it from the decode cache) and returns (waveform, sr, crop offsets)."""
+        decoded = self.decode_cache.get(audio_path)
+        if decoded is None:
+            waveform, sr = load_audio(audio_path, self.sample_rate)
+            decoded = (waveform, sr, crop_offsets(waveform, self.expected_length, self.crops_per_file, self.crop_mode))
+            self.decode_cache.put(audio_path, decoded)
+        return decoded
 
     def __getitem__(self, idx):
+        idx, crop = divmod(idx, self.crops_per_file)
         audio_dir, filename = self.file_list[idx]
         label = torch.tensor(self.labels[idx], dtype=torch.float32)
 
 
         # Full path to the audio file.
         audio_path = os.path.join(audio_dir, f"{filename}")
-        waveform, sr = torchaudio.load(audio_path, format="wav")
+        if self.crops_per_file == 1 and self.crop_mode == "first":
+            waveform, sr = load_audio(audio_path, self.sample_rate)
+        else:
+            waveform, sr, offsets = self.decode_crops(audio_path)
+            waveform = waveform[:, offsets[crop]:offsets[crop] + self.expected_length]
 
         # Decide whether to apply augmentation.
         use_augmented = random.random() < self.augment_prob
@@ -193,11 +240,7 @@ class RawAudioDatasetLoader(Dataset):
                 waveform, _ = augment_audio(waveform, sr)
 
         # Ensure exact length using padding or truncation
-        if waveform.shape[1] < self.expected_length:
-            pad_size = self.expected_length - waveform.shape[1]
-            waveform = F.pad(waveform, (0, pad_size))  # Pad with zeros
-        elif waveform.shape[1] > self.expected_length:
-            waveform = waveform[:, :self.expected_length]  # Truncate
+        waveform = fix_length(waveform, self.expected_length)
 
         # Extract LFCC features from the waveform.
         lfcc_input = extract_lfcc_torchaudio(waveform, sr)
@@ -206,6 +249,12 @@ class RawAudioDatasetLoader(Dataset):
 
         return lfcc_input, wav2vec_input, label
 
+    def get_metadata(self, idx):
+        """Path, label and source folder (Real/<source>/ or Fake/<source>/) of an item, without loading the audio."""
+        audio_dir, filename = self.file_list[idx // self.crops_per_file]
+        return {"path": os.path.join(audio_dir, filename), "label": int(self.labels[idx // self.crops_per_file]),
+                "language": "", "technique": os.path.basename(os.path.dirname(audio_dir))}
+
 
 class RecursiveFakeAudioDataset(Dataset):
     def __init__(self, root_dir, dataset_type="Fake", fraction=False):
@@ -224,7 +273,7 @@ class RecursiveFakeAudioDataset(Dataset):
         self.expected_length = self.sample_rate * 4  # 4 seconds
         self.dataset_type = dataset_type
 
-        # Recursively find all .wav files
+        # Recursively find all audio files
         for lang_dir in os.listdir(root_dir):
             lang_path = os.path.join(root_dir, lang_dir)
             if not os.path.isdir(lang_path):
@@ -235,12 +284,13 @@ class RecursiveFakeAudioDataset(Dataset):
                 if not os.path.isdir(technique_path):
                     continue
 
-                # Find all WAV files in this technique directory
+                # Find all audio files in this technique directory
                 for file in os.listdir(technique_path):
-                    if file.endswith('.wav'):
+                    if file.lower().endswith(AUDIO_EXTENSIONS):
                         self.data.append((technique_path, file, 1))  # Always assign label 1 (Fake)
 
-        # Shuffle all (path, filename, label) entries together
+        # Shuffle all (path, filename, label) entries together (sorted first so the order only depends on the seed)
+        self.data.sort()
         random.shuffle(self.data)
         if fraction and isinstance(fraction, float) and 0 < fraction < 1:
             self.data = self.data[:int(len(self.data) * fraction)]
@@ -260,7 +310,7 @@ class RecursiveFakeAudioDataset(Dataset):
 
         # Full path to the audio file
         audio_path = os.path.join(audio_dir, filename)
-        waveform, sr = torchaudio.load(audio_path, format="wav")
+        waveform, sr = load_audio(audio_path, self.sample_rate)
 
         # Decide whether to apply augmentation
         use_augmented = random.random() < self.augment_prob
@@ -271,11 +321,7 @@ class RecursiveFakeAudioDataset(Dataset):
                 waveform, _ = augment_audio(waveform, sr)
 
         # Ensure exact length using padding or truncation
-        if waveform.shape[1] < self.expected_length:
-            pad_size = self.expected_length - waveform.shape[1]
-            waveform = F.pad(waveform, (0, pad_size))  # Pad with zeros
-        elif waveform.shape[1] > self.expected_length:
-            waveform = waveform[:, :self.expected_length]  # Truncate
+        waveform = fix_length(waveform, self.expected_length)
 
         # Extract LFCC features from the waveform
         lfcc_input = extract_lfcc_torchaudio(waveform, sr)
@@ -284,41 +330,131 @@ class RecursiveFakeAudioDataset(Dataset):
 
         return lfcc_input, wav2vec_input, label
 
+    def get_metadata(self, idx):
+        """Path, label, language and technique (generator) of an item, without loading the audio."""
+        technique_path, filename = self.file_list[idx]
+        return {"path": os.path.join(technique_path, filename), "label": int(self.labels[idx]),
+                "language": os.path.basename(os.path.dirname(technique_path)),
+                "technique": os.path.basename(technique_path)}
 
-def extract_lfcc_torchaudio(waveform, sample_rate=16000, n_lfcc=80, n_filter=128, log_lf=False):
-    """
-    Extract LFCC features from waveform using torchaudio.
 
-    Args:
-        waveform (torch.Tensor): Audio tensor of shape (1, samples)
-        sample_rate (int): Sample rate of audio (default: 16kHz)
-        n_lfcc (int): Number of LFCC coefficients (default: 40)
-        n_filter (int): Number of linear filters (default: 128)
-        log_lf (bool): Whether to apply log scale on LFCC (default: False)
+    #COMMENT
+    # bundle = pipelines.WAV2VEC2_ASR_BASE_960H
+    # bundle = pipelines.WAV2VEC2_XLSR_53 #1024 features but more suited for multi lingual
+    # model = bundle.get_model()
 
-    Returns:
-        torch.Tensor: LFCC features of shape (1, n_lfcc, time_steps)
-    """
-    lfcc_transform = T.LFCC(
-        sample_rate=sample_rate,
-        n_lfcc=n_lfcc,
-        n_filter=n_filter,
-        log_lf=log_lf
-    )
+class ResumableSampler(DistributedSampler):
+    def __init__(self, dataset, shuffle=True, seed=0):
+        """
+        DistributedSampler (a single replica outside of torch.distributed) that can start an epoch in the middle:
+        the order of an epoch only depends on the seed and the epoch, so skipping the first samples given to
+        set_start_index continues an interrupted epoch exactly.
 
-    lfcc_features = lfcc_transform(waveform)  # (1, n_lfcc, time_steps)
+        Args:
+            dataset (Dataset): Dataset to sample from.
+            shuffle (bool): Shuffle the indices every epoch (call set_epoch(epoch)).
+            seed (int): Seed of the shuffling.
+        """
+        super().__init__(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle, seed=seed)
+        self.start_index = 0
 
-    return lfcc_features
+    def set_start_index(self, start_index):
+        """Number of samples (of this rank) of the current epoch to skip, reset it to 0 for the next epoch."""
+        self.start_index = start_index
 
+    def __iter__(self):
+        return iter(list(super().__iter__())[self.start_index:])
 
+    def __len__(self):
+        return max(0, self.num_samples - self.start_index)
+
+
+class CropBatchSampler(Sampler):
+    def __init__(self, dataset, batch_size, num_workers=0, shuffle=True, seed=0, drop_last=False):
+        """
+        Batch sampler for a dataset with several crops per file (RawAudioDatasetLoader with crops_per_file > 1).
+        The files are shuffled and cut in chunks of batch_size files, every chunk gives crops_per_file batches
+        (batch j holds crop j of each file, so the crops of a file are spread over different batches) and these
+        batches are interleaved by groups of num_workers chunks so that the DataLoader, which hands batch k to
+        worker k % num_workers, gives all of them to the same worker: each file is decoded once per epoch, by one
+        worker. The files left after the last full group (and the last incomplete chunk, unless drop_last) are
+        shared out into num_workers smaller chunks, one per worker, to keep that alignment to the end of the
+        epoch; with fewer of them than num_workers (than 2 * num_workers with drop_last, so that no batch holds
+        a single file) they keep the batch_size chunks and may be decoded by several workers.
+        Files are sharded across the ranks of torch.distributed, and set_epoch/set_start_index work as in
+        ResumableSampler. Resuming skips whole batches: the DataLoader then starts its worker cycle at the first
+        remaining batch, which only renumbers the workers, every file still goes to a single worker.
+
+        Args:
+            dataset (RawAudioDatasetLoader): Dataset with crops_per_file.
+            batch_size (int): Number of crops per batch (= files per chunk).
+            num_workers (int): Number of DataLoader workers (must match the DataLoader).
+            shuffle (bool): Shuffle the files every epoch.
+            seed (int): Seed of the shuffling.
+            drop_last (bool): Drop the batches of the last incomplete chunk.
+        """
+        self.crops_per_file = dataset.crops_per_file
+        self.n_files = len(dataset) // self.crops_per_file
+        self.batch_size = batch_size
+        self.num_workers = max(1, num_workers)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.rank, self.world_size = get_rank(), get_world_size()
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_index(self, start_index):
+        """Number of samples (of this rank) of the current epoch to skip, reset it to 0 for the next epoch."""
+        self.start_index = start_index
+
+    def batches(self):
+        files = list(range(self.n_files))
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            files = torch.randperm(self.n_files, generator=generator).tolist()
+        # same number of files on every rank (as DistributedSampler does)
+        per_rank = -(-self.n_files // self.world_size)
+        files = (files * self.world_size)[:per_rank * self.world_size][self.rank::self.world_size]
+
+        batches = []
+        chunks = self.chunks(files)
+        for start in range(0, len(chunks), self.num_workers):
+            group = chunks[start:start + self.num_workers]  # chunk i of the group goes to worker i
+            for crop in range(self.crops_per_file):
+                batches += [[file * self.crops_per_file + crop for file in chunk] for chunk in group]
+        return batches
+
+    def chunks(self, files):
+        """Cuts the files of this rank in chunks, in groups of num_workers (see the class description)."""
+        n_full = len(files) // self.batch_size
+        grouped = n_full // self.num_workers * self.num_workers * self.batch_size
+        chunks = [files[i:i + self.batch_size] for i in range(0, grouped, self.batch_size)]
+        tail = files[grouped:n_full * self.batch_size] if self.drop_last else files[grouped:]
+        if len(tail) >= self.num_workers * (2 if self.drop_last else 1):
+            size, extra = divmod(len(tail), self.num_workers)
+            bounds = [i * size + min(i, extra) for i in range(self.num_workers + 1)]
+            chunks += [tail[bounds[i]:bounds[i + 1]] for i in range(self.num_workers)]
+        else:
+            chunks += [tail[i:i + self.batch_size] for i in range(0, len(tail), self.batch_size)]
+        return chunks
+
+    def __iter__(self):
+        return iter(self.batches()[self.start_index // self.batch_size:])
+
+    def __len__(self):
+        per_rank = -(-self.n_files // self.world_size)
+        n_chunks = len(self.chunks(range(per_rank)))
+        return max(0, n_chunks * self.crops_per_file - self.start_index // self.batch_size)
 
-    #COMMENT
-    # bundle = pipelines.WAV2VEC2_ASR_BASE_960H
-    # bundle = pipelines.WAV2VEC2_XLSR_53 #1024 features but more suited for multi lingual
-    # model = bundle.get_model()
 
 # Function to create DataLoader
-def get_dataloader(dataset_type, root_dir, pin_memory=False, batch_size=32, shuffle=True, num_workers=4, fraction =None):
+def get_dataloader(dataset_type, root_dir, pin_memory=False, batch_size=32, shuffle=True, num_workers=4, fraction =None,
+                   distributed=False, drop_last=False, data_seed=None, crops_per_file=1, crop_mode="first"):
     """
     Creates a DataLoader for the given CSV (defining the dataset split) and data root directory.
 
@@ -329,17 +465,49 @@ def get_dataloader(dataset_type, root_dir, pin_memory=False, batch_size=32, shuf
         batch_size (int): Batch size.
         shuffle (bool): Whether to shuffle the data.
         num_workers (int): Number of worker processes.
+        distributed (bool): Shard the dataset across the processes of the torch.distributed group
+            with a ResumableSampler (call loader.sampler.set_epoch(epoch) every epoch when shuffling).
+        drop_last (bool): Drop the last incomplete batch.
+        data_seed (int): Seed of the file list shuffling (and subsampling) and of the sampling order. With a seed
+            the loader uses a ResumableSampler, so that an interrupted run can continue with the same data.
+        crops_per_file (int): Number of 4 second crops per file (Train/Validation/Test datasets), shuffled
+            loaders then sample them with a CropBatchSampler.
+        crop_mode (str): "first", "random" or "energy" crops.
 
     Returns:
         DataLoader: The DataLoader instance for the dataset.
     """
+    if distributed and data_seed is None:
+        data_seed = 0
+    if data_seed is not None:
+        # The datasets shuffle (and subsample) their file list on load, every rank (and every resumed run)
+        # must get the same list
+        random_state = random.getstate()
+        random.seed(data_seed)
+
     if "Fake" == dataset_type:
         dataset = RecursiveFakeAudioDataset(root_dir=root_dir, dataset_type=dataset_type, fraction=fraction)
     else:
-        dataset = RawAudioDatasetLoader(root_dir=root_dir, dataset_type=dataset_type, fraction = fraction)
+        dataset = RawAudioDatasetLoader(root_dir=root_dir, dataset_type=dataset_type, fraction = fraction,
+                                        crops_per_file=crops_per_file, crop_mode=crop_mode,
+                                        decode_cache_size=max(64, 2 * batch_size))
+
+    if data_seed is not None:
+        random.setstate(random_state)
+
+    if getattr(dataset, "crops_per_file", 1) > 1 and shuffle:
+        batch_sampler = CropBatchSampler(dataset, batch_size, num_workers=num_workers, shuffle=True,
+                                         seed=data_seed if data_seed is not None else random.randrange(2 ** 31),
+                                         drop_last=drop_last)
+        return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_workers, pin_memory=pin_memory)
+
+    sampler = None
+    if data_seed is not None:
+        sampler = ResumableSampler(dataset, shuffle=shuffle, seed=data_seed)
+        shuffle = False
 
     dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
-                            pin_memory=pin_memory)
+                            pin_memory=pin_memory, sampler=sampler, drop_last=drop_last)
     return dataloader
 
 
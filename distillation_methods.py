@@ -0,0 +1,213 @@
+import argparse
+import os
+
+import numpy as np
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+from constants import *
+from Architectures.registry import get_model_class
+from benchmark_methods import synthetic_batch, measure_latency, count_parameters
+from data_methods import get_dataloader, calculate_metrics, calculate_eer
+from model_methods import save_model, load_model
+from train_methods import validate_model
+
+
+class IndexedDataset(Dataset):
+    """Wraps a dataset so that every item also returns its index (to look precomputed teacher logits up)."""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return (*self.dataset[idx], idx)
+
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature=2.0, alpha=0.7):
+    """
+    Binary knowledge distillation loss.
+
+    :param student_logits: Student logits of shape [B].
+    :param teacher_logits: Teacher logits of shape [B].
+    :param labels: Hard labels of shape [B].
+    :param temperature: Softening temperature applied to both logits.
+    :param alpha: Weight of the soft target term, (1 - alpha) weights the hard label term.
+    :return: Scalar loss.
+    """
+    soft_targets = torch.sigmoid(teacher_logits / temperature)
+    soft_loss = F.binary_cross_entropy_with_logits(student_logits / temperature, soft_targets) * temperature ** 2
+    hard_loss = F.binary_cross_entropy_with_logits(student_logits, labels.float())
+    return alpha * soft_loss + (1 - alpha) * hard_loss
+
+
+def precompute_teacher_logits(teacher, dataset, path, batch_size=16, num_workers=2):
+    """
+    Runs the teacher once over `dataset` (without augmentation) and stores its logits in a .npy file,
+    in dataset order. Returns the logits array.
+    """
+    augment_prob = dataset.augment_prob
+    dataset.augment_prob = 0.0  # the soft targets are computed on the clean clips
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    teacher.eval()
+    logits = []
+    with torch.no_grad():
+        for input_1, input_2, _ in tqdm(loader):
+            logits.append(teacher(input_1.to(DEVICE), input_2.to(DEVICE)).view(-1).cpu().numpy())
+    dataset.augment_prob = augment_prob
+
+    logits = np.concatenate(logits).astype(np.float32)
+    np.save(path, logits)
+    return logits
+
+
+def train_one_epoch_distill(student, teacher, train_loader, optimizer, temperature=2.0, alpha=0.7, teacher_logits=None):
+    """
+    One epoch of distillation. The soft targets are either streamed from `teacher` on the same batch,
+    or looked up in `teacher_logits` (then the loader must yield the item index, see IndexedDataset).
+    Returns the average loss and a flag indicating numerical instability, like train_one_epoch.
+    """
+    student.train()
+    if teacher is not None:
+        teacher.eval()
+    train_loss = 0.0
+    count_train = 0
+    exploding_batch_count = 0
+
+    for batch in train_loader:
+        input_1, input_2, y_batch = batch[0].to(DEVICE), batch[1].to(DEVICE), batch[2].to(DEVICE)
+
+        if teacher_logits is not None:
+            t_logits = torch.as_tensor(teacher_logits[batch[3].numpy()], device=DEVICE)
+        else:
+            with torch.no_grad():
+                t_logits = teacher(input_1, input_2).view(-1)
+
+        optimizer.zero_grad()
+        s_logits = student(input_1, input_2).view(-1)
+        loss = distillation_loss(s_logits, t_logits, y_batch.view(-1), temperature, alpha)
+
+        # Check for numerical instability
+        if torch.isnan(loss) or torch.isinf(loss):
+            exploding_batch_count += 1
+            del loss
+            if exploding_batch_count >= len(train_loader) * 0.1:
+                print("Warning: NaN/Inf detected in loss. Skipping training.")
+                return float('inf'), True
+            continue
+
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+        train_loss += loss.detach().item()
+        count_train += 1
+
+    return train_loss / (count_train + 1e-10), False
+
+
+def distill_model(teacher_path, output_path, student="cnn", mode="stream", learning_rate=1e-3, weight_decay=1e-5,
+                  batch_size=BATCH_SIZE, temperature=2.0, alpha=0.7, dense_hidden_dims=None):
+    """
+    Trains a StudentNet on the soft targets of a trained AVDNet teacher and saves the best epoch
+    (lowest validation loss) with save_model.
+
+    :param teacher_path: Checkpoint of the teacher.
+    :param output_path: Where to save the student checkpoint.
+    :param student: "cnn" or "wav2vec2-base".
+    :param mode: "stream" to run the teacher on every training batch, "precompute" to run it once over
+        the Train split and cache its logits next to the output checkpoint.
+    :return: The output path.
+    """
+    from optimization import EarlyStopping, setup_optimizer
+
+    teacher = load_model(teacher_path)
+    model = get_model_class("StudentNet")(student=student, dense_hidden_dims=dense_hidden_dims).to(DEVICE)
+    optimizer = setup_optimizer(model, learning_rate, weight_decay)
+    early_stopping = EarlyStopping(patience=PATIENCE)
+    criterion = torch.nn.BCEWithLogitsLoss()
+
+    train_loader = get_dataloader("Train", DATASET_FOLDER, batch_size=batch_size, num_workers=2, fraction=PARTIAL_TRAINING)
+    val_loader = get_dataloader("Validation", DATASET_FOLDER, batch_size=batch_size, num_workers=2, fraction=PARTIAL_TRAINING)
+
+    teacher_logits = None
+    if mode == "precompute":
+        logits_path = os.path.splitext(output_path)[0] + "_teacher_logits.npy"
+        teacher_logits = precompute_teacher_logits(teacher, train_loader.dataset, logits_path, batch_size)
+        train_loader = DataLoader(IndexedDataset(train_loader.dataset), batch_size=batch_size, shuffle=True, num_workers=2)
+        teacher = None  # not needed anymore, free its memory
+    elif mode != "stream":
+        raise ValueError("Unsupported mode. Choose 'stream' or 'precompute'.")
+
+    best_val_loss = float('inf')
+    for epoch in tqdm(range(EPOCHS)):
+        train_loss, early_termination = train_one_epoch_distill(model, teacher, train_loader, optimizer,
+                                                                temperature, alpha, teacher_logits)
+        if early_termination:
+            break
+
+        val_loss, accuracy, recall, f1 = validate_model(model, val_loader, criterion)
+        print(f"\nEpoch {epoch} : Train Loss = {train_loss:.4f}, Validation Loss = {val_loss:.4f}, "
+              f"Accuracy = {accuracy:.4f}, Recall = {recall:.4f}, F1 = {f1:.4f}")
+
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            save_model(model, output_path)
+
+        early_stopping(val_loss)
+        if early_stopping.early_stop:
+            break
+
+    print(f"Student saved to {output_path} (validation loss = {best_val_loss:.4f})")
+    return output_path
+
+
+def benchmark_student(teacher_path, student_path, batch_sizes=(1, 8), dataset_type="Test"):
+    """
+    Compares accuracy/EER and latency of the student against its teacher.
+    Returns one result dictionary per model.
+    """
+    loader = get_dataloader(dataset_type, DATASET_FOLDER, batch_size=16, shuffle=False, num_workers=2)
+    results = []
+    for name, path in (("teacher", teacher_path), ("student", student_path)):
+        model = load_model(path)
+        model.eval()
+
+        all_y_true, all_y_pred = [], []
+        with torch.no_grad():
+            for input_1, input_2, y_batch in loader:
+                logits = model(input_1.to(DEVICE), input_2.to(DEVICE)).view(-1)
+                all_y_true.extend(y_batch.numpy())
+                all_y_pred.extend(torch.sigmoid(logits).cpu().numpy())
+        accuracy, recall, f1 = calculate_metrics(np.array(all_y_true), np.array(all_y_pred))
+
+        result = {"model": name, "accuracy": accuracy, "f1": f1,
+                  "eer": calculate_eer(np.array(all_y_true), np.array(all_y_pred)),
+                  "parameters": count_parameters(model)[0]}
+        for batch_size in batch_sizes:
+            result[f"latency_ms_bs{batch_size}"] = measure_latency(model, synthetic_batch(batch_size))["latency_ms"]
+        results.append(result)
+
+    for result in results:
+        print(", ".join(f"{key} = {value:.4f}" if isinstance(value, float) else f"{key} = {value}"
+                        for key, value in result.items()))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distill a trained AVDNet into a compact StudentNet.")
+    parser.add_argument("teacher", help="checkpoint of the trained AVDNet teacher")
+    parser.add_argument("--output", default="checkpoints/student.pth")
+    parser.add_argument("--student", choices=["cnn", "wav2vec2-base"], default="cnn")
+    parser.add_argument("--mode", choices=["stream", "precompute"], default="precompute")
+    parser.add_argument("--learning-rate", type=float, default=1e-3)
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--alpha", type=float, default=0.7)
+    args = parser.parse_args()
+
+    distill_model(args.teacher, args.output, student=args.student, mode=args.mode, learning_rate=args.learning_rate,
+                  temperature=args.temperature, alpha=args.alpha)
+    benchmark_student(args.teacher, args.output)
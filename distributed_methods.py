@@ -0,0 +1,191 @@
+import os
+
+import torch.distributed as dist
+
+from constants import *
+
+# Data-parallel training helpers. Every function degrades to the single-process behaviour when
+# torch.distributed is not initialized, so the training loop can call them unconditionally.
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """Only rank 0 writes checkpoints, logs and study results."""
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def setup_distributed(backend="gloo"):
+    """
+    Joins the process group described by the torchrun environment variables (RANK, WORLD_SIZE,
+    MASTER_ADDR, MASTER_PORT). The CPU cores of a node are split between its local processes.
+    Returns the rank.
+    """
+    dist.init_process_group(backend=backend)
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))  # torchrun defaults to 1 thread
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+    return get_rank()
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def unwrap_model(model):
+    """Returns the module wrapped by DistributedDataParallel (the one to save), or the model itself."""
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
+
+
+def all_reduce_sum(*values):
+    """Sums python numbers over all the ranks. Returns a tuple of floats."""
+    if not is_distributed():
+        return tuple(float(value) for value in values)
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tuple(tensor.tolist())
+
+
+def any_rank(flag):
+    """True on every rank if `flag` is True on at least one of them (keeps the ranks in lockstep)."""
+    return all_reduce_sum(float(flag))[0] > 0
+
+
+def all_reduce_gradients(model):
+    """
+    Averages the gradients over the ranks by hand (when DistributedDataParallel did not synchronize them).
+    A parameter without gradient on some ranks (not used by their forward, e.g. Wav2Vec2 LayerDrop) counts as a zero
+    gradient there; a parameter without gradient on every rank keeps no gradient, as with DistributedDataParallel.
+    """
+    if not is_distributed():
+        return
+    world_size = get_world_size()
+    params = [param for param in model.parameters() if param.requires_grad]
+    if not params:
+        return
+    # the ranks first agree on which parameters have a gradient, so that they all run the same all_reduce calls
+    used = torch.tensor([float(param.grad is not None) for param in params], device=params[0].device)
+    dist.all_reduce(used, op=dist.ReduceOp.SUM)
+    for param, ranks_with_grad in zip(params, used.tolist()):
+        if ranks_with_grad == 0:
+            continue
+        if param.grad is None:
+            param.grad = torch.zeros_like(param)
+        dist.all_reduce(param.grad, op=dist.ReduceOp.SUM)
+        param.grad.div_(world_size)
+
+
+def all_gather_list(values):
+    """Concatenates python lists (e.g. predictions) from all the ranks, in rank order."""
+    if not is_distributed():
+        return list(values)
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, list(values))
+    return [value for rank_values in gathered for value in rank_values]
+
+
+def train_distributed(params, output_path, backend="gloo", num_workers=2, resume_from=None, data_seed=0):
+    """
+    Trains one configuration of the study with data parallelism (launch every process with torchrun).
+    The dataset is sharded with a DistributedSampler, gradients are all-reduced by DistributedDataParallel,
+    validation loss and metrics are computed over the whole Validation split on every rank (so that
+    EarlyStopping takes the same decision everywhere) and only rank 0 writes checkpoints.
+
+    :param params: Trial parameters (trial.params of a study, or a best_params.json).
+    :param output_path: Where rank 0 saves the best model.
+    :param resume_from: Training-state snapshot of an interrupted run to continue (see train_methods.train_model),
+        it is also where this run writes its snapshots.
+    :param data_seed: Seed of the data order, keep it when resuming.
+    :return: (best validation loss, last validation loss, f1)
+    """
+    import optuna
+    from torch.nn.parallel import DistributedDataParallel
+    from data_methods import get_dataloader
+    from model_methods import save_model, load_model
+    from optimization import EarlyStopping, setup_optimizer, suggest_hyperparameters, set_dropout
+    from train_methods import train_model
+    from Architectures.registry import get_model_class
+    from Architectures.AVDNetV2 import warm_pretrained_cache, clear_pretrained_cache
+
+    setup_distributed(backend)
+    try:
+        if "effective_batch_size" not in params and "batch_size" in params:  # studies without accumulation
+            params = {**params, "effective_batch_size": params["batch_size"]}
+        trial = optuna.trial.FixedTrial(params)
+        trial.set_user_attr("run_name", f"distributed_{os.path.splitext(os.path.basename(output_path))[0]}")
+        if resume_from is not None:
+            trial.set_user_attr("resume_from", resume_from)
+        model_kwargs, learning_rate, batch_size, accumulation_steps, dropout, weight_decay = \
+            suggest_hyperparameters(trial)
+        # the ranks process micro-batches in parallel, accumulate less to keep the same effective batch size
+        accumulation_steps = max(1, accumulation_steps // get_world_size())
+
+        # Rank 0 downloads the pretrained weights first, the other ranks then read them from the local cache
+        if is_main_process():
+            warm_pretrained_cache(backbones=(model_kwargs["backbone"],))
+        barrier()
+        warm_pretrained_cache(backbones=(model_kwargs["backbone"],))
+
+        train_loader = get_dataloader("Train", DATASET_FOLDER, batch_size=batch_size, num_workers=num_workers,
+                                      fraction=PARTIAL_TRAINING, distributed=True, drop_last=True, data_seed=data_seed,
+                                      crops_per_file=CROPS_PER_FILE, crop_mode=CROP_MODE)
+        val_loader = get_dataloader("Validation", DATASET_FOLDER, batch_size=batch_size, num_workers=num_workers,
+                                    fraction=PARTIAL_TRAINING, shuffle=False, distributed=True, data_seed=data_seed)
+
+        model = get_model_class("AVDNet")(**model_kwargs).to(DEVICE)
+        set_dropout(model, dropout)
+        if ACTIVATION_CHECKPOINTING:
+            model.enable_activation_checkpointing()
+        # some parameters get no gradient at some steps (Wav2Vec2 LayerDrop, unused layers), DDP has to look for them
+        model = DistributedDataParallel(model, find_unused_parameters=True)
+
+        os.makedirs("checkpoints", exist_ok=True)
+        result = train_model(float('inf'), torch.nn.BCEWithLogitsLoss(), EarlyStopping(patience=PATIENCE), model,
+                             setup_optimizer(model, learning_rate, weight_decay), train_loader, trial, val_loader,
+                             accumulation_steps)
+        clear_pretrained_cache()
+
+        if is_main_process() and "best_model_path" in trial.user_attrs:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            save_model(load_model(trial.user_attrs["best_model_path"]), output_path)
+            print(f"Best model saved to {output_path}")
+        barrier()
+        return result
+    finally:
+        cleanup_distributed()
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Data-parallel training of one AVDNet configuration "
+                                                 "(torchrun --nproc_per_node=2 distributed_methods.py best_params.json).")
+    parser.add_argument("params", help="JSON file with the trial parameters")
+    parser.add_argument("--output", default="checkpoints/distributed_model.pth")
+    parser.add_argument("--backend", default="gloo")
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--resume", default=None, help="training-state snapshot to continue from (and to write to)")
+    parser.add_argument("--data-seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.params) as f:
+        train_distributed(json.load(f), args.output, backend=args.backend, num_workers=args.num_workers,
+                          resume_from=args.resume, data_seed=args.data_seed)
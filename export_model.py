@@ -0,0 +1,223 @@
+import argparse
+import copy
+import os
+
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
+
+from constants import *
+from audio_methods import extract_lfcc_torchaudio
+from model_methods import load_model
+
+
+# =============================================================================
+# 1. Graph simplifications (BatchNorm folding, weight norm removal)
+# =============================================================================
+def fold_batchnorm(module):
+    """
+    Recursively folds every BatchNorm into the Conv2d / Linear that precedes it, in place.
+    Handles consecutive layers of an nn.Sequential (VGG features, DenseClassifier, ResNet stem)
+    and the (convN, bnN) attribute pairs of the torchvision ResNet blocks.
+    The folded BatchNorm is replaced by nn.Identity. The module must be in eval mode.
+    """
+    for child in module.children():
+        fold_batchnorm(child)
+
+    if isinstance(module, nn.Sequential):
+        for i in range(len(module) - 1):
+            layer, next_layer = module[i], module[i + 1]
+            if isinstance(layer, nn.Conv2d) and isinstance(next_layer, nn.BatchNorm2d):
+                module[i] = fuse_conv_bn_eval(layer, next_layer)
+                module[i + 1] = nn.Identity()
+            elif isinstance(layer, nn.Linear) and isinstance(next_layer, nn.BatchNorm1d):
+                module[i] = fuse_linear_bn_eval(layer, next_layer)
+                module[i + 1] = nn.Identity()
+    else:
+        for conv_name, bn_name in (("conv1", "bn1"), ("conv2", "bn2"), ("conv3", "bn3")):
+            conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+    return module
+
+
+def fold_input_batchnorm(bn, linear):
+    """
+    Folds a BatchNorm1d that is applied *before* a Linear layer (AVDNet.bn -> classifier) into that layer.
+    Returns the new nn.Linear.
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+
+    fused = nn.Linear(linear.in_features, linear.out_features)
+    with torch.no_grad():
+        fused.weight.copy_(linear.weight * scale.unsqueeze(0))
+        fused.bias.copy_(linear.bias + linear.weight @ shift)
+    return fused
+
+
+def remove_weight_norm(module):
+    """Replaces weight norm (wav2vec2 positional convolution) by the plain weight it computes."""
+    for child in module.modules():
+        if nn.utils.parametrize.is_parametrized(child, "weight"):
+            nn.utils.parametrize.remove_parametrizations(child, "weight", leave_parametrized=True)
+        elif hasattr(child, "weight_g") and hasattr(child, "weight_v"):
+            nn.utils.remove_weight_norm(child)
+    return module
+
+
+# =============================================================================
+# 2. Static inference graph
+# =============================================================================
+class StaticFusionTransformer(nn.Module):
+    def __init__(self, fusion, H, W, T):
+        """
+        Inference copy of FusionTransformer where the positional and token type embeddings are
+        precomputed for a fixed CNN grid (H, W) and wav2vec sequence length T.
+        Token reduction and the Transformer encoder are delegated to the original module.
+        """
+        super().__init__()
+        self.cnn_proj = fusion.cnn_proj
+        self.wav2vec_proj = fusion.wav2vec_proj
+        self.fusion = fusion
+
+        d_model = fusion.cnn_proj.out_features
+        with torch.no_grad():
+            cnn_embedding, wav2vec_embedding = fusion.embed(torch.zeros(1, fusion.cnn_proj.in_features, H, W),
+                                                            torch.zeros(1, T, fusion.wav2vec_proj.in_features))
+            # embed() also adds the projection biases, keep only the embeddings
+            cnn_embedding = cnn_embedding - fusion.cnn_proj.bias
+            wav2vec_embedding = wav2vec_embedding - fusion.wav2vec_proj.bias
+        self.register_buffer("cnn_embedding", cnn_embedding.reshape(1, H * W, d_model))  # [1, H*W, d_model]
+        self.register_buffer("wav2vec_embedding", wav2vec_embedding.reshape(1, T, d_model))  # [1, T, d_model]
+
+    def forward(self, cnn_feat, wav2vec_feat):
+        cnn_tokens = self.cnn_proj(cnn_feat.flatten(2).transpose(1, 2)) + self.cnn_embedding
+        wav2vec_tokens = self.wav2vec_proj(wav2vec_feat) + self.wav2vec_embedding
+        return self.fusion.fuse(cnn_tokens, wav2vec_tokens)
+
+
+class InferenceGraph(nn.Module):
+    def __init__(self, model, example_image, example_audio):
+        """
+        Builds the static LFCC+CNN+wav2vec2+fusion+classifier graph of a trained AVDNet:
+        BatchNorms folded, weight norm removed and fusion embeddings precomputed for the example shapes.
+        The given model is not modified.
+        """
+        super().__init__()
+        model = copy.deepcopy(model).cpu().eval()
+        with torch.no_grad():
+            cnn_feat = model.cnn_extractor(example_image)
+            wav2vec_feat = model.wav2vec_extractor(example_audio.squeeze(1))
+        _, _, H, W = cnn_feat.shape
+        T = wav2vec_feat.size(1)
+
+        if model.config.get("lora_rank", 0) > 0:
+            model.merge_lora()
+        fold_batchnorm(model.cnn_extractor)
+        fold_batchnorm(model.classifier)
+        remove_weight_norm(model.wav2vec_extractor)
+        model.classifier.classifier[0] = fold_input_batchnorm(model.bn, model.classifier.classifier[0])
+
+        self.cnn_extractor = model.cnn_extractor
+        self.wav2vec_extractor = model.wav2vec_extractor
+        self.fusion = StaticFusionTransformer(model.fusion, H, W, T)
+        self.classifier = model.classifier
+
+    def forward(self, image, audio):
+        cnn_feat = self.cnn_extractor(image)
+        wav2vec_feat = self.wav2vec_extractor(audio.squeeze(1))
+        fused_feature = self.fusion(cnn_feat, wav2vec_feat)
+        return self.classifier(fused_feature)
+
+
+# =============================================================================
+# 3. Export and parity check
+# =============================================================================
+def example_inputs(batch_size=2):
+    """Random inputs with the shapes produced by the datasets (4 seconds of 16kHz audio)."""
+    audio = torch.randn(batch_size, 1, SAMPLE_RATE * CLIP_SECONDS) * 0.1
+    image = torch.stack([extract_lfcc_torchaudio(waveform, SAMPLE_RATE) for waveform in audio])
+    return image, audio
+
+
+def max_abs_difference(reference, output):
+    return (reference - output).abs().max().item()
+
+
+def export_checkpoint(checkpoint_path, output_dir, formats=("export", "onnx"), atol=1e-4):
+    """
+    Exports a trained AVDNet checkpoint as a static inference graph (dynamic batch size) and checks that every
+    exported artifact matches the eager model within `atol`, at the traced batch size and at another one.
+
+    :param checkpoint_path: Path to a checkpoint written by save_model.
+    :param output_dir: Directory to write the .pt2 (torch.export) and/or .onnx files to.
+    :param formats: Any of "export" and "onnx".
+    :param atol: Maximum absolute difference allowed on the logits.
+    :return: Dictionary mapping each artifact to its maximum absolute difference with the eager model.
+    """
+    model = load_model(checkpoint_path).cpu().eval()
+    if not all(hasattr(model, name) for name in ("cnn_extractor", "wav2vec_extractor", "fusion", "bn", "classifier")):
+        raise ValueError(f"Only AVDNet checkpoints can be exported, got `{model.__class__.__name__}`.")
+
+    image, audio = example_inputs()
+    graph = InferenceGraph(model, image, audio).eval()
+
+    # the exported graphs take any batch size, they are also checked at a batch size other than the traced one
+    other_image, other_audio = example_inputs(3)
+    with torch.no_grad():
+        reference = model(image, audio)
+        other_reference = model(other_image, other_audio)
+        differences = {"folded": max_abs_difference(reference, graph(image, audio))}
+
+    os.makedirs(output_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(checkpoint_path))[0]
+
+    if "export" in formats:
+        program_path = os.path.join(output_dir, f"{name}.pt2")
+        batch = torch.export.Dim("batch")
+        program = torch.export.export(graph, (image, audio), dynamic_shapes={"image": {0: batch}, "audio": {0: batch}})
+        torch.export.save(program, program_path)
+        exported = torch.export.load(program_path).module()
+        with torch.no_grad():
+            differences[program_path] = max_abs_difference(reference, exported(image, audio))
+            differences[f"{program_path} (batch 3)"] = max_abs_difference(other_reference,
+                                                                           exported(other_image, other_audio))
+
+    if "onnx" in formats:
+        onnx_path = os.path.join(output_dir, f"{name}.onnx")
+        torch.onnx.export(graph, (image, audio), onnx_path,
+                          input_names=["lfcc", "audio"], output_names=["logit"],
+                          dynamic_axes={"lfcc": {0: "batch"}, "audio": {0: "batch"}, "logit": {0: "batch"}},
+                          opset_version=17)
+        try:
+            import onnxruntime
+        except ImportError:
+            print("onnxruntime is not installed, skipping the ONNX parity check.")
+        else:
+            session = onnxruntime.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+            output = session.run(None, {"lfcc": image.numpy(), "audio": audio.numpy()})[0]
+            differences[onnx_path] = max_abs_difference(reference, torch.from_numpy(output))
+            output = session.run(None, {"lfcc": other_image.numpy(), "audio": other_audio.numpy()})[0]
+            differences[f"{onnx_path} (batch 3)"] = max_abs_difference(other_reference, torch.from_numpy(output))
+
+    for artifact, difference in differences.items():
+        status = "OK" if difference <= atol else "MISMATCH"
+        print(f"{status} {artifact}: max |logit difference| = {difference:.2e}")
+
+    failed = [artifact for artifact, difference in differences.items() if difference > atol]
+    if failed:
+        raise RuntimeError(f"Exported graph does not match the eager model (atol={atol}): {failed}")
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a trained AVDNet checkpoint as a static inference graph.")
+    parser.add_argument("checkpoint", help="path to a .pth checkpoint written by save_model")
+    parser.add_argument("--output-dir", default="exported")
+    parser.add_argument("--format", choices=["export", "onnx", "both"], default="both")
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    formats = ("export", "onnx") if args.format == "both" else (args.format,)
+    export_checkpoint(args.checkpoint, args.output_dir, formats=formats, atol=args.atol)
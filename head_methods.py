@@ -0,0 +1,198 @@
+import argparse
+import os
+
+import numpy as np
+from torch.utils.data import Dataset, DataLoader, ConcatDataset, Subset
+from tqdm import tqdm
+
+from constants import *
+from data_methods import get_dataloader, calculate_metrics, calculate_eer
+from model_methods import save_model, load_model
+
+
+def feature_paths(prefix):
+    """Returns the (features, labels) .npy paths of a feature cache."""
+    return f"{prefix}_features.npy", f"{prefix}_labels.npy"
+
+
+def extract_fused_features(model, loader, prefix, dtype=np.float32):
+    """
+    Runs a trained AVDNet once over `loader` up to fusion + bn and writes the fused features to a
+    memmap of shape [N, d_model] (and the labels next to it), in dataset order.
+
+    :param model: Trained AVDNet (anything with forward_features and config["d_model"]).
+    :param loader: Unshuffled DataLoader yielding (image, audio, label).
+    :param prefix: Output path prefix, see feature_paths.
+    :param dtype: Storage type of the features (float16 halves the size of the cache).
+    :return: The (features, labels) paths.
+    """
+    features_path, labels_path = feature_paths(prefix)
+    if os.path.dirname(features_path):
+        os.makedirs(os.path.dirname(features_path), exist_ok=True)
+
+    dataset = loader.dataset
+    augment_prob = getattr(dataset, "augment_prob", None)
+    if augment_prob is not None:
+        dataset.augment_prob = 0.0  # the cached features are computed on the clean clips
+
+    features = np.lib.format.open_memmap(features_path, mode="w+", dtype=dtype,
+                                         shape=(len(dataset), model.config["d_model"]))
+    labels = np.zeros(len(dataset), dtype=np.float32)
+
+    model.eval()
+    start = 0
+    with torch.no_grad():
+        for input_1, input_2, y_batch in tqdm(loader):
+            fused = model.forward_features(input_1.to(DEVICE), input_2.to(DEVICE)).cpu().numpy()
+            features[start:start + len(fused)] = fused
+            labels[start:start + len(fused)] = y_batch.view(-1).numpy()
+            start += len(fused)
+
+    features.flush()
+    np.save(labels_path, labels)
+    if augment_prob is not None:
+        dataset.augment_prob = augment_prob
+    return features_path, labels_path
+
+
+def extract_checkpoint_features(checkpoint_path, dataset_type, root_dir, prefix, batch_size=16, num_workers=2):
+    """Extracts the fused features of one split of a dataset folder with the model of `checkpoint_path`."""
+    model = load_model(checkpoint_path)
+    loader = get_dataloader(dataset_type, root_dir, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    return extract_fused_features(model, loader, prefix)
+
+
+class FusedFeatureDataset(Dataset):
+    def __init__(self, prefix):
+        """
+        Fused features cached by extract_fused_features, read through a memmap.
+
+        Args:
+            prefix (str): Path prefix given to extract_fused_features.
+        """
+        features_path, labels_path = feature_paths(prefix)
+        self.features = np.load(features_path, mmap_mode="r")
+        self.labels = np.load(labels_path)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.features[idx], dtype=np.float32)), torch.tensor(self.labels[idx])
+
+
+def replay_subset(dataset, size, seed=42):
+    """Random subset of `size` items of `dataset` (the replay buffer of old data)."""
+    generator = np.random.default_rng(seed)
+    indices = generator.choice(len(dataset), size=min(size, len(dataset)), replace=False)
+    return Subset(dataset, indices.tolist())
+
+
+def evaluate_head(classifier, loader, criterion):
+    """Returns loss, accuracy, f1 and EER of the classifier over a feature loader."""
+    classifier.eval()
+    total_loss, count = 0.0, 0
+    all_y_true, all_y_pred = [], []
+    with torch.no_grad():
+        for x_batch, y_batch in loader:
+            x_batch, y_batch = x_batch.to(DEVICE), y_batch.to(DEVICE)
+            logits = classifier(x_batch).view(-1)
+            total_loss += criterion(logits, y_batch).item() * len(y_batch)
+            count += len(y_batch)
+            all_y_true.extend(y_batch.cpu().numpy())
+            all_y_pred.extend(torch.sigmoid(logits).cpu().numpy())
+
+    y_true, y_pred = np.array(all_y_true), np.array(all_y_pred)
+    accuracy, _, f1 = calculate_metrics(y_true, y_pred)
+    return total_loss / max(count, 1), accuracy, f1, calculate_eer(y_true, y_pred)
+
+
+def retrain_head(checkpoint_path, train_prefixes, output_path, val_prefix=None, replay_prefix=None, replay_size=5000,
+                 reset=False, epochs=30, learning_rate=1e-3, weight_decay=1e-5, batch_size=256):
+    """
+    Retrains only the DenseClassifier of a trained AVDNet on cached fused features, the rest of the model
+    is left untouched and the whole model is saved with save_model.
+
+    :param checkpoint_path: Checkpoint of the trained AVDNet.
+    :param train_prefixes: Feature caches to train on (e.g. the clips of the new fake source).
+    :param output_path: Where to save the updated checkpoint.
+    :param val_prefix: Feature cache used to keep the best epoch (lowest loss), None keeps the last one.
+    :param replay_prefix: Feature cache of the old training data, `replay_size` random items of it are mixed in
+        so that the head does not forget the known attacks.
+    :param reset: Re-initialize the classifier instead of fine-tuning it.
+    :return: The output path.
+    """
+    model = load_model(checkpoint_path)
+    classifier = model.classifier
+    if reset:
+        for module in classifier.modules():
+            if hasattr(module, "reset_parameters") and module is not classifier:
+                module.reset_parameters()
+
+    datasets = [FusedFeatureDataset(prefix) for prefix in train_prefixes]
+    if replay_prefix is not None:
+        datasets.append(replay_subset(FusedFeatureDataset(replay_prefix), replay_size))
+    train_loader = DataLoader(ConcatDataset(datasets), batch_size=batch_size, shuffle=True, drop_last=True)
+    val_loader = None
+    if val_prefix is not None:
+        val_loader = DataLoader(FusedFeatureDataset(val_prefix), batch_size=batch_size, shuffle=False)
+
+    optimizer = torch.optim.AdamW(classifier.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    criterion = torch.nn.BCEWithLogitsLoss()
+    best_val_loss = float('inf')
+
+    for epoch in range(epochs):
+        classifier.train()
+        train_loss, count = 0.0, 0
+        for x_batch, y_batch in train_loader:
+            x_batch, y_batch = x_batch.to(DEVICE), y_batch.to(DEVICE)
+            optimizer.zero_grad()
+            loss = criterion(classifier(x_batch).view(-1), y_batch)
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.item()
+            count += 1
+
+        if val_loader is None:
+            save_model(model, output_path)
+            continue
+
+        val_loss, accuracy, f1, eer = evaluate_head(classifier, val_loader, criterion)
+        print(f"Epoch {epoch} : Train Loss = {train_loss / max(count, 1):.4f}, Validation Loss = {val_loss:.4f}, "
+              f"Accuracy = {accuracy:.4f}, F1 = {f1:.4f}, EER = {eer * 100:.2f}%")
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            save_model(model, output_path)
+
+    print(f"Retrained model saved to {output_path}")
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retrain the classifier head of an AVDNet on cached fused features.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    extract_parser = subparsers.add_parser("extract", help="cache the fused features of one split")
+    extract_parser.add_argument("checkpoint", help="checkpoint of the trained AVDNet")
+    extract_parser.add_argument("--root-dir", default=DATASET_FOLDER, help="dataset folder (Train/Validation/Test CSVs)")
+    extract_parser.add_argument("--split", default="Train", choices=["Train", "Validation", "Test"])
+    extract_parser.add_argument("--output", required=True, help="output prefix of the feature cache")
+    extract_parser.add_argument("--batch-size", type=int, default=16)
+
+    retrain_parser = subparsers.add_parser("retrain", help="retrain the classifier head on cached features")
+    retrain_parser.add_argument("checkpoint", help="checkpoint of the trained AVDNet")
+    retrain_parser.add_argument("--train", nargs="+", required=True, help="feature caches to train on")
+    retrain_parser.add_argument("--val", default=None, help="feature cache used to keep the best epoch")
+    retrain_parser.add_argument("--replay", default=None, help="feature cache of the old training data")
+    retrain_parser.add_argument("--replay-size", type=int, default=5000)
+    retrain_parser.add_argument("--reset", action="store_true", help="re-initialize the head instead of fine-tuning it")
+    retrain_parser.add_argument("--epochs", type=int, default=30)
+    retrain_parser.add_argument("--learning-rate", type=float, default=1e-3)
+    retrain_parser.add_argument("--output", default="checkpoints/retrained_head.pth")
+    args = parser.parse_args()
+
+    if args.command == "extract":
+        print(extract_checkpoint_features(args.checkpoint, args.split, args.root_dir, args.output, args.batch_size))
+    else:
+        retrain_head(args.checkpoint, args.train, args.output, val_prefix=args.val, replay_prefix=args.replay,
+                     replay_size=args.replay_size, reset=args.reset, epochs=args.epochs, learning_rate=args.learning_rate)
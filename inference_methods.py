@@ -0,0 +1,223 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+
+from constants import *
+from audio_methods import extract_lfcc_torchaudio, fix_length, load_audio
+from model_methods import load_model
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Returns the sha256 hex digest of a file (used to identify a checkpoint)."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def waveform_hash(waveform, sample_rate):
+    """
+    Returns the sha256 hex digest of a decoded waveform.
+    The waveform should already be length-normalized so that the hash matches what the model sees.
+    """
+    digest = hashlib.sha256(str(sample_rate).encode())
+    digest.update(waveform.detach().to(torch.float32).cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    def __init__(self, max_entries=PREDICTION_CACHE_SIZE, db_path=PREDICTION_CACHE_DB,
+                 max_disk_entries=PREDICTION_CACHE_MAX_DISK_ENTRIES, ttl=PREDICTION_CACHE_TTL,
+                 evict_every=1000):
+        """
+        Two tier cache of model scores: an in-memory LRU in front of an optional SQLite file.
+
+        Args:
+            max_entries (int): Number of entries kept in memory, the least recently used are evicted first.
+            db_path (str or None): Path of the SQLite file for the on-disk tier, None disables it.
+            max_disk_entries (int): Number of rows kept on disk, the least recently used are evicted first.
+            ttl (float or None): Seconds after which an entry expires, None to never expire.
+            evict_every (int): Number of disk writes between two disk eviction passes.
+        """
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.evict_every = evict_every
+        self.memory = OrderedDict()  # key -> (score, insertion time)
+        self.hits = 0
+        self.misses = 0
+        self._disk_writes = 0
+
+        self.db = None
+        if db_path is not None:
+            if os.path.dirname(db_path):
+                os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS predictions ("
+                            "key TEXT PRIMARY KEY, score REAL, created REAL, last_access REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS predictions_access ON predictions(last_access)")
+            self.db.commit()
+
+    @staticmethod
+    def make_key(audio_hash, model_hash):
+        return f"{model_hash}:{audio_hash}"
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, key):
+        """Returns the cached score for `key` or None on a miss."""
+        now = time.time()
+        if key in self.memory:
+            score, created = self.memory[key]
+            if not self._expired(created, now):
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return score
+            del self.memory[key]
+
+        if self.db is not None:
+            row = self.db.execute("SELECT score, created FROM predictions WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                score, created = row
+                if not self._expired(created, now):
+                    self.db.execute("UPDATE predictions SET last_access = ? WHERE key = ?", (now, key))
+                    self.db.commit()
+                    self._put_memory(key, score, created)
+                    self.hits += 1
+                    return score
+                self.db.execute("DELETE FROM predictions WHERE key = ?", (key,))
+                self.db.commit()
+
+        self.misses += 1
+        return None
+
+    def put(self, key, score):
+        now = time.time()
+        self._put_memory(key, score, now)
+
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)", (key, score, now, now))
+            self.db.commit()
+            self._disk_writes += 1
+            if self._disk_writes % self.evict_every == 0:
+                self._evict_disk()
+
+    def _put_memory(self, key, score, created):
+        if self.max_entries <= 0:
+            return
+        self.memory[key] = (score, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)  # drop the least recently used entry
+
+    def _evict_disk(self):
+        if self.ttl is not None:
+            self.db.execute("DELETE FROM predictions WHERE created < ?", (time.time() - self.ttl,))
+        count = self.db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        excess = count - self.max_disk_entries
+        if excess > 0:
+            self.db.execute("DELETE FROM predictions WHERE key IN "
+                            "(SELECT key FROM predictions ORDER BY last_access ASC LIMIT ?)", (excess,))
+        self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class AudioScorer:
+    def __init__(self, checkpoint_path, cache=None, device=DEVICE):
+        """
+        Scores audio files with a trained checkpoint, optionally skipping the model for already seen audio.
+
+        Args:
+            checkpoint_path (str): Path to a checkpoint written by save_model, or to a cascade
+              definition (.json) written by cascade_methods.py.
+            cache (PredictionCache or None): Cache of previous predictions, None to always run the model.
+            device: Device to run the model on.
+        """
+        self.device = device
+        if checkpoint_path.endswith(".json"):
+            from cascade_methods import load_cascade
+            self.model = load_cascade(checkpoint_path).to(device)
+            checkpoint_paths = self.model.checkpoint_paths
+        else:
+            self.model = load_model(checkpoint_path).to(device)
+            checkpoint_paths = [checkpoint_path]
+        self.model.eval()
+        self.model_hash = hashlib.sha256("".join(file_hash(path) for path in checkpoint_paths).encode()).hexdigest()
+        self.cache = cache
+        self.expected_length = SAMPLE_RATE * CLIP_SECONDS
+
+    def load(self, path):
+        waveform, sr = load_audio(path, SAMPLE_RATE)
+        return fix_length(waveform, self.expected_length), sr
+
+    def score_files(self, paths, batch_size=8):
+        """
+        Returns the probability of each file to be fake. Cache hits never reach the model,
+        the misses are scored in batches of `batch_size`.
+        """
+        scores = [None] * len(paths)
+        pending = []  # (index, cache key, waveform, sample rate)
+
+        for i, path in enumerate(paths):
+            waveform, sr = self.load(path)
+            key = None
+            if self.cache is not None:
+                key = self.cache.make_key(waveform_hash(waveform, sr), self.model_hash)
+                cached = self.cache.get(key)
+                if cached is not None:
+                    scores[i] = cached
+                    continue
+
+            pending.append((i, key, waveform, sr))
+            if len(pending) == batch_size:
+                self._score_batch(pending, scores)
+                pending = []
+
+        if pending:
+            self._score_batch(pending, scores)
+        return scores
+
+    def _score_batch(self, pending, scores):
+        lfcc_batch = torch.stack([extract_lfcc_torchaudio(waveform, sr) for _, _, waveform, sr in pending])
+        audio_batch = torch.stack([waveform for _, _, waveform, _ in pending])
+
+        with torch.no_grad():
+            logits = self.model(lfcc_batch.to(self.device), audio_batch.to(self.device)).view(-1)
+        probabilities = torch.sigmoid(logits).cpu().tolist()
+
+        for (i, key, _, _), probability in zip(pending, probabilities):
+            scores[i] = probability
+            if key is not None:
+                self.cache.put(key, probability)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score audio files with a trained checkpoint.")
+    parser.add_argument("checkpoint", help="path to a .pth checkpoint written by save_model or a cascade .json")
+    parser.add_argument("files", nargs="+", help="audio files to score")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--cache-db", default=PREDICTION_CACHE_DB, help="SQLite file for the on-disk cache tier")
+    parser.add_argument("--no-cache", action="store_true", help="always run the model")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else PredictionCache(db_path=args.cache_db)
+    scorer = AudioScorer(args.checkpoint, cache=cache)
+    for path, score in zip(args.files, scorer.score_files(args.files, batch_size=args.batch_size)):
+        print(f"{score:.4f}\t{path}")
+
+    if hasattr(scorer.model, "escalation_rate"):
+        print(f"cascade escalation rate = {scorer.model.escalation_rate() * 100:.1f}%")
+    if cache is not None:
+        print(f"cache hits = {cache.hits}, misses = {cache.misses}")
+        cache.close()
@@ -0,0 +1,144 @@
+from constants import *
+from Architectures.registry import get_model_class
+
+
+PRETRAINED_PREFIXES = ("wav2vec_extractor.model.",)  # sub-modules whose frozen weights come from the pretrained cache
+
+
+def adapter_state_dict(model):
+    """
+    The state dict of a model without the frozen weights that are restored from the pretrained checkpoints
+    when it is rebuilt: every parameter outside the pretrained sub-modules (including frozen, randomly
+    initialized ones such as the 1-channel CNN stems), the trainable ones (adapters) inside them, and every buffer.
+    """
+    trainable = {name for name, param in model.named_parameters() if param.requires_grad}
+    return {name: value for name, value in model.state_dict(keep_vars=True).items()
+            if name in trainable or not isinstance(value, torch.nn.Parameter)
+            or not name.startswith(PRETRAINED_PREFIXES)}
+
+
+def save_model(model, path, trainable_only=None, batch_size_profile=None):
+    """This function saves the model as a .pth file
+    and keep tracks of:
+    1. the parameters of the model
+    2. the hyperparameters of the model
+    3. the class name of the model to easier later one loading
+
+    With trainable_only, the frozen pretrained Wav2Vec2 weights are not stored (they are restored from the
+    pretrained checkpoints when loading), see adapter_state_dict. By default this is done for models with low-rank adapters.
+    batch_size_profile (see benchmark_methods.profile_batch_sizes) is stored next to the hyperparameters.
+    """
+    if trainable_only is None:
+        trainable_only = model.config.get("lora_rank", 0) > 0 if isinstance(model.config, dict) else False
+
+    if trainable_only:
+        state_dict = {name: value.detach() for name, value in adapter_state_dict(model).items()}
+    else:
+        state_dict = model.state_dict()
+
+    torch.save({
+        'model_state_dict': state_dict,
+        'hyperparameters': model.config,
+        'model_class': model.__class__.__name__,
+        'trainable_only': trainable_only,
+        'batch_size_profile': batch_size_profile},
+        path)
+
+    return path
+
+
+def save_batch_size_profile(save_path, batch_size_profile):
+    """Stores a batch size profile in an existing checkpoint (without rebuilding the model)."""
+    checkpoint = torch.load(save_path, map_location="cpu", weights_only=False)
+    checkpoint['batch_size_profile'] = batch_size_profile
+    torch.save(checkpoint, save_path)
+    return save_path
+
+
+def load_batch_size_profile(save_path):
+    """Returns the batch size profile of a checkpoint, None if it was never profiled."""
+    return torch.load(save_path, map_location="cpu", weights_only=False).get('batch_size_profile')
+
+
+def load_model(save_path, model_class = None):
+    """
+    :param model_class: The class definition for DeepFakeDetection or similar (optional).
+    :param save_path: Path to the saved .pth file.
+    :return: Instantiated model loaded with the best weights.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    checkpoint = torch.load(save_path, map_location=device, weights_only=False)
+
+    # Retrieve hyperparameters
+    hyperparameters = checkpoint.get('hyperparameters', {})
+
+    # Checkpoints saved before the 2D positional encoding was sized from the CNN output grid
+    state_dict = checkpoint['model_state_dict']
+    if "backbone" in hyperparameters and "cnn_grid" not in hyperparameters \
+            and "fusion.pos_encoding_2d.row_embed.weight" in state_dict:
+        hyperparameters["cnn_grid"] = (state_dict["fusion.pos_encoding_2d.row_embed.weight"].shape[0],
+                                       state_dict["fusion.pos_encoding_2d.col_embed.weight"].shape[0])
+
+    # Resolve the saved class name through the lazy registry (imports only the needed architecture)
+    if model_class is None:
+        model_class = get_model_class(checkpoint['model_class'])
+
+    # Load the saved weights into the new model
+    model = model_class(**hyperparameters)  # Instantiate the model
+    if checkpoint.get('trainable_only', False):
+        # Only the trainable weights were saved, the rest comes from the pretrained weights loaded by the model
+        unexpected = model.load_state_dict(checkpoint['model_state_dict'], strict=False).unexpected_keys
+        if unexpected:
+            raise ValueError(f"⚠️ Unexpected keys in `{save_path}`: {unexpected}")
+    else:
+        model.load_state_dict(checkpoint['model_state_dict'])
+
+    return model.to(device)
+
+
+def check_round_trip(model, save_path, atol=1e-5, batch_size=2):
+    """
+    Reloads a saved checkpoint and checks that it gives the same outputs as `model` on random inputs
+    (e.g. that no weight was left out of a trainable_only checkpoint). Raises a ValueError otherwise.
+    """
+    from audio_methods import extract_lfcc_torchaudio
+
+    device = next(model.parameters()).device
+    audio = torch.randn(batch_size, 1, SAMPLE_RATE * CLIP_SECONDS) * 0.1
+    image = torch.stack([extract_lfcc_torchaudio(waveform, SAMPLE_RATE) for waveform in audio])
+    image, audio = image.to(device), audio.to(device)
+
+    was_training = model.training
+    reloaded = load_model(save_path).to(device).eval()
+    model.eval()
+    with torch.no_grad():
+        difference = (model(image, audio) - reloaded(image, audio)).abs().max().item()
+    model.train(was_training)
+    del reloaded
+
+    if difference > atol:
+        raise ValueError(f"⚠️ `{save_path}` does not reproduce the model outputs (max abs difference {difference:.2e}).")
+    return difference
+
+
+def merge_lora_checkpoint(save_path, output_path):
+    """
+    Loads a checkpoint trained with low-rank adapters, folds the adapters into the base weights
+    and saves it as a full checkpoint for inference.
+    """
+    model = load_model(save_path)
+    model.merge_lora()
+    save_model(model, output_path, trainable_only=False)
+    check_round_trip(model, output_path)
+    return output_path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Merge the low-rank adapters of a checkpoint into its base weights.")
+    parser.add_argument("checkpoint", help="checkpoint trained with lora_rank > 0")
+    parser.add_argument("output", help="path of the merged checkpoint")
+    args = parser.parse_args()
+
+    print(f"Merged checkpoint saved to {merge_lora_checkpoint(args.checkpoint, args.output)}")
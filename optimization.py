@@ -4,12 +4,12 @@ from datetime import datetime
 import optuna
 import os
 import numpy as np
-from Architectures.AVDNet import DeepFakeDetector
-from Architectures.AVDNetV2 import AVDNet
-from Architectures.VGG16 import DeepFakeDetection
-from Architectures.VGG16_FeaturesOnly import FeaturesOnly
+from Architectures.registry import get_model_class
+from benchmark_methods import profile_inference, profile_batch_sizes
+from cost_methods import estimate_avdnet_cost
 from data_methods import calculate_metrics, get_dataloader
-from train_methods import train_model, save_model, load_model
+from train_methods import train_model, save_model, load_model, training_state_path
+from model_methods import check_round_trip
 import math
 
 
@@ -43,15 +43,19 @@ class EarlyStopping:
             self.counter = 0
 
 
-def objective(trial):
-    """
-    Optuna objective function for hyperparameter tuning using training and validation sets.
+def suggest_hyperparameters(trial):
     """
-    best_trial_loss = float('inf')
+    Samples the search space of the study. Also used with optuna.trial.FixedTrial to rebuild
+    the configuration of a previous trial (e.g. for distributed training).
 
+    :return: (AVDNet kwargs, learning_rate, micro-batch size, accumulation_steps, dropout, weight_decay)
+    """
     # Hyperparameter search space
     learning_rate = trial.suggest_float("learning_rate", 1e-7, 1e-3, log=True)
-    batch_size = trial.suggest_categorical("batch_size",[8, 16, 32])
+    # Effective batch size (samples per optimizer step), reached by accumulating micro-batches that fit in memory
+    effective_batch_size = trial.suggest_categorical("effective_batch_size", [8, 16, 32, 64, 128])
+    batch_size = min(MICRO_BATCH_SIZE, effective_batch_size)
+    accumulation_steps = effective_batch_size // batch_size
     dropout = trial.suggest_float("dropout", 0.1, 0.70)
     dense_layers = trial.suggest_int("dense_layers", 2, 7)  # total number of dense layers in classifier
     dense_initial_dim = trial.suggest_int("dense_initial_dim", 128, 2048, step=64)
@@ -62,9 +66,22 @@ def objective(trial):
     head_dim = trial.suggest_int("head_dim", 32, 128, step=16)  # or choose an appropriate range
     d_model = head_dim * transformer_nhead
 
+    # Token reduction in the fusion transformer (fusion cost is quadratic in the number of tokens)
+    fusion_token_reduction = trial.suggest_categorical("fusion_token_reduction", ["none", "stride", "learned", "query"])
+    fusion_reduction_factor = 4
+    fusion_queries = 8
+    if fusion_token_reduction in ("stride", "learned"):
+        fusion_reduction_factor = trial.suggest_categorical("fusion_reduction_factor", [2, 4, 8])
+    elif fusion_token_reduction == "query":
+        fusion_queries = trial.suggest_categorical("fusion_queries", [4, 8, 16, 32])
+
     # Pretrained module freezing parameters
     freeze_cnn_layers = trial.suggest_int("freeze_cnn_layers", 5, 15)
-    freeze_encoder_layers = trial.suggest_int("freeze_encoder_layers", 0, 8)
+    # With low-rank adapters the whole wav2vec2 model stays frozen, only the adapters are trained
+    freeze_encoder_layers = trial.suggest_int("freeze_encoder_layers", 0, 8) if WAV2VEC_LORA_RANK == 0 else 0
+
+    # Number of Wav2Vec encoder layers kept (the deeper ones are dropped from the model)
+    wav2vec_layers = trial.suggest_int("wav2vec_layers", 12, 24)
 
     # Backbone selection: choose between 'vgg' and 'resnet'
     # backbone = trial.suggest_categorical("backbone", ["vgg", "resnet"])
@@ -72,14 +89,6 @@ def objective(trial):
     # Optimizer weight decay
     weight_decay = trial.suggest_float("weight_decay", 1e-7, 1e-2, log=True)
 
-    # Print the current trial parameters
-    print(f"Current trial parameters: {trial.params}")
-
-    # Loading the data
-    fraction_to_test = PARTIAL_TRAINING
-    train_loader = get_dataloader("Train", DATASET_FOLDER, batch_size=batch_size, num_workers=2, fraction=fraction_to_test)
-    val_loader = get_dataloader("Validation", DATASET_FOLDER, batch_size=batch_size, num_workers=2, fraction = fraction_to_test)
-
     # Build dense classifier hidden dimensions based on a linear decrease.
     # For instance, if dense_layers=3 and dense_initial_dim=512, you might have dimensions: [256, 128]
     dense_hidden_dims = []
@@ -89,8 +98,7 @@ def objective(trial):
         dense_hidden_dims.append(next_dim)
         current_dim = next_dim
 
-    # Model initialization with tunable parameters.
-    model = AVDNet(
+    model_kwargs = dict(
         backbone="vgg",
         freeze_cnn=True,
         freeze_cnn_layers=freeze_cnn_layers,
@@ -100,14 +108,72 @@ def objective(trial):
         d_model=d_model,
         nhead=transformer_nhead,
         num_layers=transformer_layers,
-        dense_hidden_dims=dense_hidden_dims
-    ).to(DEVICE)
+        dense_hidden_dims=dense_hidden_dims,
+        wav2vec_layers=wav2vec_layers,
+        fusion_token_reduction=fusion_token_reduction,
+        fusion_reduction_factor=fusion_reduction_factor,
+        fusion_queries=fusion_queries,
+        lora_rank=WAV2VEC_LORA_RANK
+    )
 
-    # Apply dynamic dropout to all dropout variants in the model.
+    return model_kwargs, learning_rate, batch_size, accumulation_steps, dropout, weight_decay
+
+
+def set_dropout(model, dropout):
+    """Applies the dropout rate to all dropout variants in the model."""
     for name, module in model.named_modules():
         if isinstance(module, (torch.nn.Dropout, torch.nn.Dropout2d, torch.nn.Dropout3d)):
             module.p = dropout
 
+
+def objective(trial):
+    """
+    Optuna objective function for hyperparameter tuning using training and validation sets.
+    """
+    best_trial_loss = float('inf')
+
+    model_kwargs, learning_rate, batch_size, accumulation_steps, dropout, weight_decay = suggest_hyperparameters(trial)
+
+    # Print the current trial parameters
+    print(f"Current trial parameters: {trial.params}")
+
+    # Static cost estimate: reject over-budget configurations before loading any data or weights
+    cost = estimate_avdnet_cost(batch_size=batch_size, **model_kwargs)
+    for key, value in cost.items():
+        trial.set_user_attr(f"estimated_{key}", value)
+    if COMPUTE_BUDGET_GFLOPS is not None and cost["training_gflops"] > COMPUTE_BUDGET_GFLOPS:
+        raise optuna.TrialPruned(f"Estimated {cost['training_gflops']:.1f} GFLOPs per training sample "
+                                 f"exceed the budget of {COMPUTE_BUDGET_GFLOPS} GFLOPs.")
+    if MEMORY_BUDGET_MB is not None and cost["training_memory_mb"] > MEMORY_BUDGET_MB:
+        raise optuna.TrialPruned(f"Estimated {cost['training_memory_mb']:.0f} MB for training "
+                                 f"exceed the budget of {MEMORY_BUDGET_MB} MB.")
+
+    # Loading the data
+    fraction_to_test = PARTIAL_TRAINING
+    # A seeded data order, so that a resumed trial (see resume_interrupted_trials) sees the same data
+    data_seed = trial.user_attrs.get("data_seed", trial.number)
+    trial.set_user_attr("data_seed", data_seed)
+    # drop_last: a last micro-batch of a single clip would break BatchNorm in training
+    train_loader = get_dataloader("Train", DATASET_FOLDER, batch_size=batch_size, num_workers=2, fraction=fraction_to_test,
+                                  drop_last=True, data_seed=data_seed, crops_per_file=CROPS_PER_FILE, crop_mode=CROP_MODE)
+    val_loader = get_dataloader("Validation", DATASET_FOLDER, batch_size=batch_size, num_workers=2, fraction = fraction_to_test,
+                                data_seed=data_seed)
+
+    # Model initialization with tunable parameters.
+    AVDNet = get_model_class("AVDNet")
+    model = AVDNet(**model_kwargs).to(DEVICE)
+
+    # Apply dynamic dropout to all dropout variants in the model.
+    set_dropout(model, dropout)
+    if ACTIVATION_CHECKPOINTING:
+        model.enable_activation_checkpointing()
+
+    # Serving cost of this configuration, measured before training so that failed trials keep it too
+    for key, value in profile_inference(model).items():
+        trial.set_user_attr(key, value)
+    print(f"Latency = {trial.user_attrs['latency_ms']:.1f} ms (batch of {LATENCY_BATCH_SIZE}), "
+          f"parameters = {trial.user_attrs['parameters']}, peak RSS = {trial.user_attrs['peak_rss_mb']:.0f} MB")
+
     # Loss, optimizer, and early stopping
     criterion = torch.nn.BCEWithLogitsLoss()
     optimizer = setup_optimizer(model, learning_rate, weight_decay)
@@ -124,12 +190,15 @@ def objective(trial):
         optimizer,
         train_loader,
         trial,
-        val_loader
+        val_loader,
+        accumulation_steps
     )
 
     # Store the best validation loss for the trial
     trial.set_user_attr("best_val_loss", best_trial_loss)
 
+    if LATENCY_OBJECTIVE:
+        return best_trial_loss, val_loss, f1, trial.user_attrs["latency_ms"]
     return best_trial_loss, val_loss, f1
 
 
@@ -156,10 +225,11 @@ def evaluate_on_test(model, test_csv, batch_size=None):
     Evaluate the model on the test set after tuning.
     """
 
-    # Create Test DataLoader
-    if type(model) == DeepFakeDetection:
+    # Create Test DataLoader (compare class names to avoid importing every architecture)
+    model_class_name = type(model).__name__
+    if model_class_name == "DeepFakeDetection":
         test_loader = get_dataloader(test_csv, WAV2VEC_FOLDER, batch_size=batch_size, num_workers=2)
-    elif type(model) == DeepFakeDetector:
+    elif model_class_name == "DeepFakeDetector":
         test_loader = get_dataloader("Validation", DATASET_FOLDER, batch_size=batch_size, num_workers=2)
 
     # Testing Loop with DataLoader
@@ -173,11 +243,11 @@ def evaluate_on_test(model, test_csv, batch_size=None):
             x_features_batch, y_batch = x_features_batch.to(DEVICE), y_batch.to(DEVICE)
 
             # Choose model type
-            if isinstance(model, DeepFakeDetection):
+            if model_class_name == "DeepFakeDetection":
                 y_pred = model(x_paths_batch, x_features_batch).squeeze()
-            elif isinstance(model, FeaturesOnly):
+            elif model_class_name == "FeaturesOnly":
                 y_pred = model(x_features_batch).squeeze()
-            elif isinstance(model, DeepFakeDetector):
+            elif model_class_name == "DeepFakeDetector":
                 y_pred = model(x_paths_batch, x_features_batch).squeeze()
 
             # Compute loss
@@ -220,19 +290,28 @@ def save_best_model(study, prefix="DeepFakeModel", extension="pth"):
     model_filename = (
         f"{prefix}_"
         f"lr={params.get('learning_rate', 0.001):.5f}_"
-        f"bs={params.get('batch_size', 32)}_"
+        f"bs={params.get('effective_batch_size', params.get('batch_size', 32))}_"
         f"drop={params.get('dropout', 0.5):.2f}_"
         f"layers={params.get('dense_layers', 3)}_"
         f"valloss={best_val_loss:.4f}.{extension}"
     )
 
+    # Probe the batch sizes that fit this configuration on this hardware
+    batch_size_profile = None
+    if PROFILE_BATCH_SIZES:
+        batch_size_profile = profile_batch_sizes(saved_model)
+
     # Save final checkpoint
-    save_model(saved_model, model_filename)
+    save_model(saved_model, model_filename, batch_size_profile=batch_size_profile)
+    check_round_trip(saved_model, model_filename)
 
     print(f"Best model saved to {model_filename}")
     return model_filename
 
 
+COST_ATTRIBUTES = ("latency_ms", "samples_per_sec", "parameters", "trainable_parameters", "peak_rss_mb", "peak_cuda_mb")
+
+
 def log_result(trial, filename="optuna_trials.csv"):
     """Logs all trial results into a CSV file for easy tracking."""
 
@@ -249,10 +328,14 @@ def log_result(trial, filename="optuna_trials.csv"):
     else:
         return
 
-    # Merge dictionaries, ensuring order: trial_number -> values -> hyperparams
+    # Serving cost measured by the objective (latency, throughput, parameters, memory)
+    cost_dict = {key: trial.user_attrs[key] for key in COST_ATTRIBUTES if key in trial.user_attrs}
+
+    # Merge dictionaries, ensuring order: trial_number -> values -> serving cost -> hyperparams
     ordered_trial_dict = {
         "trial_number": trial.number,  # First column
         **value_dict,  # Multi-objective values (value_0, value_1, ...)
+        **cost_dict,
         **trial.params  # Hyperparameters (remaining values)
     }
 
@@ -335,8 +418,28 @@ def save_all_trials_csv(study, filename_prefix="optuna_results"):
     # print(f"All trial results have been saved to '{filename}'.")
 
 
+def resume_interrupted_trials(study):
+    """
+    Trials left RUNNING in the study storage by a killed process are marked FAIL and enqueued again with the
+    same parameters and data seed, and their last training-state snapshot as "resume_from" (if one was written),
+    so that the next study.optimize continues them where they stopped.
+    Only call it when no other process is running trials of the study.
+    """
+    for trial in study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.RUNNING,)):
+        state_path = training_state_path(trial)
+        study.tell(trial.number, state=optuna.trial.TrialState.FAIL)
+        user_attrs = {"data_seed": trial.user_attrs.get("data_seed", trial.number)}
+        if os.path.exists(state_path):
+            user_attrs["resume_from"] = state_path
+        study.enqueue_trial(trial.params, user_attrs=user_attrs)
+        print(f"Trial {trial.number} was interrupted, re-enqueued" +
+              (f" to resume from {state_path}" if "resume_from" in user_attrs else ""))
+
+
 def save_best_model_callback(study, trial):
     global best_model_path, best_validation_loss
+    if trial.state != optuna.trial.TrialState.COMPLETE:  # e.g. pruned as over budget
+        return
     this_trial_loss = trial.user_attrs["best_val_loss"]
     this_trial_model_path = trial.user_attrs["best_model_path"]
 
@@ -350,6 +453,7 @@ def save_best_model_callback(study, trial):
 
 # Run Optuna optimization
 if __name__ == "__main__":
+    print("Runnig on device:", DEVICE)
     best_model = None
     best_model_path = None
     best_validation_loss = 1000000
@@ -368,18 +472,26 @@ if __name__ == "__main__":
     if not LOAD_TRAINING:
         STUDY_DB_PATH = None
 
+    # Load the pretrained weights once, every trial then copies them in memory
+    from Architectures.AVDNetV2 import warm_pretrained_cache, clear_pretrained_cache
+    warm_pretrained_cache(backbones=("vgg",))
+
     # run the optuna study
     study = optuna.create_study(storage=STUDY_DB_PATH,
                                 study_name="speech_classification",
-                                directions=["minimize", "minimize", "maximize"],
+                                directions=["minimize", "minimize", "maximize"] + (["minimize"] if LATENCY_OBJECTIVE else []),
                                 load_if_exists=LOAD_TRAINING)
 
+    if LOAD_TRAINING and RESUME_INTERRUPTED_TRIALS:
+        resume_interrupted_trials(study)
+
     if hasattr(study, "num_trials"):
         nb_trials = TRIALS - study.num_trials if TRIALS > study.num_trials else 0
     else:
         nb_trials = TRIALS
 
     study.optimize(objective, n_trials=nb_trials, show_progress_bar=True, callbacks=[save_best_model_callback])
+    clear_pretrained_cache()  # the models built from here on are few, no need to keep the weights in memory
 
     #save the results
     save_all_trials_csv(study, filename_prefix="data/results/optuna_results")
@@ -394,6 +506,9 @@ if __name__ == "__main__":
         print(f"  Best Loss       = {trial.values[0]:.6f}")
         print(f"  Last Epoch Loss = {trial.values[1]:.6f}")
         print(f"  F1-score        = {trial.values[2]:.6f}")
+        if "latency_ms" in trial.user_attrs:
+            print(f"  Latency         = {trial.user_attrs['latency_ms']:.1f} ms "
+                  f"({trial.user_attrs['samples_per_sec']:.1f} samples/s, {trial.user_attrs['parameters']} parameters)")
         print("  Hyperparameters:")
         for key, value in trial.params.items():
             print(f"    {key}: {value}")
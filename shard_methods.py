@@ -0,0 +1,294 @@
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import tarfile
+import urllib.request
+
+import pandas as pd
+import torchaudio
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+
+from constants import *
+from audio_methods import fix_length, extract_lfcc_torchaudio, load_audio
+from data_methods import RawAudioDatasetLoader, augment_audio, augment_audio_fixed
+from distributed_methods import get_rank, get_world_size
+
+# Sharded storage of an audio corpus: tar files holding, for every clip, the compressed audio
+# ("{key}.flac" or "{key}.opus") followed by its metadata ("{key}.json": path, label, language, technique).
+# A JSON index ("{prefix}-index.json") lists the shards and their number of clips.
+
+CODEC_FORMATS = {"flac": "flac", "opus": "opus"}  # extension -> torchaudio format (opus needs the ffmpeg backend)
+
+
+def manifest_items(manifest_path):
+    """Reads a manifest CSV (columns path and label, optionally language and technique) into metadata dicts."""
+    manifest = pd.read_csv(manifest_path, keep_default_na=False)
+    return [{"path": row["path"], "label": int(row["label"]),
+             "language": row.get("language", ""), "technique": row.get("technique", "")}
+            for row in manifest.to_dict("records")]
+
+
+def encode_audio(waveform, sample_rate, codec="flac"):
+    """Compresses a waveform, returns the encoded bytes."""
+    buffer = io.BytesIO()
+    if codec == "flac":
+        torchaudio.save(buffer, waveform, sample_rate, format="flac", bits_per_sample=16)
+    else:
+        torchaudio.save(buffer, waveform, sample_rate, format=CODEC_FORMATS[codec])
+    return buffer.getvalue()
+
+
+def add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shards(items, output_prefix, shard_samples=2000, codec="flac"):
+    """
+    Packs audio files, converted to 16kHz mono, into tar shards of `shard_samples` clips (the last one may hold fewer).
+    The items are written in the given order, shuffle them beforehand so that every shard mixes the sources.
+
+    :param items: Metadata dicts with at least path and label (see manifest_items, dataset get_metadata).
+    :param output_prefix: Shards are written to `{output_prefix}-00000.tar`, ...
+    :param shard_samples: Number of clips per shard.
+    :param codec: "flac" (lossless) or "opus".
+    :return: Path of the index.
+    """
+    if codec not in CODEC_FORMATS:
+        raise ValueError(f"Unknown codec `{codec}`, expected one of {list(CODEC_FORMATS)}.")
+    if os.path.dirname(output_prefix):
+        os.makedirs(os.path.dirname(output_prefix), exist_ok=True)
+
+    shards = []
+    tar = None
+    skipped = 0
+    for item in items:
+        try:
+            waveform, sr = load_audio(item["path"], SAMPLE_RATE)
+        except RuntimeError as error:
+            print(f"⚠️ Skipping unreadable `{item['path']}`: {error}")
+            skipped += 1
+            continue
+
+        if tar is None or shards[-1]["samples"] == shard_samples:
+            if tar is not None:
+                tar.close()
+            name = f"{os.path.basename(output_prefix)}-{len(shards):05d}.tar"
+            tar = tarfile.open(os.path.join(os.path.dirname(output_prefix), name), "w")
+            shards.append({"name": name, "samples": 0})
+
+        key = f"{len(shards) - 1:05d}{shards[-1]['samples']:06d}"
+        add_bytes(tar, f"{key}.{codec}", encode_audio(waveform, sr, codec))
+        add_bytes(tar, f"{key}.json", json.dumps({**item, "sample_rate": sr}).encode())
+        shards[-1]["samples"] += 1
+    if tar is not None:
+        tar.close()
+
+    index_path = f"{output_prefix}-index.json"
+    with open(index_path, "w") as f:
+        json.dump({"codec": codec, "samples": sum(shard["samples"] for shard in shards), "shards": shards}, f, indent=1)
+    print(f"Wrote {sum(shard['samples'] for shard in shards)} clips in {len(shards)} shards ({skipped} skipped)")
+    return index_path
+
+
+def write_dataset_shards(root_dir, dataset_type, output_prefix, shard_samples=2000, codec="flac"):
+    """Packs one split of a Real/Fake dataset folder (the files RawAudioDatasetLoader would load) into shards."""
+    dataset = RawAudioDatasetLoader(root_dir=root_dir, dataset_type=dataset_type)  # shuffled file list
+    return write_shards([dataset.get_metadata(i) for i in range(len(dataset))], output_prefix, shard_samples, codec)
+
+
+def fetch_shard(location, cache_dir, max_cache_mb=None):
+    """
+    Returns a local path of a shard. Remote shards (http(s)://) and, when a cache_dir is given, shards on
+    another (e.g. network) file system are copied to cache_dir first; the least recently used shards are
+    removed beyond max_cache_mb.
+    """
+    remote = location.startswith(("http://", "https://"))
+    if cache_dir is None:
+        if remote:
+            raise ValueError(f"A cache_dir is needed to read the remote shard `{location}`.")
+        return location
+
+    os.makedirs(cache_dir, exist_ok=True)
+    local_path = os.path.join(cache_dir, os.path.basename(location))
+    if os.path.exists(local_path):
+        os.utime(local_path)  # mark as recently used
+        return local_path
+
+    temp_path = f"{local_path}.{os.getpid()}.tmp"  # several workers may fetch the same shard
+    if remote:
+        with urllib.request.urlopen(location) as response, open(temp_path, "wb") as f:
+            shutil.copyfileobj(response, f)
+    else:
+        shutil.copyfile(location, temp_path)
+    os.replace(temp_path, local_path)
+
+    if max_cache_mb is not None:
+        cached = sorted((os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".tar")),
+                        key=os.path.getmtime)
+        total_mb = sum(os.path.getsize(path) for path in cached) / 2 ** 20
+        for path in cached[:-1]:  # never the shard just fetched
+            if total_mb <= max_cache_mb:
+                break
+            total_mb -= os.path.getsize(path) / 2 ** 20
+            os.remove(path)
+    return local_path
+
+
+def read_shard(path):
+    """Streams the (audio bytes, torchaudio format, metadata) of the clips of a shard, reading the tar sequentially."""
+    audio = None  # (key, bytes, format) of the last audio member, its metadata follows it
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            key, extension = member.name.rsplit(".", 1)
+            data = tar.extractfile(member).read()
+            if extension != "json":
+                audio = (key, data, CODEC_FORMATS.get(extension, extension))
+            elif audio is not None and audio[0] == key:
+                yield audio[1], audio[2], json.loads(data)
+                audio = None
+
+
+class ShardedAudioDataset(IterableDataset):
+    def __init__(self, index_path, dataset_type="Train", shuffle=True, shuffle_buffer=1000, seed=0, cache_dir=None,
+                 max_cache_mb=None):
+        """
+        Streams the clips of the shards written by write_shards and yields the same (lfcc, waveform, label)
+        triples as RawAudioDatasetLoader. Every DataLoader worker of every rank reads its own subset of the
+        shards, sequentially, and every rank yields n_samples // world_size clips.
+
+        Args:
+            index_path (str): Index written by write_shards (local path or http(s) URL), the shards are
+                next to it.
+            dataset_type (str): "Train" applies the data augmentation.
+            shuffle (bool): Shuffle the shard order every epoch (call set_epoch) and the clips through a buffer.
+            shuffle_buffer (int): Number of clips of the clip-level shuffle buffer.
+            seed (int): Seed of the shuffling.
+            cache_dir (str): Local directory the shards are copied to before reading (needed for remote shards).
+            max_cache_mb (float): Size of the local shard cache, None for unlimited.
+        """
+        if index_path.startswith(("http://", "https://")):
+            with urllib.request.urlopen(index_path) as response:
+                index = json.load(response)
+        else:
+            with open(index_path) as f:
+                index = json.load(f)
+        base = index_path.rsplit("/", 1)[0] if "/" in index_path else "."
+        self.shards = [f"{base}/{shard['name']}" for shard in index["shards"]]
+        self.n_samples = index["samples"]
+        self.dataset_type = dataset_type
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.max_cache_mb = max_cache_mb
+        self.epoch = 0
+        self.augment_prob = 0.20
+        self.sample_rate = 16000
+        self.expected_length = self.sample_rate * 4  # 4 seconds
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        """Clips per rank, the same on every rank (see worker_clips)."""
+        return self.n_samples // get_world_size()
+
+    def worker_shards(self):
+        """Shards of this (rank, worker), the order is shuffled the same way on every rank and worker."""
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+        return shards[get_rank() * num_workers + worker_id::get_world_size() * num_workers]
+
+    def worker_quota(self):
+        """Clips yielded by this (rank, worker): the clips of the rank, len(self), shared between its workers."""
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+        return len(self) // num_workers + (worker_id < len(self) % num_workers)
+
+    def worker_clips(self):
+        """
+        Streams exactly worker_quota() clips from the shards of this worker: the shards rarely split evenly, so the
+        stream stops early or starts over its shards (all the shards for a worker without any), and every rank
+        yields the same number of clips (DistributedDataParallel waits for every rank at every step).
+        """
+        quota = self.worker_quota()
+        if quota == 0:
+            return
+        shards = self.worker_shards()
+        count = 0
+        for shard in itertools.chain(shards, itertools.cycle(shards or self.shards)):
+            for clip in read_shard(fetch_shard(shard, self.cache_dir, self.max_cache_mb)):
+                yield clip
+                count += 1
+                if count == quota:
+                    return
+
+    def prepare(self, audio, audio_format, metadata):
+        waveform, sr = load_audio(io.BytesIO(audio), self.sample_rate, format=audio_format)
+        label = torch.tensor(metadata["label"], dtype=torch.float32)
+
+        # Decide whether to apply augmentation.
+        use_augmented = random.random() < self.augment_prob
+        if use_augmented and self.dataset_type == "Train":
+            if DATA_AUGMENTATION:
+                waveform, _ = augment_audio_fixed(waveform, self.sample_rate)
+            else:
+                waveform, _ = augment_audio(waveform, sr)
+
+        waveform = fix_length(waveform, self.expected_length)
+        return extract_lfcc_torchaudio(waveform, sr), waveform, label
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        generator = random.Random(f"{self.seed}-{self.epoch}-{get_rank()}-{worker_info.id if worker_info else 0}")
+        buffer = []
+        for audio, audio_format, metadata in self.worker_clips():
+            if not self.shuffle:
+                yield self.prepare(audio, audio_format, metadata)
+                continue
+            # clip-level shuffle: emit a random clip of the buffer once it is full (decoding only what is emitted)
+            buffer.append((audio, audio_format, metadata))
+            if len(buffer) >= self.shuffle_buffer:
+                yield self.prepare(*buffer.pop(generator.randrange(len(buffer))))
+        generator.shuffle(buffer)
+        for item in buffer:
+            yield self.prepare(*item)
+
+
+def get_shard_dataloader(index_path, dataset_type="Train", batch_size=32, shuffle=True, num_workers=4, pin_memory=False,
+                         seed=0, cache_dir=None, max_cache_mb=None, drop_last=False):
+    """
+    DataLoader over a ShardedAudioDataset (call loader.dataset.set_epoch(epoch) every epoch when shuffling).
+    Use at least as many shards as ranks * num_workers, otherwise some workers only re-read the shards of the others.
+    """
+    dataset = ShardedAudioDataset(index_path, dataset_type=dataset_type, shuffle=shuffle, seed=seed,
+                                  cache_dir=cache_dir, max_cache_mb=max_cache_mb)
+    return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=pin_memory,
+                      drop_last=drop_last)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack an audio corpus into compressed tar shards for streaming.")
+    parser.add_argument("output", help="output prefix of the shards, e.g. shards/train")
+    parser.add_argument("--root-dir", default=DATASET_FOLDER, help="Real/Fake dataset folder")
+    parser.add_argument("--split", default="Train", choices=["Train", "Validation", "Test"])
+    parser.add_argument("--manifest", default=None, help="CSV with path and label columns (instead of --root-dir)")
+    parser.add_argument("--shard-samples", type=int, default=2000)
+    parser.add_argument("--codec", default="flac", choices=list(CODEC_FORMATS))
+    args = parser.parse_args()
+
+    if args.manifest:
+        items = manifest_items(args.manifest)
+        random.Random(0).shuffle(items)
+        print(write_shards(items, args.output, args.shard_samples, args.codec))
+    else:
+        print(write_dataset_shards(args.root_dir, args.split, args.output, args.shard_samples, args.codec))
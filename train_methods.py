@@ -1,11 +1,16 @@
-import importlib
+import os
+import random
 import time
+from contextlib import nullcontext
 
 import matplotlib
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import numpy as np
 from data_methods import calculate_metrics
+from model_methods import save_model, load_model
+from distributed_methods import all_reduce_sum, all_gather_list, all_reduce_gradients, any_rank, get_rank, \
+    is_main_process, unwrap_model
 matplotlib.use('Agg')
 from constants import *
 
@@ -22,104 +27,88 @@ def plot_loss(data, dir_path = ""):
     plt.savefig(dir_path + '/loss_plot.jpeg')
 
 
-def save_model(model, path):
-    """This function saves the model as a .pth file
-    and keep tracks of:
-    1. the parameters of the model
-    2. the hyperparameters of the model
-    3. the class name of the model to easier later one loading
-    """
-
-    torch.save({
-        'model_state_dict': model.state_dict(),
-        'hyperparameters': model.config,
-        'model_class': model.__class__.__name__},
-        path)
-
-    return path
-
-
-def load_model(save_path, model_class = None):
-    """
-    :param model_class: The class definition for DeepFakeDetection or similar (optional).
-    :param save_path: Path to the saved .pth file.
-    :return: Instantiated model loaded with the best weights.
-    """
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    checkpoint = torch.load(save_path, map_location=device, weights_only=False)
-
-    # Retrieve hyperparameters
-    hyperparameters = checkpoint.get('hyperparameters', {})
-
-
-    # Retrieve the saved class name
-    model_class_name = checkpoint['model_class']
-    if model_class is None:
-        # Ensure the class is defined in the current environment
-        if model_class_name in globals():
-            model_class = globals()[model_class_name]  # Get the class reference
-        else:
-            try:
-                module_name = f"data.Architectures.{model_class_name}"  # Replace with the correct module path
-                module = importlib.import_module(module_name)
-                model_class = getattr(module, model_class_name)
-            except (ModuleNotFoundError, AttributeError):
-                raise ValueError(f"⚠️ Class `{model_class_name}` not found in the current script or module.\n"
-                                 f"👉 Ensure `{model_class_name}` is correctly defined in `{module_name}`.\n"
-                                 f"👉 Alternatively, pass `model_class` explicitly to `load_model()`.")
-
-    # Load the saved weights into the new model
-    model = model_class(**hyperparameters)  # Instantiate the model
-    model.load_state_dict(checkpoint['model_state_dict'])
-
-    return model.to(device)
+def apply_accumulated_gradients(model, optimizer, accumulated, synced):
+    """Optimizer step on the gradients accumulated over `accumulated` valid micro-batches, then zeroes them."""
+    if accumulated > 0:
+        if not synced:  # the micro-batch that should have synchronized the window was skipped
+            all_reduce_gradients(model)
+        # average over the valid micro-batches of the window
+        if accumulated > 1:
+            for param in model.parameters():
+                if param.grad is not None:
+                    param.grad.div_(accumulated)
+        optimizer.step()
+    optimizer.zero_grad(set_to_none=True)
 
 
-def train_one_epoch(model, train_loader, optimizer, criterion):
+def train_one_epoch(model, train_loader, optimizer, criterion, accumulation_steps=1, start_step=0, totals=None,
+                    on_step=None):
     """
     Performs one epoch of training. Returns the average training loss
     and a flag indicating if early termination is needed due to
     numerical instability (NaN/Inf in loss).
+
+    With accumulation_steps > 1 every batch of the loader is a micro-batch and the optimizer steps once
+    every `accumulation_steps` micro-batches, on the gradient averaged over the micro-batches of the window
+    (micro-batches skipped for NaN/Inf are left out of the average). BatchNorm statistics are computed per
+    micro-batch, as they would be per device in data parallel training.
+
+    An interrupted epoch is continued with start_step (micro-batches already done, the loader must skip them)
+    and totals, the (train_loss, count_train, exploding_batch_count) sums of that part of the epoch.
+    on_step(step, totals) is called after every optimizer step, e.g. to snapshot the training state.
     """
     model.train()
-    train_loss = 0.0
-    count_train = 0
-    exploding_batch_count = 0
+    train_loss, count_train, exploding_batch_count = totals or (0.0, 0, 0)
+    n_steps = start_step + len(train_loader)
+    accumulated = 0  # valid micro-batches in the current accumulation window
+    synced = False  # whether the gradients of the window were already all-reduced by DistributedDataParallel
+    optimizer.zero_grad(set_to_none=True)
 
-    for input_1, input_2, y_batch in train_loader:
+    for step, (input_1, input_2, y_batch) in enumerate(train_loader, start=start_step):
         input_1, input_2, y_batch = (
             input_1.to(DEVICE),
             input_2.to(DEVICE),
             y_batch.to(DEVICE)
         )
-        optimizer.zero_grad()
-
-        y_pred = model(input_1, input_2).squeeze()
-        y_batch = y_batch.view(-1)  # ensure the shapes match
-        y_pred = y_pred.squeeze(-1)  # handle extra dimension if present
-        loss = criterion(y_pred, y_batch.float())
-
-        # Check for numerical instability
-        if torch.isnan(loss) or torch.isinf(loss):
-            exploding_batch_count += 1
-            del loss  # Free the loss tensor
-            torch.cuda.empty_cache()  # Manually clear GPU cache
-
-            if exploding_batch_count >= len(train_loader) * 0.1:
-                print("Warning: NaN/Inf detected in loss. Skipping training.")
-                return float('inf'), True  # Return infinite loss, signal early termination
-
-            continue
+        end_of_window = (step + 1) % accumulation_steps == 0 or step + 1 == n_steps
 
-        # Backpropagation step
-        loss.backward()
-        optimizer.step()
-        optimizer.zero_grad(set_to_none=True)
-
-        train_loss += loss.detach().item()
-        count_train += 1
+        # Only the last micro-batch of a window all-reduces the gradients across ranks
+        with model.no_sync() if hasattr(model, "no_sync") and not end_of_window else nullcontext():
+            y_pred = model(input_1, input_2).squeeze()
+            y_batch = y_batch.view(-1)  # ensure the shapes match
+            y_pred = y_pred.squeeze(-1)  # handle extra dimension if present
+            loss = criterion(y_pred, y_batch.float())
+
+            # Check for numerical instability (on every rank together, so that they all skip the same steps)
+            if any_rank(torch.isnan(loss) or torch.isinf(loss)):
+                exploding_batch_count += 1
+                del loss  # Free the loss tensor
+                torch.cuda.empty_cache()  # Manually clear GPU cache
+
+                if exploding_batch_count >= n_steps * 0.1:
+                    print("Warning: NaN/Inf detected in loss. Skipping training.")
+                    optimizer.zero_grad(set_to_none=True)
+                    return float('inf'), True  # Return infinite loss, signal early termination
+            else:
+                # Backpropagation step (gradients accumulate over the window)
+                loss.backward()
+                accumulated += 1
+                synced = end_of_window
+                train_loss += loss.detach().item()
+                count_train += 1
+
+        if end_of_window:
+            apply_accumulated_gradients(model, optimizer, accumulated, synced)
+            accumulated = 0
+            synced = False
+            if on_step is not None:
+                on_step(step + 1, (train_loss, count_train, exploding_batch_count))
+
+    # the loader ended before its len() (e.g. a ShardedAudioDataset whose shards split unevenly)
+    apply_accumulated_gradients(model, optimizer, accumulated, synced)
 
     # Avoid division by zero in case all batches got skipped
+    train_loss, count_train = all_reduce_sum(train_loss, count_train)
     avg_train_loss = train_loss / (count_train + 1e-10)
     return avg_train_loss, False
 
@@ -148,51 +137,174 @@ def validate_model(model, val_loader, criterion):
             all_y_true.extend(y_batch.detach().cpu().numpy())
             all_y_pred.extend(y_pred.detach().squeeze().cpu().numpy())
 
-    avg_val_loss = val_loss / len(val_loader)
+    # Over the whole split when the loader is sharded across ranks
+    val_loss, val_batches = all_reduce_sum(val_loss, len(val_loader))
+    all_y_true, all_y_pred = all_gather_list(all_y_true), all_gather_list(all_y_pred)
+
+    avg_val_loss = val_loss / val_batches
     accuracy, recall, f1 = calculate_metrics(np.array(all_y_true), np.array(all_y_pred))
     return avg_val_loss, accuracy, recall, f1
 
 
-def train_model(best_trial_loss, criterion, early_stopping, model, optimizer, train_loader, trial, val_loader):
+def run_name(trial):
+    """
+    Name of the checkpoint files of a training run: trial_{number} for the trials of a study, or the run_name
+    user attribute of runs outside a study (their FixedTrial is always number 0).
+    """
+    return trial.user_attrs.get("run_name") or f"trial_{trial.number}"
+
+
+def training_state_path(trial):
+    """Snapshot file of a trial (a resumed trial keeps writing to the snapshot it was resumed from)."""
+    return trial.user_attrs.get("resume_from") or f"checkpoints/training_state_{run_name(trial)}.pth"
+
+
+def capture_rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_training_state(path, model, optimizer, early_stopping, epoch, step, best_trial_loss, totals=None,
+                        best_model_path=None):
+    """
+    Snapshots everything needed to continue a training run: model and optimizer state, EarlyStopping counters,
+    epoch and micro-batch index in the epoch, best loss so far, and the RNG states and partial epoch sums of
+    every rank. Must be called on every rank, rank 0 writes the file (atomically, a kill while writing keeps
+    the previous snapshot).
+    """
+    ranks = all_gather_list([{"rng": capture_rng_state(), "totals": totals}])
+    if not is_main_process():
+        return path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    torch.save({"model_state_dict": unwrap_model(model).state_dict(),
+                "optimizer_state_dict": optimizer.state_dict(),
+                "early_stopping": dict(vars(early_stopping)),
+                "epoch": epoch,
+                "step": step,
+                "best_trial_loss": best_trial_loss,
+                "best_model_path": best_model_path,
+                "ranks": ranks}, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def load_training_state(path, model, optimizer, early_stopping):
+    """
+    Restores a snapshot written by save_training_state into the model, optimizer and EarlyStopping,
+    and the RNG state of this rank. Returns the snapshot (epoch, step, best_trial_loss, best_model_path)
+    with the partial epoch sums of this rank under "totals".
+    """
+    state = torch.load(path, map_location=DEVICE, weights_only=False)
+    unwrap_model(model).load_state_dict(state["model_state_dict"])
+    optimizer.load_state_dict(state["optimizer_state_dict"])
+    vars(early_stopping).update(state["early_stopping"])
+
+    rank_state = state["ranks"][get_rank()] if get_rank() < len(state["ranks"]) else state["ranks"][0]
+    restore_rng_state(rank_state["rng"])
+    state["totals"] = rank_state["totals"]
+    return state
+
+
+def train_model(best_trial_loss, criterion, early_stopping, model, optimizer, train_loader, trial, val_loader,
+                accumulation_steps=1):
     """
     Main training method that loops over EPOCHS, calling the
     separate train and validation methods.
+    `accumulation_steps` micro-batches of train_loader are accumulated per optimizer step.
+
+    The training state is snapshotted every SNAPSHOT_EVERY_STEPS optimizer steps and at the end of every epoch
+    (see training_state_path), a trial with a "resume_from" user attribute continues from that snapshot.
+    Mid-epoch resumption needs a train_loader with a ResumableSampler (get_dataloader with a data_seed).
     """
-    for epoch in tqdm(range(EPOCHS)):
+    state_path = training_state_path(trial)
+    # the epoch-aware part of the loader: its sampler, a CropBatchSampler or a ShardedAudioDataset
+    sampler = next((candidate for candidate in (train_loader.batch_sampler, train_loader.sampler, train_loader.dataset)
+                    if hasattr(candidate, "set_epoch")), train_loader.sampler)
+    start_epoch, start_step, totals = 0, 0, None
+    if trial.user_attrs.get("resume_from") and os.path.exists(state_path):
+        state = load_training_state(state_path, model, optimizer, early_stopping)
+        start_epoch, start_step, totals = state["epoch"], state["step"], state["totals"]
+        best_trial_loss = state["best_trial_loss"]
+        if state["best_model_path"] is not None:
+            trial.set_user_attr("best_model_path", state["best_model_path"])
+        if start_step and not hasattr(sampler, "set_start_index"):
+            start_step, totals = 0, None  # the loader cannot skip what was done, restart the epoch
+        if is_main_process():
+            print(f"Resuming from {state_path}: epoch {start_epoch}, step {start_step}")
+
+    val_loss, f1 = float('inf'), 0
+    for epoch in tqdm(range(start_epoch, EPOCHS), initial=start_epoch, total=EPOCHS, disable=not is_main_process()):
+        # reshuffle the shards of a distributed sampler
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+        if hasattr(sampler, "set_start_index"):
+            sampler.set_start_index(start_step * train_loader.batch_sampler.batch_size)
+
+        def snapshot(step, step_totals):
+            if SNAPSHOT_EVERY_STEPS and (step // accumulation_steps) % SNAPSHOT_EVERY_STEPS == 0:
+                save_training_state(state_path, model, optimizer, early_stopping, epoch, step, best_trial_loss,
+                                    step_totals, trial.user_attrs.get("best_model_path"))
+
         # --- TRAINING PHASE ---
         train_loss, early_termination = train_one_epoch(
-            model, train_loader, optimizer, criterion
+            model, train_loader, optimizer, criterion, accumulation_steps, start_step, totals, snapshot
         )
+        start_step, totals = 0, None
 
         # If we detect NaN/Inf too often, stop and return worst values
         if early_termination:
+            remove_training_state(state_path)
             return float('inf'), float('inf'), 0
 
         # --- VALIDATION PHASE ---
         val_loss, accuracy, recall, f1 = validate_model(model, val_loader, criterion)
 
         now = time.strftime("%d/%m %H:%M:%S", time.localtime())
-        print(
-            f"\n{now} - "
-            f"Epoch {epoch} : "
-            f"Train Loss = {train_loss:.4f}, "
-            f"Validation Loss = {val_loss:.4f}, "
-            f"Accuracy = {accuracy:.4f}, "
-            f"Recall = {recall:.4f}, "
-            f"F1 = {f1:.4f}"
-        )
+        if is_main_process():
+            print(
+                f"\n{now} - "
+                f"Epoch {epoch} : "
+                f"Train Loss = {train_loss:.4f}, "
+                f"Validation Loss = {val_loss:.4f}, "
+                f"Accuracy = {accuracy:.4f}, "
+                f"Recall = {recall:.4f}, "
+                f"F1 = {f1:.4f}"
+            )
 
         # Track the best validation loss
         if val_loss < best_trial_loss:
             best_trial_loss = val_loss
-            temp_model_path = f"checkpoints/tmp_model_trial_{trial.number}.pth"
+            temp_model_path = f"checkpoints/tmp_model_{run_name(trial)}.pth"
             trial.set_user_attr("best_model_path", temp_model_path)
-            save_model(model, temp_model_path)
+            if is_main_process():  # the ranks hold identical weights
+                os.makedirs(os.path.dirname(temp_model_path), exist_ok=True)
+                save_model(unwrap_model(model), temp_model_path)
 
         # Early stopping check
         early_stopping(val_loss)
         if early_stopping.early_stop:
+            remove_training_state(state_path)
             return best_trial_loss, val_loss, f1
 
+        save_training_state(state_path, model, optimizer, early_stopping, epoch + 1, 0, best_trial_loss,
+                            best_model_path=trial.user_attrs.get("best_model_path"))
+
+    remove_training_state(state_path)
     return best_trial_loss, val_loss, f1
 
+
+def remove_training_state(path):
+    """Deletes the snapshot of a finished run."""
+    if is_main_process() and os.path.exists(path):
+        os.remove(path)
+